@@ -0,0 +1,103 @@
+# Teste de carga: N pedidos /get-tipster-strategy em simultâneo contra uma OpenAI falsa lenta.
+# Com o I/O assíncrono os pedidos sobrepõem-se e o tempo total fica perto da latência de uma chamada;
+# se algo bloquear o event loop, serializam (~N x latência). Durante a carga, /test-connection é sondado
+# para confirmar que o loop continua a responder.
+#
+#   python bench/concurrency_check.py --requests 8 --openai-latency 1.0
+#   python bench/concurrency_check.py --requests 16 --tolerance 0.3   # exit 1 se serializar
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+from run_collect import API_KEY, configure_environment, free_port, start_backends, wait_for_backends
+
+SAMPLE_TIPS = [
+    { "market": "Over 2.5", "odds": 1.85, "league": "Premier League", "date": "2024-01-01T15:00:00Z" },
+    { "market": "BTTS", "odds": 1.70, "league": "La Liga", "date": "2024-01-02T20:00:00Z" },
+    { "market": "1X2", "odds": 2.10, "league": "Serie A", "date": "2024-01-03T19:45:00Z" }
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prova que pedidos com chamadas lentas ao LLM não serializam")
+    parser.add_argument("--requests", type=int, default=8, help="Pedidos em simultâneo")
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--probe-interval", type=float, default=0.05, help="Intervalo entre sondas ao /test-connection")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Tempo total máximo aceite, em múltiplos extra da latência")
+    return parser.parse_args()
+
+async def run_check(args, port: int, backend_process: subprocess.Popen) -> dict:
+    import httpx
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    headers = { "Authorization": f"Bearer {API_KEY}" }
+    async with httpx.AsyncClient(timeout=30) as backend, httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as service:
+        await wait_for_backends(backend, port, backend_process)
+        await backend.post(f"http://127.0.0.1:{port}/_reset")
+        done = asyncio.Event()
+        probe_latencies = []
+
+        async def send() -> int:
+            response = await service.post("/get-tipster-strategy", json={ "tips": SAMPLE_TIPS }, headers=headers)
+            return response.status_code
+
+        async def probe():
+            while not done.is_set():
+                started = time.perf_counter()
+                await service.post("/test-connection", headers=headers)
+                probe_latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(args.probe_interval)
+
+        probe_task = asyncio.create_task(probe())
+        started = time.perf_counter()
+        statuses = await asyncio.gather(*(send() for _ in range(args.requests)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await probe_task
+        backend_calls = (await backend.get(f"http://127.0.0.1:{port}/_stats")).json()
+
+    await main.http_client.aclose()
+    await main.client.close()
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "http_errors": sum(1 for status in statuses if status != 200),
+        "openai_requests": backend_calls.get("openai_requests", 0),
+        "probe_max_seconds": round(max(probe_latencies, default=0.0), 3)
+    }
+
+if __name__ == "__main__":
+    args = parse_args()
+    port = free_port()
+    state_dir = tempfile.mkdtemp(prefix="bench_")
+    configure_environment(args, port, os.path.join(state_dir, "state.db"))
+    # O semáforo do LLM limitaria a sobreposição por desenho: abre-o para o número de pedidos
+    os.environ["LLM_CONCURRENCY"] = str(args.requests)
+    backend_args = argparse.Namespace(openai_latency=args.openai_latency, openai_jitter=0.0, openai_error_rate=0.0, storage_latency=0.0, seed=0)
+    backend_process = start_backends(backend_args, port)
+    try:
+        result = asyncio.run(run_check(args, port, backend_process))
+    finally:
+        backend_process.terminate()
+        backend_process.wait()
+    limit = args.openai_latency * (1 + args.tolerance)
+    print(f"[Bench] 📊 {args.requests} pedidos em {result['elapsed_seconds']}s (uma chamada: {args.openai_latency}s, limite: {limit:.2f}s)")
+    print(f"[Bench]   chamadas OpenAI: {result['openai_requests']}, erros HTTP: {result['http_errors']}")
+    print(f"[Bench]   sonda /test-connection durante a carga: máx {result['probe_max_seconds']}s")
+    failures = []
+    if result["http_errors"] or result["openai_requests"] != args.requests:
+        failures.append("nem todos os pedidos chegaram à OpenAI falsa")
+    if result["elapsed_seconds"] > limit:
+        failures.append(f"tempo total {result['elapsed_seconds']}s > {limit:.2f}s: os pedidos serializaram")
+    if result["probe_max_seconds"] > args.openai_latency / 2:
+        failures.append(f"event loop bloqueado: sonda demorou {result['probe_max_seconds']}s")
+    for failure in failures:
+        print(f"[Bench] ❌ {failure}")
+    if failures:
+        sys.exit(1)
+    print("[Bench] ✅ Pedidos concorrentes não serializam")
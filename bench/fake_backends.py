@@ -0,0 +1,120 @@
+# Servidor local que substitui a OpenAI (chat completions) e o Supabase (storage e tabelas REST)
+# durante o benchmark. Latência e taxa de erro configuráveis; GET /_stats devolve as chamadas recebidas.
+#
+#   python bench/fake_backends.py --port 8765 --openai-latency 0.4 --openai-error-rate 0.02
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from collections import Counter
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "messages.jsonl")
+# O gerador de histórico acrescenta este sufixo para que cada texto seja único (sem hits na cache)
+UNIQUE_SUFFIX_PATTERN = re.compile(r"\s*\[bench:[^\]]*\]$")
+
+def load_fixtures(path: str = FIXTURES_PATH) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def create_app(openai_latency: float, openai_jitter: float, openai_error_rate: float, storage_latency: float, seed: int = 0) -> FastAPI:
+    app = FastAPI()
+    fixtures = load_fixtures()
+    text_results = { sample["text"]: sample["result"] for sample in fixtures if "text" in sample }
+    photo_results = [sample["result"] for sample in fixtures if "photo" in sample] or [{ "is_tip": False }]
+    rng = random.Random(seed)
+    stats = Counter()
+
+    def text_result(text: str) -> dict:
+        return text_results.get(UNIQUE_SUFFIX_PATTERN.sub("", text), { "is_tip": False })
+
+    def image_result(data_url: str) -> dict:
+        digest = hashlib.sha256(data_url.encode("utf-8")).digest()
+        return photo_results[digest[0] % len(photo_results)]
+
+    def completion(content: str, prompt_tokens: int) -> dict:
+        completion_tokens = max(1, len(content) // 4)
+        return {
+            "id": f"chatcmpl-bench-{stats['openai_requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "bench",
+            "choices": [{ "index": 0, "message": { "role": "assistant", "content": content }, "finish_reason": "stop" }],
+            "usage": { "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens }
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["openai_requests"] += 1
+        await asyncio.sleep(max(0.0, openai_latency + rng.uniform(-openai_jitter, openai_jitter)))
+        if rng.random() < openai_error_rate:
+            stats["openai_errors"] += 1
+            return JSONResponse(status_code=500, content={ "error": { "message": "Injected failure", "type": "server_error" } })
+        user = body["messages"][-1]["content"]
+        prompt_tokens = sum(len(json.dumps(m["content"])) for m in body["messages"]) // 4
+        if isinstance(user, list):
+            stats["openai_image"] += 1
+            data_url = next(part["image_url"]["url"] for part in user if part.get("type") == "image_url")
+            return completion(json.dumps(image_result(data_url)), prompt_tokens)
+        try:
+            items = json.loads(user)
+        except ValueError:
+            items = None
+        if isinstance(items, list) and all(isinstance(item, dict) and "message_id" in item for item in items):
+            stats["openai_batch"] += 1
+            stats["openai_batched_messages"] += len(items)
+            results = [{ "message_id": item["message_id"], **text_result(item.get("text", "")) } for item in items]
+            return completion(json.dumps(results, ensure_ascii=False), prompt_tokens)
+        stats["openai_text"] += 1
+        return completion(f"```json\n{json.dumps(text_result(user), ensure_ascii=False)}\n```", prompt_tokens)
+
+    @app.post("/storage/v1/object/{bucket}/{path:path}")
+    async def storage_upload(bucket: str, path: str, request: Request):
+        body = await request.body()
+        await asyncio.sleep(storage_latency)
+        stats["storage_uploads"] += 1
+        stats["storage_bytes"] += len(body)
+        return { "Key": f"{bucket}/{path}" }
+
+    @app.api_route("/rest/v1/{table}", methods=["GET", "POST", "PATCH", "DELETE"])
+    async def rest_table(table: str, request: Request):
+        body = await request.body()
+        await asyncio.sleep(storage_latency)
+        stats[f"rest_{request.method.lower()}"] += 1
+        stats[f"rest_{table}"] += 1
+        rows = json.loads(body) if body else []
+        return JSONResponse(status_code=201 if request.method == "POST" else 200, content=rows if isinstance(rows, list) else [rows])
+
+    @app.get("/_stats")
+    async def get_stats():
+        return dict(stats)
+
+    @app.post("/_reset")
+    async def reset_stats():
+        stats.clear()
+        return { "success": True }
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI e Supabase falsos para o benchmark")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--openai-latency", type=float, default=0.4)
+    parser.add_argument("--openai-jitter", type=float, default=0.1)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--storage-latency", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    app = create_app(args.openai_latency, args.openai_jitter, args.openai_error_rate, args.storage_latency, args.seed)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
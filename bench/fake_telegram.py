@@ -0,0 +1,140 @@
+# Cliente Telegram falso para o benchmark: serve histórico sintético (textos e fotos das fixtures)
+# e passa pelo mesmo scheduler/safe_call do SafeTelegramClient. Importa main, por isso as variáveis
+# de ambiente do serviço têm de estar definidas antes (ver run_collect.py).
+import asyncio
+import io
+import random
+import types
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from PIL import Image, ImageDraw
+
+import main
+
+def render_photo(width: int, height: int, rng: random.Random) -> bytes:
+    img = Image.new("RGB", (width, height), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(20, width // 2), y0 + rng.randrange(10, height // 6)
+        draw.rectangle((x0, y0, x1, y1), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    for line in range(8):
+        draw.text((20, 20 + line * 24), f"{rng.random():.6f} @{rng.uniform(1.1, 5):.2f}", fill=(0, 0, 0))
+    output = io.BytesIO()
+    img.save(output, "JPEG", quality=90)
+    return output.getvalue()
+
+def build_channel(chat_id: str, fixtures: list[dict], count: int, photo_ratio: float, unique_texts: bool, seed: int) -> tuple[list, dict]:
+    rng = random.Random(f"{seed}:{chat_id}")
+    texts = [sample["text"] for sample in fixtures if "text" in sample]
+    photos = [sample["photo"] for sample in fixtures if "photo" in sample]
+    peer = types.SimpleNamespace(id=-1000000000000 - zlib.crc32(chat_id.encode("utf-8")), title=f"Bench {chat_id}", username=None)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    messages, media = [], {}
+    for message_id in range(count, 0, -1):
+        text, photo = None, None
+        if photos and rng.random() < photo_ratio:
+            spec = rng.choice(photos)
+            photo = types.SimpleNamespace(file_id=f"{chat_id}:{message_id}", file_unique_id=f"{chat_id}:{message_id}")
+            media[photo.file_id] = render_photo(spec["width"], spec["height"], rng)
+        else:
+            text = rng.choice(texts)
+            if unique_texts:
+                text = f"{text} [bench:{chat_id}:{message_id}]"
+        messages.append(types.SimpleNamespace(
+            id=message_id,
+            date=now - timedelta(minutes=count - message_id),
+            chat=peer,
+            text=text,
+            caption=None,
+            photo=photo,
+            video=None,
+            sticker=None,
+            empty=False
+        ))
+    return messages, media
+
+class FakeTelegramClient:
+    # safe_call é o do serviço: acquire no scheduler, tratamento de FloodWait e métricas
+    safe_call = main.SafeTelegramClient.safe_call
+
+    def __init__(self, rate_limits: dict, latency: float = 0.05, stale_rate: float = 0.0, seed: int = 0):
+        self.name = f"bench{seed}"
+        self.scheduler = main.TelegramScheduler(rate_limits)
+        self.latency = latency
+        self.stale_rate = stale_rate
+        self.rng = random.Random(seed)
+        self.channels = {}
+        self.media = {}
+        self.stale = set()
+        self.calls = Counter()
+
+    def add_channel(self, chat_id: str, messages: list, media: dict):
+        self.channels[str(chat_id)] = messages
+        self.media.update(media)
+        for msg in messages:
+            if msg.photo and self.rng.random() < self.stale_rate:
+                self.stale.add(msg.photo.file_id)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def add_handler(self, handler):
+        pass
+
+    async def get_me(self):
+        self.calls["get_me"] += 1
+        return types.SimpleNamespace(id=0, is_bot=False)
+
+    async def get_chat_history(self, chat_id, limit: int = 0, offset_id: int = 0, **kwargs):
+        self.calls["get_chat_history"] += 1
+        await asyncio.sleep(self.latency)
+        messages = [msg for msg in self.channels.get(str(chat_id), []) if not offset_id or msg.id < offset_id]
+        for msg in messages[:limit or None]:
+            yield msg
+
+    async def get_messages(self, chat_id, message_ids):
+        self.calls["get_messages"] += 1
+        await asyncio.sleep(self.latency)
+        ids = set(message_ids) if isinstance(message_ids, list) else { message_ids }
+        found = [msg for msg in self.channels.get(str(chat_id), []) if msg.id in ids]
+        # Uma mensagem pedida de novo traz uma file reference válida
+        for msg in found:
+            if msg.photo:
+                self.stale.discard(msg.photo.file_id)
+        return found if isinstance(message_ids, list) else (found[0] if found else None)
+
+    async def get_chat(self, chat_id):
+        self.calls["get_chat"] += 1
+        await asyncio.sleep(self.latency)
+        messages = self.channels.get(str(chat_id))
+        peer = messages[0].chat if messages else types.SimpleNamespace(id=-1, title=str(chat_id), username=None)
+        return types.SimpleNamespace(
+            id=peer.id, title=peer.title, username=peer.username, type="channel",
+            photo=None, members_count=0, description=None, invite_link=None
+        )
+
+    async def download_media(self, message, file_name: str = "downloads/", in_memory: bool = False, **kwargs):
+        self.calls["download_media"] += 1
+        await asyncio.sleep(self.latency)
+        file_id = message if isinstance(message, str) else message.photo.file_id
+        data = self.media.get(file_id)
+        # Como no Pyrogram, o get_file engole o FileReferenceExpired: o download em memória devolve um
+        # BytesIO vazio (nunca None) e o download para ficheiro devolve None
+        if data is None or file_id in self.stale:
+            self.calls["download_media_failed"] += 1
+            if not in_memory:
+                return None
+            data = b""
+        if in_memory:
+            buffer = io.BytesIO(data)
+            buffer.name = f"{file_id}.jpg"
+            return buffer
+        with open(file_name, "wb") as f:
+            f.write(data)
+        return file_name
@@ -0,0 +1,63 @@
+# Teste do refetch de fotos: com file references expiradas o Pyrogram não levanta erro nem devolve None,
+# devolve um BytesIO vazio. Cada foto tem de ser tratada como download falhado, pedida de novo num
+# get_messages em lote e descarregada com a referência nova.
+#
+#   python bench/refetch_check.py --photos 50
+#   python bench/refetch_check.py --photos 100 --stale-rate 0.5   # exit 1 se alguma foto falhar
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+from run_collect import configure_environment
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prova que fotos com file reference expirada são recuperadas por refetch")
+    parser.add_argument("--photos", type=int, default=20, help="Fotos no histórico do canal")
+    parser.add_argument("--stale-rate", type=float, default=1.0, help="Fração de fotos com file reference expirada")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+async def run_check(args) -> dict:
+    import main
+    from fake_backends import load_fixtures
+    from fake_telegram import FakeTelegramClient, build_channel
+
+    fake = FakeTelegramClient({ name: "1000:1000" for name in main.TELEGRAM_RATE_LIMITS }, latency=0.0, stale_rate=args.stale_rate, seed=args.seed)
+    chat_id = "refetch_check"
+    messages, media = build_channel(chat_id, load_fixtures(), args.photos, 1.0, True, args.seed)
+    fake.add_channel(chat_id, messages, media)
+    stale = len(fake.stale)
+    refetcher = main.MediaRefetcher(fake, chat_id)
+    buffers = await asyncio.gather(*(main.download_photo(fake, chat_id, msg, refetcher) for msg in messages))
+    await main.http_client.aclose()
+    return {
+        "photos": len(messages),
+        "stale": stale,
+        "recovered": sum(1 for buffer in buffers if buffer is not None and buffer.getbuffer().nbytes > 0),
+        "download_retries": main.media_stats["download_retries"],
+        "get_messages": fake.calls["get_messages"]
+    }
+
+if __name__ == "__main__":
+    args = parse_args()
+    state_dir = tempfile.mkdtemp(prefix="bench_")
+    configure_environment(args, 0, os.path.join(state_dir, "state.db"))
+    result = asyncio.run(run_check(args))
+    print(f"[Bench] 📊 {result['photos']} fotos, {result['stale']} com file reference expirada")
+    print(f"[Bench]   recuperadas: {result['recovered']}, retries: {result['download_retries']}, get_messages: {result['get_messages']}")
+    failures = []
+    if result["recovered"] != result["photos"]:
+        failures.append(f"{result['photos'] - result['recovered']} fotos ficaram sem imagem (buffer vazio tratado como sucesso?)")
+    if result["download_retries"] != result["stale"]:
+        failures.append(f"{result['download_retries']} retries para {result['stale']} fotos expiradas")
+    if result["stale"] and not result["get_messages"]:
+        failures.append("nenhum get_messages: o refetch não foi usado")
+    for failure in failures:
+        print(f"[Bench] ❌ {failure}")
+    if failures:
+        sys.exit(1)
+    print("[Bench] ✅ Fotos com file reference expirada recuperadas por refetch")
@@ -0,0 +1,278 @@
+# Benchmark offline do /collect-tips: Telegram, OpenAI e Supabase são substituídos por versões locais
+# (fake_telegram.py no processo, fake_backends.py num subprocesso), sem gastar quota real.
+# Mede mensagens/s, latência p50/p95 dos pedidos, tempo por estágio, memória máxima e chamadas a cada backend.
+#
+#   python bench/run_collect.py --requests 8 --concurrency 4 --channels 3 --messages 50
+#   python bench/run_collect.py --output baseline.json
+#   python bench/run_collect.py --baseline baseline.json --tolerance 0.15   # exit 1 se regredir
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+API_KEY = "bench"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark offline do /collect-tips")
+    parser.add_argument("--requests", type=int, default=4, help="Pedidos /collect-tips medidos")
+    parser.add_argument("--concurrency", type=int, default=2, help="Pedidos em simultâneo")
+    parser.add_argument("--channels", type=int, default=3, help="Canais por pedido")
+    parser.add_argument("--messages", type=int, default=50, help="Mensagens no histórico de cada canal")
+    parser.add_argument("--photo-ratio", type=float, default=0.3)
+    parser.add_argument("--repeat-texts", action="store_true", help="Não torna os textos únicos (exercita a cache)")
+    parser.add_argument("--mode", choices=["backfill", "incremental"], default="backfill")
+    parser.add_argument("--llm-batch-size", type=int, default=None)
+    parser.add_argument("--max-messages", type=int, default=None, help="Limite de mensagens por canal (por omissão o do serviço)")
+    parser.add_argument("--collect-concurrency", type=int, default=None, help="Canais em paralelo por pedido")
+    parser.add_argument("--warmup", type=int, default=1, help="Pedidos de aquecimento (não medidos)")
+    parser.add_argument("--sessions", type=int, default=1, help="Sessões Telegram falsas no pool")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--telegram-rate", default="1000:1000", help="rate:burst de todos os buckets; 'real' usa os do ambiente")
+    parser.add_argument("--stale-rate", type=float, default=0.0, help="Fração de fotos com file reference expirada")
+    parser.add_argument("--openai-latency", type=float, default=0.4)
+    parser.add_argument("--openai-jitter", type=float, default=0.1)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--storage-latency", type=float, default=0.05)
+    parser.add_argument("--tracemalloc", action="store_true", help="Mede o pico do heap Python (mais lento)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Grava o resultado em JSON")
+    parser.add_argument("--baseline", help="Resultado JSON anterior para comparar")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Regressão máxima aceite face ao baseline")
+    return parser.parse_args()
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_backends(args, port: int) -> subprocess.Popen:
+    return subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "fake_backends.py"),
+        "--port", str(port),
+        "--openai-latency", str(args.openai_latency),
+        "--openai-jitter", str(args.openai_jitter),
+        "--openai-error-rate", str(args.openai_error_rate),
+        "--storage-latency", str(args.storage_latency),
+        "--seed", str(args.seed)
+    ])
+
+# O serviço lê a configuração ao importar: tudo aponta para os backends locais
+def configure_environment(args, port: int, state_path: str):
+    backend_url = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "TELEGRAM_API_ID": "1",
+        "TELEGRAM_API_HASH": "bench",
+        "TELEGRAM_SESSION_STRING": "bench",
+        "TELEGRAM_SERVICE_API_KEY": API_KEY,
+        "SUPABASE_URL": backend_url,
+        "SUPABASE_KEY": "bench",
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{backend_url}/v1",
+        "STATE_BACKEND": "sqlite",
+        "STATE_SQLITE_PATH": state_path,
+        "CLASSIFICATION_CACHE_PERSIST": "0",
+        "LIVE_MODE": "0"
+    })
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+def histogram_summary(histogram) -> dict:
+    summary = {}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            label = next(iter(sample.labels.values()), "") if sample.labels else ""
+            if sample.name.endswith("_count"):
+                summary.setdefault(label, {})["count"] = int(sample.value)
+            elif sample.name.endswith("_sum"):
+                summary.setdefault(label, {})["seconds"] = round(sample.value, 3)
+    for values in summary.values():
+        values["mean"] = round(values["seconds"] / values["count"], 4) if values.get("count") else 0.0
+    return summary
+
+async def wait_for_backends(http, port: int, process: subprocess.Popen):
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError("fake_backends.py terminou ao arrancar")
+        try:
+            await http.get(f"http://127.0.0.1:{port}/_stats")
+            return
+        except Exception:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("fake_backends.py não respondeu")
+
+async def run_benchmark(args, port: int, backend_process: subprocess.Popen) -> dict:
+    import httpx
+    import main
+    from fake_backends import load_fixtures
+    from fake_telegram import FakeTelegramClient, build_channel
+
+    rate_limits = main.TELEGRAM_RATE_LIMITS if args.telegram_rate == "real" else { name: args.telegram_rate for name in main.TELEGRAM_RATE_LIMITS }
+    fakes = [
+        FakeTelegramClient(rate_limits, latency=args.telegram_latency, stale_rate=args.stale_rate, seed=args.seed + index)
+        for index in range(max(1, args.sessions))
+    ]
+    main.telegram_pool = main.TelegramPool(fakes)
+
+    fixtures = load_fixtures()
+    total_requests = args.warmup + args.requests
+    print(f"[Bench] 🏗️ A gerar {total_requests * args.channels} canais com {args.messages} mensagens")
+    payloads = []
+    for request_index in range(total_requests):
+        channels = []
+        for channel_index in range(args.channels):
+            chat_id = f"bench_{request_index}_{channel_index}"
+            channel = build_channel(chat_id, fixtures, args.messages, args.photo_ratio, not args.repeat_texts, args.seed)
+            for fake in fakes:
+                fake.add_channel(chat_id, *channel)
+            channels.append({ "chat_id": chat_id, "since": "2000-01-01T00:00:00Z" } if args.mode == "backfill" else { "chat_id": chat_id })
+        payload = { "channels": channels, "mode": args.mode }
+        if args.llm_batch_size:
+            payload["llm_batch_size"] = args.llm_batch_size
+        if args.max_messages:
+            payload["max_messages"] = args.max_messages
+        if args.collect_concurrency:
+            payload["concurrency"] = args.collect_concurrency
+        payloads.append(payload)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(timeout=30) as backend, httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as service:
+        await wait_for_backends(backend, port, backend_process)
+
+        async def send(payload: dict) -> dict:
+            started = time.perf_counter()
+            response = await service.post("/collect-tips", json=payload, headers={ "Authorization": f"Bearer {API_KEY}" })
+            elapsed = time.perf_counter() - started
+            body = response.json()
+            channels = body.get("channels", [])
+            return {
+                "status": response.status_code,
+                "latency": elapsed,
+                "tips": len(body.get("tips", [])),
+                "messages": sum(channel.get("messages", 0) for channel in channels),
+                "failed_messages": sum(len(channel.get("failed_message_ids", [])) for channel in channels),
+                "failed_channels": sum(1 for channel in channels if not channel.get("success"))
+            }
+
+        for payload in payloads[:args.warmup]:
+            await send(payload)
+        await backend.post(f"http://127.0.0.1:{port}/_reset")
+        for fake in fakes:
+            fake.calls.clear()
+        main.PIPELINE_STAGE_SECONDS.clear()
+        main.OPENAI_REQUEST_SECONDS.clear()
+        main.TELEGRAM_WAIT_SECONDS.clear()
+        main.TELEGRAM_REQUEST_SECONDS.clear()
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(payload: dict) -> dict:
+            async with semaphore:
+                return await send(payload)
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.perf_counter()
+        results = await asyncio.gather(*(limited(payload) for payload in payloads[args.warmup:]))
+        elapsed = time.perf_counter() - started
+        heap_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+        if args.tracemalloc:
+            tracemalloc.stop()
+        backend_calls = (await backend.get(f"http://127.0.0.1:{port}/_stats")).json()
+
+    await main.http_client.aclose()
+    await main.client.close()
+    latencies = [result["latency"] for result in results]
+    messages = sum(result["messages"] for result in results)
+    return {
+        "config": { key: value for key, value in vars(args).items() if key not in ("output", "baseline") },
+        "elapsed_seconds": round(elapsed, 3),
+        "requests": len(results),
+        "http_errors": sum(1 for result in results if result["status"] != 200),
+        "messages": messages,
+        "tips": sum(result["tips"] for result in results),
+        "failed_messages": sum(result["failed_messages"] for result in results),
+        "failed_channels": sum(result["failed_channels"] for result in results),
+        "messages_per_second": round(messages / elapsed, 2) if elapsed else 0.0,
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "latency_max": round(max(latencies, default=0.0), 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_rss_growth_mb": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024, 1),
+        "peak_heap_mb": round(heap_peak / 2**20, 1) if heap_peak is not None else None,
+        "calls": {
+            "telegram": dict(sum((fake.calls for fake in fakes), Counter())),
+            "backends": backend_calls
+        },
+        "stages": {
+            "pipeline": histogram_summary(main.PIPELINE_STAGE_SECONDS),
+            "openai": histogram_summary(main.OPENAI_REQUEST_SECONDS),
+            "telegram_wait": histogram_summary(main.TELEGRAM_WAIT_SECONDS),
+            "telegram_request": histogram_summary(main.TELEGRAM_REQUEST_SECONDS)
+        },
+        "classification_cache": main.classification_cache.snapshot()
+    }
+
+def print_report(result: dict):
+    print(f"[Bench] 📊 {result['requests']} pedidos, {result['messages']} mensagens, {result['tips']} tips em {result['elapsed_seconds']}s")
+    print(f"[Bench]   mensagens/s: {result['messages_per_second']}")
+    print(f"[Bench]   latência p50/p95/max: {result['latency_p50']}s / {result['latency_p95']}s / {result['latency_max']}s")
+    print(f"[Bench]   falhas: {result['http_errors']} pedidos, {result['failed_channels']} canais, {result['failed_messages']} mensagens")
+    heap = f", heap {result['peak_heap_mb']} MB" if result["peak_heap_mb"] is not None else ""
+    print(f"[Bench]   memória: RSS máx {result['peak_rss_mb']} MB (+{result['peak_rss_growth_mb']} MB){heap}")
+    print(f"[Bench]   chamadas Telegram: {result['calls']['telegram']}")
+    print(f"[Bench]   chamadas OpenAI/Supabase: {result['calls']['backends']}")
+    for group, stages in result["stages"].items():
+        for stage, values in stages.items():
+            print(f"[Bench]   {group}/{stage}: {values['count']}x, média {values['mean']}s, total {values['seconds']}s")
+
+# Mensagens/s mais baixas ou p95 mais alto do que o baseline (para lá da tolerância) contam como regressão
+def compare_with_baseline(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    if result["messages_per_second"] < baseline["messages_per_second"] * (1 - tolerance):
+        regressions.append(f"mensagens/s {result['messages_per_second']} < {baseline['messages_per_second']}")
+    if result["latency_p95"] > baseline["latency_p95"] * (1 + tolerance):
+        regressions.append(f"latência p95 {result['latency_p95']}s > {baseline['latency_p95']}s")
+    return regressions
+
+if __name__ == "__main__":
+    args = parse_args()
+    port = free_port()
+    state_dir = tempfile.mkdtemp(prefix="bench_")
+    configure_environment(args, port, os.path.join(state_dir, "state.db"))
+    backend_process = start_backends(args, port)
+    try:
+        result = asyncio.run(run_benchmark(args, port, backend_process))
+    finally:
+        backend_process.terminate()
+        backend_process.wait()
+    print_report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"[Bench] ✅ Resultado gravado em {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"[Bench] ❌ Regressão: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("[Bench] ✅ Sem regressões face ao baseline")
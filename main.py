@@ -1,21 +1,42 @@
 from fastapi import FastAPI, Request, Header, Body, HTTPException
-from fastapi.responses import JSONResponse
-from pyrogram import Client
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from pyrogram import Client, filters
+from pyrogram.handlers import MessageHandler
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
 from dateutil import parser
 import os
 import json
-import requests
+import logging
+import httpx
 import base64
+import io
 from datetime import datetime, timedelta, timezone
 from supabase import create_client
-from openai import OpenAI
-from PIL import Image
-from pyrogram.enums import MessageMediaType
+from openai import AsyncOpenAI
+from PIL import Image, ImageOps, ImageChops
+from pyrogram.enums import ChatType, MessageMediaType
 import asyncio
 import uuid
 import time
+import sqlite3
+import threading
+import hashlib
+import heapq
+import math
+import bisect
+import itertools
+from contextvars import ContextVar
+import re
+import copy
+from collections import Counter, OrderedDict, deque
+from typing import Literal, NamedTuple
 from pyrogram.errors import FloodWait
+from prometheus_client import Counter as MetricCounter, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+try:
+    import joblib
+except ImportError:
+    joblib = None
 
 app = FastAPI()
 
@@ -24,46 +45,540 @@ API_KEY = os.environ.get("TELEGRAM_SERVICE_API_KEY")
 API_ID = int(os.environ.get("TELEGRAM_API_ID"))
 API_HASH = os.environ.get("TELEGRAM_API_HASH")
 SESSION_STRING = os.environ.get("TELEGRAM_SESSION_STRING")
+# Pool de sessões: várias session strings separadas por vírgula (a primeira é a principal)
+SESSION_STRINGS = [s.strip() for s in os.environ.get("TELEGRAM_SESSION_STRINGS", "").split(",") if s.strip()] or [SESSION_STRING]
+TELEGRAM_POOL_REPLICAS = int(os.environ.get("TELEGRAM_POOL_REPLICAS", "64"))
+# Um canal passa para a sessão seguinte do anel se a sua estiver em pausa por FloodWait há mais do que isto (s)
+TELEGRAM_FAILOVER_WAIT = float(os.environ.get("TELEGRAM_FAILOVER_WAIT", "5"))
+TELEGRAM_HEALTH_INTERVAL = float(os.environ.get("TELEGRAM_HEALTH_INTERVAL", "60"))
+TELEGRAM_HEALTH_TIMEOUT = float(os.environ.get("TELEGRAM_HEALTH_TIMEOUT", "15"))
 
 SUPABASE_URL = os.environ["SUPABASE_URL"]
 SUPABASE_KEY = os.environ["SUPABASE_KEY"]
 SUPABASE_BUCKET = os.environ.get("SUPABASE_BUCKET", "telegram-tips")
 
+COLLECT_CONCURRENCY = int(os.environ.get("COLLECT_CONCURRENCY", "4"))
+COLLECT_MAX_CONCURRENCY = int(os.environ.get("COLLECT_MAX_CONCURRENCY", "16"))
+# Mensagens por pedido de histórico (o Telegram devolve no máximo 100) e limite de mensagens por canal
+# em backfill; a coleta incremental lê sempre até ao cursor, sem limite
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "100"))
+BACKFILL_MAX_MESSAGES = int(os.environ.get("BACKFILL_MAX_MESSAGES", "5000"))
+SCAN_CHECKPOINT_EVERY = int(os.environ.get("SCAN_CHECKPOINT_EVERY", "500"))
+# Taxa (pedidos/s) e burst por classe de método: "rate:burst"
+TELEGRAM_RATE_LIMITS = {
+    "history": os.environ.get("TELEGRAM_RATE_HISTORY", "1:3"),
+    "get_messages": os.environ.get("TELEGRAM_RATE_GET_MESSAGES", "2:5"),
+    "download": os.environ.get("TELEGRAM_RATE_DOWNLOAD", "3:6"),
+    "chat": os.environ.get("TELEGRAM_RATE_CHAT", "1:3"),
+    "default": os.environ.get("TELEGRAM_RATE_DEFAULT", "2:4")
+}
+TELEGRAM_RATE_RECOVERY = int(os.environ.get("TELEGRAM_RATE_RECOVERY", "50"))
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "30"))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "120"))
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", "4"))
+DOWNLOAD_CONCURRENCY = int(os.environ.get("DOWNLOAD_CONCURRENCY", "4"))
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", "4"))
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "8"))
+LLM_BATCH_SIZE = int(os.environ.get("LLM_BATCH_SIZE", "1"))
+LLM_BACKFILL_BATCH_SIZE = int(os.environ.get("LLM_BACKFILL_BATCH_SIZE", "8"))
+LLM_BATCH_MAX_CHARS = int(os.environ.get("LLM_BATCH_MAX_CHARS", "1500"))
+LLM_BATCH_MAX_WAIT = float(os.environ.get("LLM_BATCH_MAX_WAIT", "0.5"))
+CHANNEL_INFO_TTL = int(os.environ.get("CHANNEL_INFO_TTL", "3600"))
+CHANNEL_INFO_CACHE_SIZE = int(os.environ.get("CHANNEL_INFO_CACHE_SIZE", "2000"))
+CHANNEL_INFO_CONCURRENCY = int(os.environ.get("CHANNEL_INFO_CONCURRENCY", "8"))
+CHANNEL_INFO_MAX_IDS = int(os.environ.get("CHANNEL_INFO_MAX_IDS", "200"))
+MEDIA_REFETCH_MAX_WAIT = float(os.environ.get("MEDIA_REFETCH_MAX_WAIT", "0.2"))
+MEDIA_REFETCH_MAX_BATCH = int(os.environ.get("MEDIA_REFETCH_MAX_BATCH", "100"))
+COLLECT_JOB_WORKERS = int(os.environ.get("COLLECT_JOB_WORKERS", "2"))
+COLLECT_JOB_FETCHED_TTL = int(os.environ.get("COLLECT_JOB_FETCHED_TTL", "600"))
+COLLECT_JOB_UNFETCHED_TTL = int(os.environ.get("COLLECT_JOB_UNFETCHED_TTL", str(24 * 3600)))
+COLLECT_JOB_PRUNE_INTERVAL = float(os.environ.get("COLLECT_JOB_PRUNE_INTERVAL", "60"))
+# Fila partilhada entre réplicas: os jobs vão para a tabela collect_tasks e os processos com WORKER_MODE=1 consomem-na
+COLLECT_QUEUE = os.environ.get("COLLECT_QUEUE", "local")  # local | shared
+WORKER_MODE = os.environ.get("WORKER_MODE", "0") == "1"
+WORKER_ID = os.environ.get("WORKER_ID") or f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "4"))
+WORKER_LEASE_SECONDS = int(os.environ.get("WORKER_LEASE_SECONDS", "60"))
+WORKER_HEARTBEAT_INTERVAL = float(os.environ.get("WORKER_HEARTBEAT_INTERVAL", str(WORKER_LEASE_SECONDS / 3)))
+WORKER_POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", "2"))
+WORKER_MAX_ATTEMPTS = int(os.environ.get("WORKER_MAX_ATTEMPTS", "3"))
+
+LIVE_MODE = os.environ.get("LIVE_MODE", "0") == "1"
+LIVE_CHANNELS = [c.strip() for c in os.environ.get("LIVE_CHANNELS", "").split(",") if c.strip()]
+LIVE_SINKS = [s.strip() for s in os.environ.get("LIVE_SINK", "memory").split(",") if s.strip()]
+LIVE_QUEUE_SIZE = int(os.environ.get("LIVE_QUEUE_SIZE", "1000"))
+LIVE_WEBHOOK_URL = os.environ.get("LIVE_WEBHOOK_URL")
+LIVE_WEBHOOK_SECRET = os.environ.get("LIVE_WEBHOOK_SECRET")
+IMAGE_MAX_SIDE = int(os.environ.get("IMAGE_MAX_SIDE", "2048"))
+IMAGE_MAX_SHORT_SIDE = int(os.environ.get("IMAGE_MAX_SHORT_SIDE", "768"))
+IMAGE_JPEG_QUALITY = int(os.environ.get("IMAGE_JPEG_QUALITY", "85"))
+VISION_DETAIL = os.environ.get("VISION_DETAIL", "auto")
+PHASH_SIZE = int(os.environ.get("PHASH_SIZE", "16"))
+PHASH_MAX_DISTANCE = int(os.environ.get("PHASH_MAX_DISTANCE", "16"))
+PHASH_INDEX_SIZE = int(os.environ.get("PHASH_INDEX_SIZE", "500"))
+PHASH_VERIFY_SIZE = int(os.environ.get("PHASH_VERIFY_SIZE", "64"))
+PHASH_VERIFY_THRESHOLD = int(os.environ.get("PHASH_VERIFY_THRESHOLD", "12"))
+
+PREFILTER_MODE = os.environ.get("PREFILTER_MODE", "shadow")  # off | shadow | on
+PREFILTER_THRESHOLD = float(os.environ.get("PREFILTER_THRESHOLD", "0.2"))
+PREFILTER_MODEL_PATH = os.environ.get("PREFILTER_MODEL_PATH")
+PREFILTER_SAMPLES_PATH = os.environ.get("PREFILTER_SAMPLES_PATH")
+
+STRATEGY_CHUNK_SIZE = int(os.environ.get("STRATEGY_CHUNK_SIZE", "150"))
+STRATEGY_MAX_CHUNKS = int(os.environ.get("STRATEGY_MAX_CHUNKS", "12"))
+STRATEGY_TOP_N = int(os.environ.get("STRATEGY_TOP_N", "10"))
+STRATEGY_DRIFT_THRESHOLD = float(os.environ.get("STRATEGY_DRIFT_THRESHOLD", "0.1"))
+
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "supabase")
+STATE_SQLITE_PATH = os.environ.get("STATE_SQLITE_PATH", "state.db")
+CURSORS_TABLE = os.environ.get("CURSORS_TABLE", "channel_cursors")
+CLASSIFICATION_CACHE_TABLE = os.environ.get("CLASSIFICATION_CACHE_TABLE", "classification_cache")
+STRATEGY_PROFILES_TABLE = os.environ.get("STRATEGY_PROFILES_TABLE", "strategy_profiles")
+TIPS_TABLE = os.environ.get("TIPS_TABLE", "tips")
+TIP_ENTRIES_TABLE = os.environ.get("TIP_ENTRIES_TABLE", "tip_entries")
+COLLECT_TASKS_TABLE = os.environ.get("COLLECT_TASKS_TABLE", "collect_tasks")
+SCAN_CHECKPOINTS_TABLE = os.environ.get("SCAN_CHECKPOINTS_TABLE", "scan_checkpoints")
+FAILED_MESSAGES_TABLE = os.environ.get("FAILED_MESSAGES_TABLE", "failed_messages")
+
+PERSIST_TIPS = os.environ.get("PERSIST_TIPS", "0") == "1"
+TIPS_FLUSH_SIZE = int(os.environ.get("TIPS_FLUSH_SIZE", "100"))
+TIPS_WRITE_BATCH = int(os.environ.get("TIPS_WRITE_BATCH", "500"))
+TIPS_WRITE_RETRIES = int(os.environ.get("TIPS_WRITE_RETRIES", "3"))
+TIPS_WRITE_BACKOFF = float(os.environ.get("TIPS_WRITE_BACKOFF", "0.5"))
+
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o")
+# JSON mode (response_format json_object) nas análises; uma resposta inválida é pedida de novo só para essa mensagem
+OPENAI_JSON_MODE = os.environ.get("OPENAI_JSON_MODE", "1") == "1"
+OPENAI_PARSE_RETRIES = int(os.environ.get("OPENAI_PARSE_RETRIES", "1"))
+# Mensagens que falharam são guardadas e repetidas (só elas) nas coletas seguintes, até FAILED_RETRY_MAX_ATTEMPTS vezes
+FAILED_RETRY_MAX_ATTEMPTS = int(os.environ.get("FAILED_RETRY_MAX_ATTEMPTS", "3"))
+CLASSIFICATION_CACHE_SIZE = int(os.environ.get("CLASSIFICATION_CACHE_SIZE", "5000"))
+CLASSIFICATION_CACHE_TTL = int(os.environ.get("CLASSIFICATION_CACHE_TTL", str(7 * 24 * 3600)))
+CLASSIFICATION_CACHE_PERSIST = os.environ.get("CLASSIFICATION_CACHE_PERSIST", "0") == "1"
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # text | json
+
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), timeout=OPENAI_TIMEOUT)
+http_client = httpx.AsyncClient(
+    timeout=HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+)
+
+# --- Logging estruturado ---
+# log_event(nível, componente, mensagem, **campos): os campos vão como key=value (LOG_FORMAT=text)
+# ou como chaves do objeto JSON (LOG_FORMAT=json), uma linha por evento.
+class StructuredFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        component = getattr(record, "component", record.name)
+        fields = getattr(record, "fields", {})
+        if LOG_FORMAT == "json":
+            entry = {
+                "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                "level": record.levelname,
+                "component": component,
+                "msg": record.getMessage(),
+                **fields
+            }
+            if record.exc_info:
+                entry["exc_info"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = f"{self.formatTime(record)} {record.levelname:<7} [{component}] {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+logger = logging.getLogger("telegram_service")
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(StructuredFormatter())
+logger.addHandler(log_handler)
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+
+def log_event(level: int, component: str, message: str, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={ "component": component, "fields": fields })
+
+# --- Métricas (Prometheus, GET /metrics) ---
+# Latências por estágio do pipeline e por chamada externa, mais contadores de FloodWait,
+# resultado das mensagens, cache de classificações e tokens da OpenAI.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+PIPELINE_STAGE_SECONDS = Histogram(
+    "tips_pipeline_stage_seconds", "Duração de cada estágio do processamento de mensagens",
+    ["stage"], buckets=LATENCY_BUCKETS
+)
+TELEGRAM_REQUEST_SECONDS = Histogram(
+    "telegram_request_seconds", "Duração das chamadas à API do Telegram (sem espera no scheduler)",
+    ["method"], buckets=LATENCY_BUCKETS
+)
+TELEGRAM_WAIT_SECONDS = Histogram(
+    "telegram_scheduler_wait_seconds", "Tempo de espera no scheduler antes de cada chamada ao Telegram",
+    ["method"], buckets=LATENCY_BUCKETS
+)
+TELEGRAM_FLOODWAITS = MetricCounter("telegram_floodwaits_total", "FloodWaits recebidos", ["method"])
+TELEGRAM_FLOODWAIT_SECONDS = MetricCounter("telegram_floodwait_seconds_total", "Segundos de pausa pedidos por FloodWait", ["method"])
+TELEGRAM_SESSION_FAILOVERS = MetricCounter("telegram_session_failovers_total", "Canais atribuídos a outra sessão que não a do anel", ["reason"])
+OPENAI_REQUEST_SECONDS = Histogram(
+    "openai_request_seconds", "Duração dos pedidos à OpenAI",
+    ["kind"], buckets=LATENCY_BUCKETS
+)
+OPENAI_REQUESTS = MetricCounter("openai_requests_total", "Pedidos à OpenAI", ["kind", "outcome"])
+OPENAI_TOKENS = MetricCounter("openai_tokens_total", "Tokens reportados em result.usage", ["kind", "type"])
+QUEUE_TASKS = MetricCounter("collect_queue_tasks_total", "Tasks da fila partilhada tratadas por este worker", ["outcome"])
+OPENAI_PARSE_FAILURES = MetricCounter("openai_parse_failures_total", "Respostas do LLM inválidas (JSON ou schema)", ["kind", "outcome"])
+FAILED_MESSAGE_RETRIES = MetricCounter("failed_message_retries_total", "Mensagens falhadas repetidas em coletas seguintes", ["outcome"])
+MESSAGES_PROCESSED = MetricCounter("tips_messages_processed_total", "Mensagens processadas por resultado", ["source", "outcome"])
+CLASSIFICATION_CACHE_REQUESTS = MetricCounter("classification_cache_requests_total", "Consultas à cache de classificações", ["result"])
+PREFILTER_SKIPPED = MetricCounter("prefilter_skipped_total", "Textos descartados pelo pré-filtro sem chamar o LLM")
+TIPS_PERSISTED = MetricCounter("tips_persisted_total", "Tips gravadas (upsert) no state store")
+TIPS_PERSIST_FAILURES = MetricCounter("tips_persist_failures_total", "Tips que não foi possível gravar após as tentativas")
+UPLOAD_FAILURES = MetricCounter("supabase_upload_failures_total", "Tentativas de upload para o storage que falharam")
+
+# --- Scheduler central de chamadas ao Telegram ---
+# Cada classe de método tem um token bucket. Um FloodWait pausa todo o processo e reduz para metade
+# a taxa dessa classe; após TELEGRAM_RATE_RECOVERY sucessos seguidos a taxa volta a subir aos poucos (AIMD).
+# Pedidos interativos (endpoints de consulta) passam à frente da coleta em massa na mesma fila.
+# Limitação: os downloads só passam pelo token bucket. O Pyrogram trata o FloodWait dentro do get_file
+# (espera na sessão abaixo do sleep_threshold, regista e engole acima dele), por isso um FloodWait de
+# download nunca chega ao safe_call e não pausa o processo nem reduz a taxa; o download devolve um buffer
+# vazio, que não se distingue de uma file reference expirada e segue para o refetch (safe_download_media).
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+telegram_priority: ContextVar[int] = ContextVar("telegram_priority", default=PRIORITY_BULK)
+
+TELEGRAM_METHOD_CLASSES = {
+    "get_chat_history": "history",
+    "read_chat_history": "history",
+    "get_messages": "get_messages",
+    "download_media": "download",
+    "get_chat": "chat"
+}
+
+class TokenBucket:
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.waiters = []
+        self.condition = asyncio.Condition()
+        self.successes = 0
+        self.floods = 0
+        self.flood_seconds = 0.0
+        self.last_flood = None
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def on_success(self):
+        self.successes += 1
+        if self.successes >= TELEGRAM_RATE_RECOVERY and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1)
+            self.successes = 0
+
+    def on_flood(self, seconds: float):
+        self.floods += 1
+        self.flood_seconds += seconds
+        self.last_flood = seconds
+        self.successes = 0
+        self.rate = max(self.max_rate * 0.05, self.rate / 2)
+        self.tokens = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "rate": round(self.rate, 3),
+            "max_rate": self.max_rate,
+            "tokens": round(self.tokens, 2),
+            "waiting": len(self.waiters),
+            "floods": self.floods,
+            "flood_seconds": self.flood_seconds,
+            "last_flood": self.last_flood
+        }
+
+class TelegramScheduler:
+    def __init__(self, limits: dict):
+        self.buckets = {}
+        for name, spec in limits.items():
+            rate, _, burst = spec.partition(":")
+            self.buckets[name] = TokenBucket(name, float(rate), float(burst or rate))
+        self.paused_until = 0.0
+
+    def bucket_for(self, func) -> TokenBucket:
+        name = TELEGRAM_METHOD_CLASSES.get(getattr(func, "__name__", ""), "default")
+        return self.buckets.get(name) or self.buckets["default"]
+
+    def pause_remaining(self) -> float:
+        return max(0.0, self.paused_until - time.monotonic())
+
+    async def acquire(self, bucket: TokenBucket, priority: int):
+        ticket = [priority, next(scheduler_tickets)]
+        async with bucket.condition:
+            heapq.heappush(bucket.waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    bucket.refill(now)
+                    delay = self.paused_until - now
+                    if bucket.waiters[0] is ticket:
+                        if delay <= 0 and bucket.tokens >= 1:
+                            bucket.tokens -= 1
+                            return
+                        delay = max(delay, (1 - bucket.tokens) / bucket.rate)
+                    else:
+                        delay = None
+                    try:
+                        await asyncio.wait_for(bucket.condition.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                if ticket in bucket.waiters:
+                    bucket.waiters.remove(ticket)
+                    heapq.heapify(bucket.waiters)
+                bucket.condition.notify_all()
+
+    async def on_flood(self, bucket: TokenBucket, seconds: float):
+        bucket.on_flood(seconds)
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        for other in self.buckets.values():
+            async with other.condition:
+                other.condition.notify_all()
+
+    def snapshot(self) -> dict:
+        return {
+            "paused_for": round(self.pause_remaining(), 2),
+            "buckets": { name: bucket.snapshot() for name, bucket in self.buckets.items() }
+        }
+
+scheduler_tickets = itertools.count()
 
 # --- SafeTelegramClient com tratamento de FloodWait ---
+# Todas as chamadas à API passam por safe_call e, portanto, pelo scheduler (nos downloads só o token
+# bucket se aplica: ver a limitação acima).
 class SafeTelegramClient(Client):
+    def __init__(self, *args, rate_limits: dict = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = TelegramScheduler(rate_limits or TELEGRAM_RATE_LIMITS)
+
     async def safe_call(self, func, *args, **kwargs):
+        bucket = self.scheduler.bucket_for(func)
         while True:
+            with TELEGRAM_WAIT_SECONDS.labels(bucket.name).time():
+                await self.scheduler.acquire(bucket, telegram_priority.get())
             try:
-                return await func(*args, **kwargs)
+                with TELEGRAM_REQUEST_SECONDS.labels(bucket.name).time():
+                    result = await func(*args, **kwargs)
+                bucket.on_success()
+                return result
             except FloodWait as e:
-                print(f"[SafeTelegramClient] 🕒 FloodWait: esperando {e.value} segundos...")
-                await asyncio.sleep(e.value)
-
-telegram_client = SafeTelegramClient(
-    name=None,  # ou só remove completamente
-    api_id=API_ID,
-    api_hash=API_HASH,
-    session_string=SESSION_STRING,
-    no_updates=True
-)
+                TELEGRAM_FLOODWAITS.labels(bucket.name).inc()
+                TELEGRAM_FLOODWAIT_SECONDS.labels(bucket.name).inc(e.value)
+                log_event(logging.WARNING, "SafeTelegramClient", "🕒 FloodWait: pausa da sessão", session=self.name, method=bucket.name, seconds=e.value, rate=round(bucket.rate, 2))
+                await self.scheduler.on_flood(bucket, e.value)
+
+# --- Pool de sessões Telegram ---
+# Cada sessão (conta) tem o seu cliente e o seu scheduler, porque os limites de FloodWait são por conta.
+# Os canais são atribuídos por consistent hashing (TELEGRAM_POOL_REPLICAS nós virtuais por sessão):
+# o mesmo canal fica sempre na mesma sessão e acrescentar uma sessão só move ~1/N dos canais.
+# Um canal inteiro é lido pela mesma sessão (file references e access hashes são da conta), por isso
+# o failover acontece na atribuição: se a sessão do canal está em pausa por FloodWait há mais de
+# TELEGRAM_FAILOVER_WAIT segundos ou falhou o health check, usa-se a seguinte no anel.
+# Todas as contas têm de ter acesso aos canais. Só a sessão principal arranca no startup (e recebe
+# updates no modo live); as outras arrancam na primeira atribuição.
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+class TelegramSession:
+    def __init__(self, index: int, client):
+        self.index = index
+        self.client = client
+        self.started = False
+        self.healthy = True
+        self.error = None
+        self.checked_at = None
+        self.assigned = 0
+        self.start_lock = asyncio.Lock()
+
+    async def ensure_started(self):
+        if self.started:
+            return
+        async with self.start_lock:
+            if self.started:
+                return
+            try:
+                await self.client.start()
+            except Exception as e:
+                self.mark_unhealthy(e)
+                raise
+            self.started = True
+            self.healthy = True
+            self.error = None
+            log_event(logging.INFO, "TelegramPool", "✅ Sessão iniciada", session=self.index)
+
+    def mark_unhealthy(self, error: Exception):
+        self.healthy = False
+        self.error = str(error)
+        log_event(logging.WARNING, "TelegramPool", "⚠️ Sessão indisponível", session=self.index, error=str(error))
+
+    def pause_remaining(self) -> float:
+        return self.client.scheduler.pause_remaining()
+
+    def snapshot(self) -> dict:
+        return {
+            "session": self.index,
+            "started": self.started,
+            "healthy": self.healthy,
+            "error": self.error,
+            "checked_at": self.checked_at,
+            "assigned": self.assigned,
+            "scheduler": self.client.scheduler.snapshot()
+        }
+
+class TelegramPool:
+    def __init__(self, clients: list, replicas: int = TELEGRAM_POOL_REPLICAS):
+        self.sessions = [TelegramSession(index, client) for index, client in enumerate(clients)]
+        self.ring = sorted((ring_hash(f"{session.index}:{replica}"), session.index) for session in self.sessions for replica in range(max(1, replicas)))
+        self.ring_keys = [point for point, _ in self.ring]
+        self.health_task = None
+
+    @property
+    def primary(self):
+        return self.sessions[0].client
+
+    # Sessões pela ordem do anel a partir do hash do canal (a primeira é a "dona" do canal)
+    def ring_order(self, key: str) -> list[TelegramSession]:
+        order = []
+        start = bisect.bisect(self.ring_keys, ring_hash(str(key)))
+        for offset in range(len(self.ring)):
+            session = self.sessions[self.ring[(start + offset) % len(self.ring)][1]]
+            if session not in order:
+                order.append(session)
+                if len(order) == len(self.sessions):
+                    break
+        return order
+
+    # Preferência: sessões saudáveis sem pausa longa pela ordem do anel; depois as em pausa (menor
+    # pausa primeiro); por fim as que falharam o health check, para que um pool todo em baixo ainda tente.
+    def candidates(self, key: str) -> list[TelegramSession]:
+        order = self.ring_order(key)
+        ready = [s for s in order if s.healthy and s.pause_remaining() <= TELEGRAM_FAILOVER_WAIT]
+        paused = sorted((s for s in order if s.healthy and s not in ready), key=lambda s: s.pause_remaining())
+        return ready + paused + [s for s in order if not s.healthy]
+
+    async def client_for(self, key):
+        owner = self.ring_order(key)[0]
+        last_error = None
+        for session in self.candidates(key):
+            try:
+                await session.ensure_started()
+            except Exception as e:
+                last_error = e
+                continue
+            if session is not owner:
+                reason = "unhealthy" if not owner.healthy else "floodwait"
+                TELEGRAM_SESSION_FAILOVERS.labels(reason).inc()
+                log_event(logging.DEBUG, "TelegramPool", "🔀 Failover de canal", chat_id=key, owner=owner.index, session=session.index, reason=reason)
+            session.assigned += 1
+            return session.client
+        raise last_error
+
+    async def check_health(self):
+        for session in self.sessions:
+            # Uma sessão em FloodWait está viva; não se gasta um pedido para o confirmar
+            if session.started and session.pause_remaining() > 0:
+                continue
+            try:
+                if session.started:
+                    await asyncio.wait_for(session.client.safe_call(session.client.get_me), TELEGRAM_HEALTH_TIMEOUT)
+                    if not session.healthy:
+                        log_event(logging.INFO, "TelegramPool", "✅ Sessão recuperada", session=session.index)
+                    session.healthy = True
+                    session.error = None
+                elif not session.healthy:
+                    await session.ensure_started()
+            except Exception as e:
+                if session.healthy:
+                    session.mark_unhealthy(e)
+                session.error = str(e)
+            session.checked_at = datetime.now(timezone.utc).isoformat()
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(TELEGRAM_HEALTH_INTERVAL)
+            try:
+                await self.check_health()
+            except Exception as e:
+                log_event(logging.ERROR, "TelegramPool", "❌ Health check falhou", error=str(e))
+
+    async def start(self):
+        await self.sessions[0].ensure_started()
+        if TELEGRAM_HEALTH_INTERVAL > 0:
+            self.health_task = asyncio.create_task(self.health_loop())
+
+    async def stop(self):
+        if self.health_task:
+            self.health_task.cancel()
+            await asyncio.gather(self.health_task, return_exceptions=True)
+        for session in self.sessions:
+            if session.started:
+                await session.client.stop()
+                session.started = False
+
+    def snapshot(self) -> dict:
+        return {
+            "size": len(self.sessions),
+            "healthy": sum(1 for s in self.sessions if s.healthy),
+            "sessions": [session.snapshot() for session in self.sessions]
+        }
+
+telegram_pool = TelegramPool([
+    SafeTelegramClient(
+        name=f"session{index}",
+        api_id=API_ID,
+        api_hash=API_HASH,
+        session_string=session_string,
+        # Só a sessão principal recebe updates (modo live)
+        no_updates=index > 0 or not LIVE_MODE
+    )
+    for index, session_string in enumerate(SESSION_STRINGS)
+])
 
 @app.on_event("startup")
 async def startup_event():
-    await telegram_client.start()
-    print("✅ Telegram client started")
+    await telegram_pool.start()
+    log_event(logging.INFO, "Startup", "✅ Telegram client started", sessions=len(telegram_pool.sessions))
+    start_collect_job_workers()
+    if WORKER_MODE:
+        start_queue_workers()
+    if LIVE_MODE:
+        await start_live_mode()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    await telegram_client.stop()
-    print("🛑 Telegram client stopped")
+    await stop_collect_job_workers()
+    await stop_queue_workers()
+    await prefilter.close()
+    await telegram_pool.stop()
+    await http_client.aclose()
+    await client.close()
+    log_event(logging.INFO, "Shutdown", "🛑 Telegram client stopped")
 
 # --- LOG ---
+# O payload completo só aparece com LOG_LEVEL=DEBUG; em INFO regista-se apenas o tamanho
 def log_request(request: Request, payload: dict):
-    print(f"[Request] {request.method} {request.url}")
-    print(f"[Payload] {payload}")
+    channels = payload.get("channels") or payload.get("chat_ids") or payload.get("tips")
+    log_event(
+        logging.INFO, "Request", f"{request.method} {request.url.path}",
+        chat_id=payload.get("chat_id"), items=len(channels) if isinstance(channels, list) else None
+    )
+    log_event(logging.DEBUG, "Request", "Payload", payload=payload)
 
 # --- AUTH ---
 def is_authorized(auth_header: str) -> bool:
@@ -87,50 +602,622 @@ class CollectTipsRequest(BaseModel):
 
 class AnalyzeStrategyRequest(BaseModel):
     tips: list[dict]
+    chat_id: str | None = None
+    force: bool = False
 
 # --- FloodWait-safe wrappers ---
-async def safe_get_chat_history(app, chat_id, limit=100):
-    try:
-        messages = []
-        async for msg in app.get_chat_history(chat_id, limit=limit):
-            messages.append(msg)
-        return messages
-    except FloodWait as e:
-        print(f"[FloodWait] ⏳ Esperando {e.value} segundos (get_chat_history)...")
-        await asyncio.sleep(e.value)
-        messages = []
-        async for msg in app.get_chat_history(chat_id, limit=limit):
-            messages.append(msg)
-        return messages
+async def read_chat_history(app, chat_id, **kwargs):
+    return [msg async for msg in app.get_chat_history(chat_id, **kwargs)]
+
+async def safe_get_chat_history(app, chat_id, limit=100, offset_id=0):
+    return await app.safe_call(read_chat_history, app, chat_id, limit=limit, offset_id=offset_id)
+
+# Histórico em streaming, da mensagem mais recente para a mais antiga: uma página de cada vez
+# (até 100 mensagens, um único pedido ao Telegram), por isso a memória não depende da profundidade
+# e um FloodWait só repete a página em curso, a partir do último id já entregue.
+# Pára na primeira mensagem com id <= min_id ou anterior a 'since', ou ao fim de max_messages.
+# Se 'stop' for um dict, stop["reason"] fica com o motivo: "min_id", "since", "limit" ou "end".
+async def iter_chat_history(app, chat_id, page_size=HISTORY_PAGE_SIZE, offset_id=0, min_id=0, since=None, max_messages=None, stop: dict = None):
+    page_size = max(1, min(page_size, 100))
+    stop = stop if stop is not None else {}
+    stop["reason"] = "limit"
+    yielded = 0
+    while max_messages is None or yielded < max_messages:
+        limit = page_size if max_messages is None else min(page_size, max_messages - yielded)
+        log_event(logging.DEBUG, "Collect", "🔄 Fetching messages", chat_id=chat_id, limit=limit, offset_id=offset_id)
+        with PIPELINE_STAGE_SECONDS.labels("fetch").time():
+            messages = await safe_get_chat_history(app, chat_id, limit=limit, offset_id=offset_id)
+        for msg in messages:
+            if msg.id <= min_id:
+                stop["reason"] = "min_id"
+                return
+            if since and msg.date.replace(tzinfo=timezone.utc) < since:
+                stop["reason"] = "since"
+                return
+            offset_id = msg.id
+            yield msg
+            yielded += 1
+        if len(messages) < limit:
+            stop["reason"] = "end"
+            return
         
+# --- Estado persistente (cursores, cache de classificações, perfis de estratégia, tips) ---
+# Supabase em produção; SQLite local para desenvolvimento e testes (STATE_BACKEND=sqlite).
+# Tabelas esperadas no Supabase:
+#   channel_cursors(chat_id text primary key, last_message_id bigint, updated_at timestamptz)
+#   classification_cache(cache_key text primary key, result jsonb, created_at timestamptz)
+#   strategy_profiles(chat_id text primary key, profile jsonb, updated_at timestamptz)
+#   tips(chat_id text, message_id bigint, date timestamptz, type text, odd numeric, text text, image_url text,
+#        tip jsonb, updated_at timestamptz, primary key (chat_id, message_id))
+#   tip_entries(chat_id text, message_id bigint, entry_index int, match text, tournament text, datetime text,
+#               market text, outcome text, individual_odd numeric, primary key (chat_id, message_id, entry_index))
+#   collect_tasks(task_id text primary key, job_id text, chat_id text, channel jsonb, options jsonb, status text,
+#                 worker_id text, lease_until timestamptz, attempts int default 0, report jsonb, error text,
+#                 created_at timestamptz, updated_at timestamptz)
+#   scan_checkpoints(chat_id text primary key, checkpoint jsonb, updated_at timestamptz)
+#   failed_messages(chat_id text, message_id bigint, attempts int, error text, updated_at timestamptz,
+#                   primary key (chat_id, message_id))
+#   + função claim_collect_task(p_worker_id text, p_lease_seconds int, p_max_attempts int) returns setof collect_tasks:
+#     sob pg_advisory_xact_lock, marca como failed as leases expiradas sem tentativas restantes e dá lease à task
+#     mais antiga em fila (ou com lease expirada) cujo canal não tem outra lease ativa, incrementando attempts.
+#     A tabela collect_tasks e a função estão em sql/collect_tasks.sql (migração obrigatória para a fila partilhada).
+# Os métodos são síncronos e devem ser chamados via asyncio.to_thread.
+class SupabaseStateStore:
+    def __init__(self, client):
+        self.client = client
+
+    def get_cursor(self, chat_id) -> int | None:
+        rows = self.client.table(CURSORS_TABLE).select("last_message_id").eq("chat_id", str(chat_id)).limit(1).execute().data
+        return rows[0]["last_message_id"] if rows else None
+
+    # Só avança, como o MAX do SQLite: cada escrita é condicional, por isso a coleta e o handler ao vivo
+    # podem gravar em simultâneo sem que o cursor recue.
+    def set_cursor(self, chat_id, message_id: int):
+        values = { "last_message_id": message_id, "updated_at": datetime.now(timezone.utc).isoformat() }
+
+        def advance() -> bool:
+            rows = (
+                self.client.table(CURSORS_TABLE).update(values)
+                .eq("chat_id", str(chat_id)).lt("last_message_id", message_id).execute().data
+            )
+            return bool(rows)
+
+        if advance():
+            return
+        # Sem linha ainda: insere. Se outra escrita a criou entretanto, o insert é ignorado e o update repete-se.
+        inserted = self.client.table(CURSORS_TABLE).upsert(
+            { "chat_id": str(chat_id), **values }, on_conflict="chat_id", ignore_duplicates=True
+        ).execute().data
+        if not inserted:
+            advance()
+
+    def get_classification(self, cache_key: str, max_age: int) -> dict | None:
+        min_created_at = (datetime.now(timezone.utc) - timedelta(seconds=max_age)).isoformat()
+        rows = (
+            self.client.table(CLASSIFICATION_CACHE_TABLE).select("result")
+            .eq("cache_key", cache_key).gte("created_at", min_created_at).limit(1).execute().data
+        )
+        return rows[0]["result"] if rows else None
+
+    def set_classification(self, cache_key: str, result: dict):
+        self.client.table(CLASSIFICATION_CACHE_TABLE).upsert({
+            "cache_key": cache_key,
+            "result": result,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }, on_conflict="cache_key").execute()
+
+    def get_strategy_profile(self, chat_id) -> dict | None:
+        rows = self.client.table(STRATEGY_PROFILES_TABLE).select("profile").eq("chat_id", str(chat_id)).limit(1).execute().data
+        return rows[0]["profile"] if rows else None
+
+    def set_strategy_profile(self, chat_id, profile: dict):
+        self.client.table(STRATEGY_PROFILES_TABLE).upsert({
+            "chat_id": str(chat_id),
+            "profile": profile,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }, on_conflict="chat_id").execute()
+
+    def upsert_tips(self, tip_rows: list[dict], entry_rows: list[dict]):
+        for start in range(0, len(tip_rows), TIPS_WRITE_BATCH):
+            self.client.table(TIPS_TABLE).upsert(
+                tip_rows[start:start + TIPS_WRITE_BATCH], on_conflict="chat_id,message_id", returning="minimal"
+            ).execute()
+        for start in range(0, len(entry_rows), TIPS_WRITE_BATCH):
+            self.client.table(TIP_ENTRIES_TABLE).upsert(
+                entry_rows[start:start + TIPS_WRITE_BATCH], on_conflict="chat_id,message_id,entry_index", returning="minimal"
+            ).execute()
+        # Um pedido por (canal, número de entradas): as tips de um lote têm quase sempre poucas contagens distintas
+        groups = {}
+        for (chat_id, message_id), count in entry_counts(tip_rows, entry_rows).items():
+            groups.setdefault((chat_id, count), []).append(message_id)
+        for (chat_id, count), message_ids in groups.items():
+            for start in range(0, len(message_ids), TIPS_WRITE_BATCH):
+                (
+                    self.client.table(TIP_ENTRIES_TABLE).delete(returning="minimal")
+                    .eq("chat_id", chat_id).in_("message_id", message_ids[start:start + TIPS_WRITE_BATCH])
+                    .gte("entry_index", count).execute()
+                )
+
+    def get_scan_checkpoint(self, chat_id) -> dict | None:
+        rows = self.client.table(SCAN_CHECKPOINTS_TABLE).select("checkpoint").eq("chat_id", str(chat_id)).limit(1).execute().data
+        return rows[0]["checkpoint"] if rows else None
+
+    def set_scan_checkpoint(self, chat_id, checkpoint: dict):
+        self.client.table(SCAN_CHECKPOINTS_TABLE).upsert({
+            "chat_id": str(chat_id),
+            "checkpoint": checkpoint,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }, on_conflict="chat_id").execute()
+
+    def delete_scan_checkpoint(self, chat_id):
+        self.client.table(SCAN_CHECKPOINTS_TABLE).delete().eq("chat_id", str(chat_id)).execute()
+
+    def get_failed_messages(self, chat_id, max_attempts: int) -> dict[int, int]:
+        rows = (
+            self.client.table(FAILED_MESSAGES_TABLE).select("message_id,attempts")
+            .eq("chat_id", str(chat_id)).lt("attempts", max_attempts).execute().data
+        )
+        return { row["message_id"]: row["attempts"] for row in rows }
+
+    def get_failed_attempts(self, chat_id, message_ids: list[int]) -> dict[int, int]:
+        rows = (
+            self.client.table(FAILED_MESSAGES_TABLE).select("message_id,attempts")
+            .eq("chat_id", str(chat_id)).in_("message_id", message_ids).execute().data
+        )
+        return { row["message_id"]: row["attempts"] for row in rows }
+
+    def record_failed_messages(self, chat_id, failures: list[dict]):
+        now = datetime.now(timezone.utc).isoformat()
+        self.client.table(FAILED_MESSAGES_TABLE).upsert(
+            [{ "chat_id": str(chat_id), **failure, "updated_at": now } for failure in failures],
+            on_conflict="chat_id,message_id", returning="minimal"
+        ).execute()
+
+    def delete_failed_messages(self, chat_id, message_ids: list[int]):
+        self.client.table(FAILED_MESSAGES_TABLE).delete().eq("chat_id", str(chat_id)).in_("message_id", message_ids).execute()
+
+    def enqueue_tasks(self, tasks: list[dict]):
+        self.client.table(COLLECT_TASKS_TABLE).insert(tasks, returning="minimal").execute()
+
+    def claim_task(self, worker_id: str, lease_seconds: int, max_attempts: int) -> dict | None:
+        rows = self.client.rpc("claim_collect_task", {
+            "p_worker_id": worker_id,
+            "p_lease_seconds": lease_seconds,
+            "p_max_attempts": max_attempts
+        }).execute().data
+        return rows[0] if rows else None
+
+    def renew_task(self, task_id: str, worker_id: str, lease_seconds: int) -> bool:
+        now = datetime.now(timezone.utc)
+        rows = (
+            self.client.table(COLLECT_TASKS_TABLE)
+            .update({ "lease_until": (now + timedelta(seconds=lease_seconds)).isoformat(), "updated_at": now.isoformat() })
+            .eq("task_id", task_id).eq("worker_id", worker_id).eq("status", "leased").execute().data
+        )
+        return bool(rows)
+
+    def finish_task(self, task_id: str, worker_id: str, status: str, report: dict = None, error: str = None) -> bool:
+        values = { "status": status, "report": report, "error": error, "updated_at": datetime.now(timezone.utc).isoformat() }
+        rows = (
+            self.client.table(COLLECT_TASKS_TABLE).update(values)
+            .eq("task_id", task_id).eq("worker_id", worker_id).eq("status", "leased").execute().data
+        )
+        return bool(rows)
+
+    # Devolve a task à fila; attempts é o valor a gravar (a lease é do worker, mais ninguém o altera)
+    def release_task(self, task_id: str, worker_id: str, attempts: int) -> bool:
+        rows = (
+            self.client.table(COLLECT_TASKS_TABLE)
+            .update({ "status": "queued", "worker_id": None, "lease_until": None, "attempts": attempts, "updated_at": datetime.now(timezone.utc).isoformat() })
+            .eq("task_id", task_id).eq("worker_id", worker_id).eq("status", "leased").execute().data
+        )
+        return bool(rows)
+
+    def get_job_tasks(self, job_id: str) -> list[dict]:
+        return self.client.table(COLLECT_TASKS_TABLE).select("*").eq("job_id", job_id).order("created_at").execute().data
+
+    def cancel_job_tasks(self, job_id: str) -> int:
+        rows = (
+            self.client.table(COLLECT_TASKS_TABLE)
+            .update({ "status": "cancelled", "updated_at": datetime.now(timezone.utc).isoformat() })
+            .eq("job_id", job_id).eq("status", "queued").execute().data
+        )
+        return len(rows)
+
+class SQLiteStateStore:
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {CURSORS_TABLE} ("
+                "chat_id TEXT PRIMARY KEY, last_message_id INTEGER NOT NULL, updated_at TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {CLASSIFICATION_CACHE_TABLE} ("
+                "cache_key TEXT PRIMARY KEY, result TEXT NOT NULL, created_at TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {STRATEGY_PROFILES_TABLE} ("
+                "chat_id TEXT PRIMARY KEY, profile TEXT NOT NULL, updated_at TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {TIPS_TABLE} ("
+                "chat_id TEXT NOT NULL, message_id INTEGER NOT NULL, date TEXT, type TEXT, odd REAL, text TEXT, "
+                "image_url TEXT, tip TEXT NOT NULL, updated_at TEXT NOT NULL, PRIMARY KEY (chat_id, message_id))"
+            )
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {TIP_ENTRIES_TABLE} ("
+                "chat_id TEXT NOT NULL, message_id INTEGER NOT NULL, entry_index INTEGER NOT NULL, match TEXT, "
+                "tournament TEXT, datetime TEXT, market TEXT, outcome TEXT, individual_odd REAL, "
+                "PRIMARY KEY (chat_id, message_id, entry_index))"
+            )
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {SCAN_CHECKPOINTS_TABLE} ("
+                "chat_id TEXT PRIMARY KEY, checkpoint TEXT NOT NULL, updated_at TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {FAILED_MESSAGES_TABLE} ("
+                "chat_id TEXT NOT NULL, message_id INTEGER NOT NULL, attempts INTEGER NOT NULL, error TEXT, "
+                "updated_at TEXT NOT NULL, PRIMARY KEY (chat_id, message_id))"
+            )
+            # lease_until em epoch (segundos), para comparar sem depender do formato das datas
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {COLLECT_TASKS_TABLE} ("
+                "task_id TEXT PRIMARY KEY, job_id TEXT NOT NULL, chat_id TEXT NOT NULL, channel TEXT NOT NULL, "
+                "options TEXT NOT NULL, status TEXT NOT NULL, worker_id TEXT, lease_until REAL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, report TEXT, error TEXT, created_at TEXT NOT NULL, updated_at TEXT NOT NULL)"
+            )
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {COLLECT_TASKS_TABLE}_status ON {COLLECT_TASKS_TABLE} (status, created_at)")
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {COLLECT_TASKS_TABLE}_job ON {COLLECT_TASKS_TABLE} (job_id)")
+
+    def get_cursor(self, chat_id) -> int | None:
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT last_message_id FROM {CURSORS_TABLE} WHERE chat_id = ?", (str(chat_id),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, chat_id, message_id: int):
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT INTO {CURSORS_TABLE} (chat_id, last_message_id, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET "
+                "last_message_id = MAX(last_message_id, excluded.last_message_id), updated_at = excluded.updated_at",
+                (str(chat_id), message_id, datetime.now(timezone.utc).isoformat())
+            )
+
+    def get_classification(self, cache_key: str, max_age: int) -> dict | None:
+        min_created_at = (datetime.now(timezone.utc) - timedelta(seconds=max_age)).isoformat()
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT result FROM {CLASSIFICATION_CACHE_TABLE} WHERE cache_key = ? AND created_at >= ?",
+                (cache_key, min_created_at)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_classification(self, cache_key: str, result: dict):
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {CLASSIFICATION_CACHE_TABLE} (cache_key, result, created_at) VALUES (?, ?, ?)",
+                (cache_key, json.dumps(result), datetime.now(timezone.utc).isoformat())
+            )
+
+    def get_strategy_profile(self, chat_id) -> dict | None:
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT profile FROM {STRATEGY_PROFILES_TABLE} WHERE chat_id = ?", (str(chat_id),)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_strategy_profile(self, chat_id, profile: dict):
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {STRATEGY_PROFILES_TABLE} (chat_id, profile, updated_at) VALUES (?, ?, ?)",
+                (str(chat_id), json.dumps(profile), datetime.now(timezone.utc).isoformat())
+            )
+
+    def upsert_tips(self, tip_rows: list[dict], entry_rows: list[dict]):
+        tip_columns = ("chat_id", "message_id", "date", "type", "odd", "text", "image_url", "tip", "updated_at")
+        entry_columns = ("chat_id", "message_id", "entry_index", "match", "tournament", "datetime", "market", "outcome", "individual_odd")
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {TIPS_TABLE} ({', '.join(tip_columns)}) VALUES ({', '.join('?' * len(tip_columns))})",
+                [tuple(json.dumps(row[c]) if c == "tip" else row[c] for c in tip_columns) for row in tip_rows]
+            )
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {TIP_ENTRIES_TABLE} ({', '.join(entry_columns)}) VALUES ({', '.join('?' * len(entry_columns))})",
+                [tuple(row[c] for c in entry_columns) for row in entry_rows]
+            )
+            self.conn.executemany(
+                f"DELETE FROM {TIP_ENTRIES_TABLE} WHERE chat_id = ? AND message_id = ? AND entry_index >= ?",
+                [(chat_id, message_id, count) for (chat_id, message_id), count in entry_counts(tip_rows, entry_rows).items()]
+            )
+
+    def get_scan_checkpoint(self, chat_id) -> dict | None:
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT checkpoint FROM {SCAN_CHECKPOINTS_TABLE} WHERE chat_id = ?", (str(chat_id),)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_scan_checkpoint(self, chat_id, checkpoint: dict):
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {SCAN_CHECKPOINTS_TABLE} (chat_id, checkpoint, updated_at) VALUES (?, ?, ?)",
+                (str(chat_id), json.dumps(checkpoint), datetime.now(timezone.utc).isoformat())
+            )
+
+    def delete_scan_checkpoint(self, chat_id):
+        with self.lock, self.conn:
+            self.conn.execute(f"DELETE FROM {SCAN_CHECKPOINTS_TABLE} WHERE chat_id = ?", (str(chat_id),))
+
+    def get_failed_messages(self, chat_id, max_attempts: int) -> dict[int, int]:
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT message_id, attempts FROM {FAILED_MESSAGES_TABLE} WHERE chat_id = ? AND attempts < ?",
+                (str(chat_id), max_attempts)
+            ).fetchall()
+        return dict(rows)
+
+    def get_failed_attempts(self, chat_id, message_ids: list[int]) -> dict[int, int]:
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT message_id, attempts FROM {FAILED_MESSAGES_TABLE} WHERE chat_id = ? "
+                f"AND message_id IN ({', '.join('?' * len(message_ids))})",
+                (str(chat_id), *message_ids)
+            ).fetchall()
+        return dict(rows)
+
+    def record_failed_messages(self, chat_id, failures: list[dict]):
+        now = datetime.now(timezone.utc).isoformat()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {FAILED_MESSAGES_TABLE} (chat_id, message_id, attempts, error, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(str(chat_id), f["message_id"], f["attempts"], f.get("error"), now) for f in failures]
+            )
+
+    def delete_failed_messages(self, chat_id, message_ids: list[int]):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"DELETE FROM {FAILED_MESSAGES_TABLE} WHERE chat_id = ? AND message_id = ?",
+                [(str(chat_id), message_id) for message_id in message_ids]
+            )
+
+    def fetch_tasks(self, cursor: sqlite3.Cursor) -> list[dict]:
+        columns = [column[0] for column in cursor.description]
+        return [self.task_from_row(dict(zip(columns, row))) for row in cursor.fetchall()]
+
+    def task_from_row(self, task: dict) -> dict:
+        for column in ("channel", "options", "report"):
+            task[column] = json.loads(task[column]) if task[column] else None
+        if task["lease_until"]:
+            task["lease_until"] = datetime.fromtimestamp(task["lease_until"], timezone.utc).isoformat()
+        return task
+
+    def enqueue_tasks(self, tasks: list[dict]):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT INTO {COLLECT_TASKS_TABLE} (task_id, job_id, chat_id, channel, options, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (t["task_id"], t["job_id"], t["chat_id"], json.dumps(t["channel"]), json.dumps(t["options"]), t["status"], t["created_at"], t["updated_at"])
+                    for t in tasks
+                ]
+            )
+
+    # BEGIN IMMEDIATE toma o lock de escrita do ficheiro: vários processos podem partilhar a mesma base
+    def claim_task(self, worker_id: str, lease_seconds: int, max_attempts: int) -> dict | None:
+        now = time.time()
+        updated_at = datetime.now(timezone.utc).isoformat()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    f"UPDATE {COLLECT_TASKS_TABLE} SET status = 'failed', error = 'Lease expired after ' || attempts || ' attempts', "
+                    "updated_at = ? WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+                    (updated_at, now, max_attempts)
+                )
+                row = self.conn.execute(
+                    f"SELECT task_id FROM {COLLECT_TASKS_TABLE} t "
+                    "WHERE (status = 'queued' OR (status = 'leased' AND lease_until < ?)) "
+                    f"AND NOT EXISTS (SELECT 1 FROM {COLLECT_TASKS_TABLE} o WHERE o.chat_id = t.chat_id "
+                    "AND o.status = 'leased' AND o.lease_until >= ? AND o.task_id != t.task_id) "
+                    "ORDER BY created_at LIMIT 1",
+                    (now, now)
+                ).fetchone()
+                task = None
+                if row:
+                    self.conn.execute(
+                        f"UPDATE {COLLECT_TASKS_TABLE} SET status = 'leased', worker_id = ?, lease_until = ?, "
+                        "attempts = attempts + 1, updated_at = ? WHERE task_id = ?",
+                        (worker_id, now + lease_seconds, updated_at, row[0])
+                    )
+                    task = self.fetch_tasks(self.conn.execute(
+                        f"SELECT * FROM {COLLECT_TASKS_TABLE} WHERE task_id = ?", (row[0],)
+                    ))[0]
+                self.conn.commit()
+                return task
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def renew_task(self, task_id: str, worker_id: str, lease_seconds: int) -> bool:
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE {COLLECT_TASKS_TABLE} SET lease_until = ?, updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND status = 'leased'",
+                (time.time() + lease_seconds, datetime.now(timezone.utc).isoformat(), task_id, worker_id)
+            )
+        return cursor.rowcount > 0
+
+    def finish_task(self, task_id: str, worker_id: str, status: str, report: dict = None, error: str = None) -> bool:
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE {COLLECT_TASKS_TABLE} SET status = ?, report = ?, error = ?, updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND status = 'leased'",
+                (status, json.dumps(report) if report else None, error, datetime.now(timezone.utc).isoformat(), task_id, worker_id)
+            )
+        return cursor.rowcount > 0
+
+    def release_task(self, task_id: str, worker_id: str, attempts: int) -> bool:
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE {COLLECT_TASKS_TABLE} SET status = 'queued', worker_id = NULL, lease_until = NULL, attempts = ?, updated_at = ? "
+                "WHERE task_id = ? AND worker_id = ? AND status = 'leased'",
+                (attempts, datetime.now(timezone.utc).isoformat(), task_id, worker_id)
+            )
+        return cursor.rowcount > 0
+
+    def get_job_tasks(self, job_id: str) -> list[dict]:
+        with self.lock:
+            return self.fetch_tasks(self.conn.execute(
+                f"SELECT * FROM {COLLECT_TASKS_TABLE} WHERE job_id = ? ORDER BY created_at", (job_id,)
+            ))
+
+    def cancel_job_tasks(self, job_id: str) -> int:
+        with self.lock, self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE {COLLECT_TASKS_TABLE} SET status = 'cancelled', updated_at = ? WHERE job_id = ? AND status = 'queued'",
+                (datetime.now(timezone.utc).isoformat(), job_id)
+            )
+        return cursor.rowcount
+
+def create_state_store():
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStore(STATE_SQLITE_PATH)
+    return SupabaseStateStore(supabase)
+
+state_store = create_state_store()
+
 # --- Supabase Upload ---
-def upload_image_to_supabase(file_path: str, identifier: str, retries: int = 2, delay: int = 2) -> str:
+# O cliente de storage do Supabase é síncrono: a conversão e o upload correm numa thread
+# para não bloquear o event loop. As imagens são tratadas em memória (um único decode/encode).
+def open_rgb_image(source) -> Image.Image:
+    with Image.open(source) as img:
+        img.load()
+        return ImageOps.exif_transpose(img).convert("RGB")
+
+# O JPEG é gravado sem EXIF/ICC, o que remove os metadados da imagem original
+def save_jpeg(img: Image.Image) -> bytes:
+    output = io.BytesIO()
+    img.save(output, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+def encode_image_jpeg(source) -> bytes:
+    rgb_img = open_rgb_image(source)
+    rgb_img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    return save_jpeg(rgb_img)
+
+def storage_public_url(file_name: str) -> str:
+    return f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{file_name}"
+
+# Com file_name fixo o objeto é substituído (upsert); sem ele o nome leva timestamp
+def upload_jpeg_bytes(image_bytes: bytes, identifier: str, file_name: str = None) -> str:
+    options = {"content-type": "image/jpeg"}
+    if file_name:
+        options["upsert"] = "true"
+    else:
+        file_name = f"avatars/{identifier}_{datetime.utcnow().isoformat()}.jpeg"
+    supabase.storage.from_(SUPABASE_BUCKET).upload(file_name, image_bytes, options)
+    return storage_public_url(file_name)
+
+async def upload_image_bytes_to_supabase(image_bytes: bytes, identifier: str, retries: int = 2, delay: int = 2, file_name: str = None) -> str:
     for attempt in range(retries + 1):
         try:
-            if not file_path or not os.path.exists(file_path):
-                print("[Upload] ❌ Caminho inválido:", file_path)
-                return None
-            converted_path = f"/tmp/{uuid.uuid4().hex}.jpeg"
-            with Image.open(file_path) as img:
-                img.verify()
-            with Image.open(file_path) as img:
-                rgb_img = img.convert("RGB")
-                rgb_img.save(converted_path, "JPEG")
-            file_name = f"avatars/{identifier}_{datetime.utcnow().isoformat()}.jpeg"
-            with open(converted_path, "rb") as f:
-                supabase.storage.from_(SUPABASE_BUCKET).upload(file_name, f, {"content-type": "image/jpeg"})
-            final_url = f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{file_name}"
-            os.remove(file_path) if os.path.exists(file_path) else None
-            os.remove(converted_path) if os.path.exists(converted_path) else None
-            return final_url
+            with PIPELINE_STAGE_SECONDS.labels("upload").time():
+                return await asyncio.to_thread(upload_jpeg_bytes, image_bytes, identifier, file_name)
         except Exception as e:
-            print(f"[Upload] ❌ Tentativa {attempt + 1} falhou:", str(e))
+            UPLOAD_FAILURES.inc()
+            log_event(logging.WARNING, "Upload", "❌ Tentativa de upload falhou", identifier=identifier, attempt=attempt + 1, error=str(e))
             if attempt < retries:
-                time.sleep(delay)
+                await asyncio.sleep(delay)
             else:
-                print("[Upload] ❌ Todas as tentativas de upload falharam.")
+                log_event(logging.ERROR, "Upload", "❌ Todas as tentativas de upload falharam", identifier=identifier)
                 return None
 
+# --- Pré-processamento de imagens para o modelo de visão ---
+# Com detail "high" o modelo reduz a imagem para caber em 2048x2048 e depois o lado menor para 768;
+# enviamos já nesse tamanho. Imagens que cabem em 512x512 vão com detail "low" (custo fixo).
+class PreparedImage(NamedTuple):
+    data: bytes
+    width: int
+    height: int
+    detail: str
+    phash: int
+    signature: bytes
+    sha256: str
+
+def fit_for_vision(width: int, height: int) -> tuple[int, int]:
+    scale = min(1.0, IMAGE_MAX_SIDE / max(width, height), IMAGE_MAX_SHORT_SIDE / max(1, min(width, height)))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def choose_vision_detail(width: int, height: int) -> str:
+    if VISION_DETAIL in ("low", "high"):
+        return VISION_DETAIL
+    return "low" if width <= 512 and height <= 512 else "high"
+
+# dHash: compara pixels adjacentes numa miniatura em tons de cinza; resiste a recompressão e redimensionamento
+def compute_dhash(img: Image.Image, hash_size: int = PHASH_SIZE) -> int:
+    pixels = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS).tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+# Miniatura em tons de cinza usada para confirmar quase-duplicados. O dHash sozinho não distingue
+# dois boletins do mesmo layout com odds diferentes; a comparação da miniatura sim.
+# Tamanho fixo (PHASH_VERIFY_SIZE² bytes, 4 KB por omissão) para o índice ter memória limitada.
+def compute_signature(img: Image.Image) -> bytes:
+    return img.convert("L").resize((PHASH_VERIFY_SIZE, PHASH_VERIFY_SIZE), Image.Resampling.BOX).tobytes()
+
+def signature_image(signature: bytes) -> Image.Image:
+    return Image.frombytes("L", (PHASH_VERIFY_SIZE, PHASH_VERIFY_SIZE), signature)
+
+def preprocess_image(source) -> PreparedImage:
+    rgb_img = open_rgb_image(source)
+    phash = compute_dhash(rgb_img)
+    signature = compute_signature(rgb_img)
+    width, height = fit_for_vision(*rgb_img.size)
+    if (width, height) != rgb_img.size:
+        rgb_img = rgb_img.resize((width, height), Image.Resampling.LANCZOS)
+    data = save_jpeg(rgb_img)
+    return PreparedImage(data, width, height, choose_vision_detail(width, height), phash, signature, hashlib.sha256(data).hexdigest())
+
+# Índice das imagens recentes: o dHash seleciona candidatos e a miniatura confirma.
+# Uma imagem quase idêntica a outra já vista reutiliza a identidade (e a entrada da cache) da primeira.
+class PerceptualHashIndex:
+    def __init__(self, max_size: int, max_distance: int, verify_threshold: int):
+        self.entries = deque(maxlen=max_size)
+        self.max_distance = max_distance
+        self.verify_threshold = verify_threshold
+        self.near_duplicates = 0
+
+    # A miniatura é quadrada, por isso a proporção da imagem é comparada à parte
+    @staticmethod
+    def aspect(image: PreparedImage) -> int:
+        return round(image.height * PHASH_VERIFY_SIZE / max(1, image.width))
+
+    def is_near_duplicate(self, image: PreparedImage, phash: int, aspect: int, signature: bytes) -> bool:
+        if (phash ^ image.phash).bit_count() > self.max_distance or aspect != self.aspect(image):
+            return False
+        difference = ImageChops.difference(signature_image(signature), signature_image(image.signature))
+        return difference.getextrema()[1] <= self.verify_threshold
+
+    def canonical(self, image: PreparedImage) -> str:
+        for phash, aspect, signature, identity in self.entries:
+            if identity == image.sha256:
+                return identity
+            if self.is_near_duplicate(image, phash, aspect, signature):
+                self.near_duplicates += 1
+                return identity
+        self.entries.appendleft((image.phash, self.aspect(image), image.signature, image.sha256))
+        return image.sha256
+
+image_hash_index = PerceptualHashIndex(PHASH_INDEX_SIZE, PHASH_MAX_DISTANCE, PHASH_VERIFY_THRESHOLD)
+
 # --- OpenAI Prompt ---
 def get_tip_prompt():
     return """
@@ -165,15 +1252,34 @@ Caso não consigas obter o Tournment do jogo e a data/hora do jogo, procura na i
 As tips são normalmente para jogos próximos. 
 """
 
+def get_batch_tip_prompt():
+    return get_tip_prompt() + """
+Vais receber várias mensagens num array JSON, cada uma com "message_id" e "text".
+Analisa cada mensagem de forma independente, com as regras acima.
+Devolve apenas um objeto JSON com a chave "results": um array com um objeto por mensagem, pela mesma ordem,
+cada um com o "message_id" da mensagem original e os restantes campos do formato acima. Exemplo:
+```json
+{
+  "results": [
+    { "message_id": 101, "is_tip": false },
+    { "message_id": 102, "is_tip": true, "type": "single", "odd": 1.85, "tip_entries": [ ... ] }
+  ]
+}
+```
+"""
+
 def get_strategy_prompt():
     return """
-A tua tarefa é analisar uma lista de apostas (tips) e identificar a estratégia do tipster.
+A tua tarefa é identificar a estratégia de um tipster a partir do resumo do seu histórico de apostas (tips).
 
-Cada tip contém:
-- `date`: data e hora em que foi publicada a tip
-- `tip_entries[]`: apostas feitas, com data e hora do jogo (`datetime`)
+Vais receber um JSON com:
+- `aggregates`: estatísticas calculadas sobre todas as tips (mercados, ligas, distribuição de odds,
+  tipos de aposta, momento das apostas face ao início do jogo, horas e dias de publicação)
+- `partial_summaries`: observações extraídas de lotes de tips (pode estar vazio)
+- `sample_tips`: algumas tips em formato compacto (pode estar vazio)
 
-Podes aferir que uma tip foi colocada em live quando a data da tip é dentro do horário do jogo
+O momento das apostas já vem calculado em `aggregates.timing` ("Live" = publicada depois do início do jogo).
+Baseia-te nas percentagens dos agregados; as observações servem para padrões que os números não mostram.
 
 Devolve o seguinte JSON:
 {
@@ -193,284 +1299,2030 @@ Devolve o seguinte JSON:
 Só devolve os momentos que se aplicam (não precisa todos). Usa sempre JSON válido.
 """
 
-# --- OpenAI Analysis ---
-def analyze_message_with_openai_text(text: str) -> dict:
-    if not text:
-        return { "is_tip": False }
-    try:
-        result = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                { "role": "system", "content": get_tip_prompt() },
-                { "role": "user", "content": text }
-            ],
-            temperature=0.0
-        )
-        content = result.choices[0].message.content.strip()
-        cleaned = content.strip()
-        if cleaned.startswith("```json"):
-            cleaned = cleaned.removeprefix("```json").strip()
-        if cleaned.endswith("```"):
-            cleaned = cleaned.removesuffix("```").strip()
-        if not cleaned:
-            return { "is_tip": False, "error": "Empty response from OpenAI" }
-        if not cleaned.startswith("{") and not cleaned.startswith("["):
-            print(f"[Text Analysis] ⚠️ OpenAI returned invalid format:\n{cleaned}")
-            return {
-                "is_tip": False,
-                "error": "Invalid JSON format",
-                "raw_content": cleaned,
-                "json_error": True
-            }
-        try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError as e:
-            print(f"[Text Analysis] ❌ JSONDecodeError: {str(e)}")
-            return {
-                "is_tip": False,
-                "error": str(e),
-                "raw_content": cleaned,
-                "json_error": True
-            }
-    except Exception as e:
-        print("[Text Analysis] ❌ Unexpected error:", str(e))
-        return { "is_tip": False, "error": str(e) }
+def get_strategy_chunk_prompt():
+    return """
+Vais receber um lote de apostas (tips) de um tipster, uma por linha, no formato:
+data de publicação | tipo @odd total | jogo; mercado; seleção; @odd; torneio; momento || (próxima entrada)
 
-def analyze_message_with_openai_image(image_url: str) -> dict:
-    try:
-        print(f"[Image Analysis] 🖼️ Downloading image from URL: {image_url}")
-        response = requests.get(image_url)
-        if not response.ok:
-            print(f"[Image Analysis] ❌ Failed to fetch image ({response.status_code}) from {image_url}")
-            return { "is_tip": False, "error": "Failed to download image" }
-        image_bytes = response.content
-        if not image_bytes:
-            print(f"[Image Analysis] ❌ Image content is empty.")
-            return { "is_tip": False, "error": "Empty image content" }
-        image_base64 = base64.b64encode(image_bytes).decode("utf-8")
-        data_url = f"data:image/jpeg;base64,{image_base64}"
-        print(f"[Image Analysis] ✅ Image downloaded and encoded (size: {len(image_base64)} chars)")
-        result = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                { "role": "system", "content": get_tip_prompt() },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": { "url": data_url }
-                        }
-                    ]
-                }
-            ],
-            temperature=0.0
-        )
-        content = result.choices[0].message.content.strip()
-        print(f"[Image Analysis] ⚠️ OpenAI response content: {repr(content)}")
-        cleaned = content.strip()
-        if cleaned.startswith("```json"):
-            cleaned = cleaned.removeprefix("```json").strip()
-        if cleaned.endswith("```"):
-            cleaned = cleaned.removesuffix("```").strip()
-        if not cleaned:
-            return { "is_tip": False, "error": "Empty response from OpenAI" }
-        if not cleaned.startswith("{") and not cleaned.startswith("["):
-            print(f"[Image Analysis] ⚠️ OpenAI returned invalid format:\n{cleaned}")
-            return {
-                "is_tip": False,
-                "error": "Invalid JSON format",
-                "raw_content": cleaned,
-                "json_error": True
-            }
-        try:
-            return json.loads(cleaned)
-        except json.JSONDecodeError as e:
-            print(f"[Image Analysis] ❌ JSONDecodeError: {str(e)}")
-            return {
-                "is_tip": False,
-                "error": str(e),
-                "raw_content": cleaned,
-                "json_error": True
-            }
-    except Exception as e:
-        print(f"[Image Analysis] ❌ Unexpected Exception: {str(e)}")
-        return { "is_tip": False, "error": str(e) }
+Resume os padrões deste lote em no máximo 5 observações curtas (mercados, ligas, faixas de odds,
+múltiplas vs simples, momento das apostas, gestão de stake, sequências ou mudanças de comportamento).
+Devolve apenas JSON válido:
+```json
+{ "observations": ["...", "..."] }
+```
+"""
 
-async def safe_download_media(app, media, file_name=None):
-    try:
-        return await app.download_media(media, file_name=file_name)
-    except FloodWait as e:
-        print(f"[FloodWait] ⏳ Esperando {e.value} segundos (download_media)...")
-        await asyncio.sleep(e.value)
-        return await app.download_media(media, file_name=file_name)
-    except Exception as e:
-        print(f"[safe_download_media] ❌ Erro inesperado no download: {e}")
-        return None
-        
-# --- Processar mensagem com validações robustas ---
-async def process_message(msg, chat_id, pyro):
-    print(f"\n[Process] 📩 Message ID: {msg.id} | Date: {msg.date.isoformat()} | Has text: {bool(msg.text)} | Has photo: {bool(msg.photo)}")
-    tip_data = None
+# --- Pré-filtro local de texto ---
+# Pontuação barata (0 a 1) de quão provável é um texto ser uma tip, antes de chamar o LLM.
+# Heurísticas por omissão; com PREFILTER_MODEL_PATH usa um modelo scikit-learn (predict_proba)
+# treinado com train_prefilter.py a partir das amostras gravadas em modo shadow.
+#   off: não faz nada | shadow: só regista a concordância com o LLM | on: salta textos abaixo do threshold
+ODDS_PATTERN = re.compile(r"(?<![\d.,/:])@?\s?([1-9]\d?[.,]\d{1,3})(?![\d%/:])")
+MATCH_PATTERN = re.compile(r"\w[\w .'&-]{1,40}?\s+(?:vs\.?|v\.?|x|×|-)\s+\w", re.IGNORECASE)
+MARKET_PATTERN = re.compile(
+    r"\b(?:over|under|mais de|menos de|btts|ambas marcam|ambas equipas marcam|handicap|1x2|"
+    r"dupla hip[oó]tese|double chance|resultado final|golos?|gols?|goals?|cantos|corners|cart[oõ]es|cards|"
+    r"vit[oó]ria|empate|draw|moneyline|ml|dnb|draw no bet|asian|total|marcador|scorer|odds?)\b",
+    re.IGNORECASE
+)
+STAKE_PATTERN = re.compile(r"\b(?:stake|unidades?|units?|\d+(?:[.,]\d+)?\s?u)\b", re.IGNORECASE)
+PROMO_PATTERN = re.compile(
+    r"\b(?:promo\w*|b[oó]nus|c[oó]digo|registo|regista|cadastr\w*|vip|grupo|subscre\w*|desconto|sorteio)\b",
+    re.IGNORECASE
+)
+RESULT_PATTERN = re.compile(r"\b(?:green|red|greens|reds|void|anulad[ao])\b|✅|❌", re.IGNORECASE)
+URL_PATTERN = re.compile(r"(?:https?://|t\.me/)\S+", re.IGNORECASE)
 
-    if msg.text:
-        print(f"[Process] 🧠 Analisando texto da mensagem {msg.id}")
-        tip_data = analyze_message_with_openai_text(msg.text)
-        print(f"[Process] ✅ Resultado texto: {tip_data}")
+def heuristic_tip_score(text: str) -> float:
+    without_urls = URL_PATTERN.sub(" ", text).strip()
+    if len(without_urls) < 8:
+        return 0.0
+    odds = [float(value.replace(",", ".")) for value in ODDS_PATTERN.findall(without_urls)]
+    has_odds = any(1.01 <= value <= 50 for value in odds)
+    score = 0.0
+    if has_odds:
+        score += 0.5
+    if MATCH_PATTERN.search(without_urls):
+        score += 0.25
+    score += min(0.3, 0.15 * len(MARKET_PATTERN.findall(without_urls)))
+    if STAKE_PATTERN.search(without_urls):
+        score += 0.1
+    if not has_odds:
+        if PROMO_PATTERN.search(without_urls):
+            score -= 0.3
+        if RESULT_PATTERN.search(without_urls):
+            score -= 0.2
+    return max(0.0, min(1.0, score))
 
-    elif msg.photo:
-        print(f"[Process] 🧠 A mensagem {msg.id} tem imagem. Verificando detalhes...")
-        print(f"[DEBUG] msg.photo.file_id={getattr(msg.photo, 'file_id', '❌ sem file_id')}")
+class TipPrefilter:
+    def __init__(self, mode: str, threshold: float, model_path: str = None, samples_path: str = None):
+        self.mode = mode
+        self.threshold = threshold
+        self.samples_path = samples_path
+        self.model = self.load_model(model_path)
+        self.pending_samples = []
+        self.samples_task = None
+        self.stats = { "scored": 0, "skipped": 0, "true_positives": 0, "false_positives": 0, "true_negatives": 0, "false_negatives": 0 }
 
+    def load_model(self, model_path: str):
+        if not model_path:
+            return None
+        if joblib is None:
+            log_event(logging.WARNING, "Prefilter", "⚠️ joblib não instalado; a usar só heurísticas")
+            return None
         try:
-            # Recupera a mensagem completa por ID antes de baixar a media
-            msg_full = await pyro.get_messages(chat_id, msg.id)
-
-            if not msg_full.photo:
-                print(f"[DEBUG] msg_full.photo está vazio mesmo após get_messages! ID: {msg.id}")
-                return None
-                
-            file_path = await pyro.download_media(msg_full)
-
-            if file_path is None:
-                print(f"[Process] ❌ Falha no download da imagem da mensagem {msg.id} — file_path é None")
-                print(f"[DEBUG] type(file_path): {type(file_path)}")
-                print(f"[DEBUG] repr(file_path): {repr(file_path)}")
-                print(f"[DEBUG] msg.photo: {msg.photo}")
-                return None
-            
-            if not os.path.exists(file_path):
-                print(f"[Process] ❌ Caminho {file_path} não existe após download.")
-                return None
-            
-            print(f"[Process] ✅ Imagem da mensagem {msg.id} salva em {file_path}")
-            image_url = upload_image_to_supabase(file_path, f"{chat_id}_{msg.id}")
-            if not image_url:
-                print(f"[Process] ❌ Upload falhou para imagem da mensagem {msg.id}")
-                return None
-
-            print(f"[Process] ✅ Imagem da mensagem {msg.id} disponível em {image_url}")
-            tip_data = analyze_message_with_openai_image(image_url)
-            print(f"[Process] ✅ Resultado imagem: {tip_data}")
+            return joblib.load(model_path)
         except Exception as e:
-            print(f"[Process] ❌ Erro ao processar imagem da mensagem {msg.id}: {e}")
+            log_event(logging.WARNING, "Prefilter", "⚠️ Não foi possível carregar o modelo", model_path=model_path, error=str(e))
             return None
 
-    else:
-        print(f"[Process] ℹ️ Mensagem {msg.id} não tem texto nem imagem suportada")
-
-    if tip_data and tip_data.get("is_tip"):
-        tip_data["chat_id"] = chat_id
-        tip_data["message_id"] = msg.id
-        tip_data["date"] = msg.date.isoformat()
-
-        # Adiciona o texto da mensagem, se houver
-        if msg.text:
-            tip_data["text"] = msg.text
+    def score(self, text: str) -> float:
+        self.stats["scored"] += 1
+        if self.model is not None:
+            try:
+                return float(self.model.predict_proba([text])[0][1])
+            except Exception as e:
+                log_event(logging.WARNING, "Prefilter", "⚠️ Erro no modelo, a usar heurísticas", error=str(e))
+        return heuristic_tip_score(text)
 
-        # Se foi imagem e tiver URL, adiciona como image_url
-        if msg.photo and 'image_url' in locals():
-            tip_data["image_url"] = image_url
-            if msg.caption:
-                tip_data["text"] = msg.caption
-        
-        print(f"[Process] ✅ Tip válida detectada na mensagem {msg.id}")
-        return tip_data
+    def should_skip(self, score: float) -> bool:
+        if self.mode == "on" and score < self.threshold:
+            self.stats["skipped"] += 1
+            PREFILTER_SKIPPED.inc()
+            return True
+        return False
 
-    print(f"[Process] ⛔️ Mensagem {msg.id} não é uma tip")
-    return None
+    def record(self, text: str, score: float, tip_data: dict):
+        if self.mode == "off" or not tip_data or tip_data.get("error"):
+            return
+        predicted = score >= self.threshold
+        actual = bool(tip_data.get("is_tip"))
+        outcome = f"{'true' if predicted == actual else 'false'}_{'positives' if predicted else 'negatives'}"
+        self.stats[outcome] += 1
+        if outcome == "false_negatives":
+            log_event(logging.WARNING, "Prefilter", "⚠️ Tip abaixo do threshold", score=round(score, 2), threshold=self.threshold, text=repr(text[:80]))
+        if self.samples_path:
+            self.pending_samples.append(json.dumps({ "text": text, "score": score, "is_tip": actual }, ensure_ascii=False) + "\n")
+            if self.samples_task is None or self.samples_task.done():
+                self.samples_task = asyncio.ensure_future(self.flush_samples())
 
-def analyze_tipster_strategy_with_openai(tips: list[dict]) -> dict:
-    try:
-        messages = [
-            { "role": "system", "content": get_strategy_prompt() },
-            { "role": "user", "content": json.dumps(tips) }
-        ]
-
-        result = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.3
-        )
+    # As amostras são gravadas em background, em lotes, fora do event loop
+    async def flush_samples(self):
+        while self.pending_samples:
+            lines, self.pending_samples = self.pending_samples, []
+            try:
+                await asyncio.to_thread(self.write_samples, lines)
+            except Exception as e:
+                log_event(logging.WARNING, "Prefilter", "⚠️ Falha ao gravar amostras", samples=len(lines), error=str(e))
 
-        content = result.choices[0].message.content.strip()
-        if content.startswith("```json"):
-            content = content.removeprefix("```json").strip()
-        if content.endswith("```"):
-            content = content.removesuffix("```").strip()
+    def write_samples(self, lines: list[str]):
+        with open(self.samples_path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
 
-        return json.loads(content)
+    async def close(self):
+        if self.samples_task is not None:
+            await self.samples_task
 
-    except Exception as e:
-        print("[OpenAI] ❌ Strategy Analysis Failed:", e)
+    def snapshot(self) -> dict:
+        decided = sum(self.stats[key] for key in ("true_positives", "false_positives", "true_negatives", "false_negatives"))
+        agreement = (self.stats["true_positives"] + self.stats["true_negatives"]) / decided if decided else None
         return {
-            "strategy_description": "Erro na análise",
-            "tags": {
-                "Mercados Preferidos": [],
-                "Ligas em Foco": [],
-                "Momento das Apostas": [],
-                "Outras": [str(e)]
-            }
+            **self.stats,
+            "mode": self.mode,
+            "threshold": self.threshold,
+            "model": self.model is not None,
+            "agreement": agreement
         }
-        
-# --- Atualizado: coleta com limite e FloodWait safe ---
-async def collect_tips_until_date(chat_id, until_date, batch_size=5, max_messages=5):
-    collected_tips = []
-    collected_messages = 0
-    last_message_date = datetime.now(timezone.utc)
-    last_message_id = None
-    pyro = telegram_client
-    while collected_messages < max_messages:
-        print(f"[Collect] 🔄 Fetching {batch_size} messages from {chat_id}")
-        try:
-            messages = []
-            if last_message_id:
-                history = pyro.get_chat_history(chat_id, limit=batch_size, offset_id=last_message_id)
-            else:
-                history = pyro.get_chat_history(chat_id, limit=batch_size)
-            async for msg in history:
-                messages.append(msg)
-            if not messages:
-                break
-            for msg in messages:
-                msg_date_utc = msg.date.replace(tzinfo=timezone.utc)
-                if msg_date_utc < until_date:
-                    return collected_tips
-                last_message_id = msg.id
-                print(f"[Process] 📩 Message ID: {msg.id} | Date: {msg.date.isoformat()} | Has text: {bool(msg.text)} | Has photo: {bool(msg.photo)}")
-                tip_data = await process_message(msg, chat_id, pyro)
-                collected_messages += 1
-                if tip_data:
-                    print(f"[Process] ✅ Tip detected in message {msg.id}")
-                    collected_tips.append(tip_data)
-                else:
-                    print(f"[Process] ⛔️ Message {msg.id} is not a tip")
-                if collected_messages >= max_messages:
-                    break
-        except FloodWait as e:
-            print(f"[FloodWait] ⏳ Esperando {e.value} segundos...")
-            await asyncio.sleep(e.value)
-        print(f"[Collect] ✅ Collected {len(collected_tips)} tips from {collected_messages} messages")
-    return collected_tips
 
-@app.post("/test-connection")
-async def test_connection(request: Request):
-    auth_check(request)
-    return { "success": True }
+prefilter = TipPrefilter(PREFILTER_MODE, PREFILTER_THRESHOLD, PREFILTER_MODEL_PATH, PREFILTER_SAMPLES_PATH)
 
-@app.post("/test-channel-message", summary="Testar se o canal pode ser acedido e devolver a última mensagem", tags=["Telegram"])
-async def test_channel_message(request: Request, body: dict = Body(...), authorization: str = Header(None, description="Bearer token da API")):
-    log_request(request, body)
-    auth_check(request)
-    chat_id = body.get("chat_id")
-    if not chat_id:
-        return JSONResponse(status_code=400, content={"error": "Missing chat_id"})
-    try:
-        pyro = telegram_client
-        try:
-            messages = [msg async for msg in pyro.get_chat_history(chat_id, limit=1)]
-        except Exception as fetch_error:
-            return {
+# --- Cache de classificações ---
+# Resultados de extração indexados por hash do conteúdo (texto normalizado ou bytes da imagem)
+# mais a versão do prompt/modelo. Camada em memória (LRU com TTL) e camada persistente opcional
+# no state_store. Pedidos concorrentes para o mesmo conteúdo partilham a mesma chamada.
+def get_prompt_version() -> str:
+    return hashlib.sha256(f"{OPENAI_MODEL}\n{get_tip_prompt()}".encode("utf-8")).hexdigest()[:16]
+
+def text_cache_key(text: str) -> str:
+    normalized = " ".join(text.split()).casefold()
+    return f"text:{get_prompt_version()}:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()}"
+
+def image_cache_key(image: PreparedImage) -> str:
+    return f"image:{get_prompt_version()}:{image_hash_index.canonical(image)}"
+
+class ClassificationCache:
+    def __init__(self, max_size: int, ttl: int, store=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.store = store
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.stats = { "memory_hits": 0, "persistent_hits": 0, "inflight_hits": 0, "misses": 0, "evictions": 0 }
+
+    def get_memory(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return result
+
+    def put_memory(self, key: str, result: dict):
+        self.entries[key] = (time.monotonic() + self.ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def count(self, stat: str, result: str):
+        self.stats[stat] += 1
+        CLASSIFICATION_CACHE_REQUESTS.labels(result).inc()
+
+    async def load_persistent(self, key: str):
+        if not self.store:
+            return None
+        try:
+            return await asyncio.to_thread(self.store.get_classification, key, self.ttl)
+        except Exception as e:
+            log_event(logging.WARNING, "Cache", "⚠️ Falha ao ler cache persistente", error=str(e))
+            return None
+
+    async def save_persistent(self, key: str, result: dict):
+        if not self.store:
+            return
+        try:
+            await asyncio.to_thread(self.store.set_classification, key, result)
+        except Exception as e:
+            log_event(logging.WARNING, "Cache", "⚠️ Falha ao gravar cache persistente", error=str(e))
+
+    async def load_or_compute(self, key: str, compute):
+        result = await self.load_persistent(key)
+        if result is not None:
+            self.count("persistent_hits", "persistent_hit")
+            self.put_memory(key, result)
+            return result
+        self.count("misses", "miss")
+        result = await compute()
+        # Erros (OpenAI, JSON inválido) não ficam em cache para serem repetidos
+        if result is not None and not result.get("error"):
+            self.put_memory(key, result)
+            await self.save_persistent(key, result)
+        return result
+
+    async def get_or_compute(self, key: str, compute) -> dict:
+        result = self.get_memory(key)
+        if result is not None:
+            self.count("memory_hits", "memory_hit")
+            return copy.deepcopy(result)
+        task = self.inflight.get(key)
+        if task is not None:
+            self.count("inflight_hits", "inflight_hit")
+        else:
+            task = asyncio.ensure_future(self.load_or_compute(key, compute))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def snapshot(self) -> dict:
+        return {
+            **self.stats,
+            "size": len(self.entries),
+            "inflight": len(self.inflight),
+            "image_near_duplicates": image_hash_index.near_duplicates,
+            "prompt_version": get_prompt_version()
+        }
+
+classification_cache = ClassificationCache(
+    CLASSIFICATION_CACHE_SIZE,
+    CLASSIFICATION_CACHE_TTL,
+    store=state_store if CLASSIFICATION_CACHE_PERSIST else None
+)
+
+# --- Schema das tips (validação e normalização) ---
+# Toda a resposta do LLM passa pelo modelo Tip: odds como float (aceita "1,85" e "@1.85"), datas dos
+# jogos em ISO 8601 (dateutil), tipo normalizado e campos desconhecidos descartados. Uma resposta que
+# não é JSON ou não cumpre o schema levanta TipParseError, e o pedido é repetido só para essa mensagem.
+class TipEntry(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    match: str | None = None
+    tournament: str | None = None
+    datetime: str | None = None
+    market: str | None = None
+    outcome: str | None = None
+    individual_odd: float | None = None
+
+    @field_validator("match", "tournament", "market", "outcome", mode="before")
+    @classmethod
+    def clean_text(cls, value):
+        if value is None:
+            return None
+        return " ".join(str(value).split()) or None
+
+    @field_validator("datetime", mode="before")
+    @classmethod
+    def normalize_datetime(cls, value):
+        parsed = parse_tip_datetime(value)
+        return parsed.isoformat() if parsed else None
+
+    @field_validator("individual_odd", mode="before")
+    @classmethod
+    def normalize_odd(cls, value):
+        return parse_odd(value)
+
+class Tip(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    is_tip: bool
+    type: Literal["single", "multiple", "incomplete"] | None = None
+    odd: float | None = None
+    tip_entries: list[TipEntry] = Field(default_factory=list)
+
+    @field_validator("type", mode="before")
+    @classmethod
+    def normalize_type(cls, value):
+        value = str(value or "").strip().lower()
+        return value if value in ("single", "multiple", "incomplete") else "incomplete"
+
+    @field_validator("odd", mode="before")
+    @classmethod
+    def normalize_odd(cls, value):
+        return parse_odd(value)
+
+    @field_validator("tip_entries", mode="before")
+    @classmethod
+    def drop_invalid_entries(cls, value):
+        if value is None:
+            return []
+        if isinstance(value, dict):
+            return [value]
+        if isinstance(value, list):
+            return [entry for entry in value if isinstance(entry, dict)]
+        return value
+
+    # Sem odd total mas com todas as odds individuais, a odd total é o produto (simples ou múltipla)
+    @model_validator(mode="after")
+    def fill_total_odd(self):
+        odds = [entry.individual_odd for entry in self.tip_entries]
+        if self.odd is None and odds and all(odds):
+            self.odd = round(math.prod(odds), 2)
+        return self
+
+class TipParseError(ValueError):
+    pass
+
+def strip_json_fences(content: str) -> str:
+    cleaned = content.strip()
+    if cleaned.startswith("```json"):
+        cleaned = cleaned.removeprefix("```json").strip()
+    elif cleaned.startswith("```"):
+        cleaned = cleaned.removeprefix("```").strip()
+    if cleaned.endswith("```"):
+        cleaned = cleaned.removesuffix("```").strip()
+    return cleaned
+
+def validate_tip(data) -> dict:
+    try:
+        tip = Tip.model_validate(data)
+    except ValidationError as e:
+        errors = "; ".join(f"{'.'.join(map(str, error['loc'])) or 'root'}: {error['msg']}" for error in e.errors()[:5])
+        raise TipParseError(f"Schema inválido: {errors}") from e
+    return tip.model_dump() if tip.is_tip else { "is_tip": False }
+
+def parse_tip_response(content: str) -> dict:
+    cleaned = strip_json_fences(content or "")
+    if not cleaned:
+        raise TipParseError("Empty response from OpenAI")
+    try:
+        data = json.loads(cleaned)
+    except json.JSONDecodeError as e:
+        raise TipParseError(f"Invalid JSON: {e}") from e
+    return validate_tip(data)
+
+# --- OpenAI Analysis ---
+# Todos os pedidos passam por aqui para medir latência, erros e tokens (result.usage) por tipo de análise
+JSON_RESPONSE_FORMAT = { "type": "json_object" } if OPENAI_JSON_MODE else None
+
+async def create_chat_completion(kind: str, messages: list, temperature: float = 0.0, response_format: dict = None):
+    options = { "response_format": response_format } if response_format else {}
+    with OPENAI_REQUEST_SECONDS.labels(kind).time():
+        try:
+            result = await client.chat.completions.create(model=OPENAI_MODEL, messages=messages, temperature=temperature, **options)
+        except Exception:
+            OPENAI_REQUESTS.labels(kind, "error").inc()
+            raise
+    OPENAI_REQUESTS.labels(kind, "ok").inc()
+    usage = getattr(result, "usage", None)
+    if usage:
+        OPENAI_TOKENS.labels(kind, "prompt").inc(usage.prompt_tokens or 0)
+        OPENAI_TOKENS.labels(kind, "completion").inc(usage.completion_tokens or 0)
+    return result
+
+async def analyze_message_with_openai_text(text: str) -> dict:
+    if not text:
+        return { "is_tip": False }
+    return await classification_cache.get_or_compute(text_cache_key(text), lambda: classify_text_with_openai(text))
+
+# Uma resposta inválida é pedida de novo (até OPENAI_PARSE_RETRIES vezes) na mesma conversa, com o erro
+# de validação, em vez de se perder a tip; se continuar inválida o resultado leva "error" e a mensagem
+# fica marcada como falhada para ser repetida numa próxima coleta.
+async def request_tip(kind: str, messages: list) -> dict:
+    for attempt in range(OPENAI_PARSE_RETRIES + 1):
+        result = await create_chat_completion(kind, messages, response_format=JSON_RESPONSE_FORMAT)
+        content = result.choices[0].message.content or ""
+        try:
+            return parse_tip_response(content)
+        except TipParseError as e:
+            final = attempt >= OPENAI_PARSE_RETRIES
+            OPENAI_PARSE_FAILURES.labels(kind, "failed" if final else "retried").inc()
+            log_event(logging.WARNING, "Tip Parse", "⚠️ Resposta inválida do OpenAI", kind=kind, attempt=attempt + 1, error=str(e), content=repr(content[:200]))
+            if final:
+                return { "is_tip": False, "error": str(e), "raw_content": content, "json_error": True }
+            messages = messages + [
+                { "role": "assistant", "content": content },
+                { "role": "user", "content": f"A resposta anterior não é válida ({e}). Responde apenas com o objeto JSON no formato pedido." }
+            ]
+
+async def classify_text_with_openai(text: str) -> dict:
+    try:
+        return await request_tip("text", [
+            { "role": "system", "content": get_tip_prompt() },
+            { "role": "user", "content": text }
+        ])
+    except Exception as e:
+        log_event(logging.ERROR, "Text Analysis", "❌ Unexpected error", error=str(e))
+        return { "is_tip": False, "error": str(e) }
+
+async def analyze_image_with_openai(image: PreparedImage) -> dict:
+    if not image.data:
+        log_event(logging.ERROR, "Image Analysis", "❌ Image content is empty")
+        return { "is_tip": False, "error": "Empty image content" }
+    return await classification_cache.get_or_compute(image_cache_key(image), lambda: classify_image_with_openai(image))
+
+async def classify_image_with_openai(image: PreparedImage) -> dict:
+    try:
+        image_base64 = base64.b64encode(image.data).decode("utf-8")
+        data_url = f"data:image/jpeg;base64,{image_base64}"
+        log_event(logging.DEBUG, "Image Analysis", "✅ Image encoded", width=image.width, height=image.height, detail=image.detail, chars=len(image_base64))
+        return await request_tip("image", [
+            { "role": "system", "content": get_tip_prompt() },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": { "url": data_url, "detail": image.detail }
+                    }
+                ]
+            }
+        ])
+    except Exception as e:
+        log_event(logging.ERROR, "Image Analysis", "❌ Unexpected Exception", error=str(e))
+        return { "is_tip": False, "error": str(e) }
+
+# --- Extração em lote (vários textos curtos num só pedido) ---
+# Devolve {message_id: resultado} só para os itens que passam o schema; os restantes ficam para o fallback individual.
+async def extract_tips_batch_with_openai(items: list[tuple[int, str]]) -> dict:
+    try:
+        payload = json.dumps([{ "message_id": message_id, "text": text } for message_id, text in items], ensure_ascii=False)
+        result = await create_chat_completion("batch", [
+            { "role": "system", "content": get_batch_tip_prompt() },
+            { "role": "user", "content": payload }
+        ], response_format=JSON_RESPONSE_FORMAT)
+        parsed = json.loads(strip_json_fences(result.choices[0].message.content))
+    except Exception as e:
+        log_event(logging.ERROR, "Batch Analysis", "❌ Lote falhou", messages=len(items), error=str(e))
+        return {}
+    if isinstance(parsed, dict):
+        parsed = parsed.get("results", [])
+    if not isinstance(parsed, list):
+        log_event(logging.WARNING, "Batch Analysis", "⚠️ Resposta não é um array JSON", messages=len(items))
+        return {}
+    expected = { str(message_id): message_id for message_id, _ in items }
+    results = {}
+    for item in parsed:
+        if not isinstance(item, dict):
+            continue
+        message_id = expected.get(str(item.pop("message_id", None)))
+        if message_id is None:
+            continue
+        try:
+            results[message_id] = validate_tip(item)
+        except TipParseError as e:
+            OPENAI_PARSE_FAILURES.labels("batch", "retried").inc()
+            log_event(logging.DEBUG, "Batch Analysis", "⚠️ Item inválido no lote", message_id=message_id, error=str(e))
+    return results
+
+# Agrupa textos curtos em lotes de até batch_size mensagens (ou o que houver ao fim de max_wait segundos).
+# Cada texto passa primeiro pela cache de classificações; só os que falham a cache entram no lote.
+# Mensagens em falta ou inválidas na resposta do lote são analisadas individualmente.
+class TextBatchExtractor:
+    def __init__(self, batch_size: int, max_wait: float = LLM_BATCH_MAX_WAIT):
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+        self.stats = { "batches": 0, "batched_messages": 0, "fallbacks": 0 }
+
+    async def analyze(self, message_id: int, text: str) -> dict:
+        if not text:
+            return { "is_tip": False }
+        if len(text) > LLM_BATCH_MAX_CHARS:
+            async with llm_semaphore:
+                return await analyze_message_with_openai_text(text)
+        return await classification_cache.get_or_compute(text_cache_key(text), lambda: self.enqueue(message_id, text))
+
+    def enqueue(self, message_id: int, text: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((message_id, text, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self.flush)
+        return future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch: list):
+        try:
+            self.stats["batches"] += 1
+            self.stats["batched_messages"] += len(batch)
+            log_event(logging.DEBUG, "Batch Analysis", "🧠 Analisando lote", messages=len(batch))
+            async with llm_semaphore:
+                results = await extract_tips_batch_with_openai([(message_id, text) for message_id, text, _ in batch])
+            missing = []
+            for message_id, text, future in batch:
+                if message_id in results:
+                    future.done() or future.set_result(results[message_id])
+                else:
+                    missing.append((text, future))
+            if missing:
+                self.stats["fallbacks"] += len(missing)
+                log_event(logging.WARNING, "Batch Analysis", "⚠️ Mensagens sem resultado no lote; a analisar individualmente", missing=len(missing))
+                await asyncio.gather(*(self.run_single(text, future) for text, future in missing))
+        except Exception as e:
+            for _, _, future in batch:
+                future.done() or future.set_result({ "is_tip": False, "error": str(e) })
+
+    async def run_single(self, text: str, future: asyncio.Future):
+        async with llm_semaphore:
+            result = await classify_text_with_openai(text)
+        future.done() or future.set_result(result)
+
+# O Pyrogram não levanta erro quando o download falha: o get_file regista a exceção (file reference
+# expirada, FloodWait acima do sleep_threshold) e download_media(in_memory=True) devolve um BytesIO vazio.
+# Um buffer vazio conta como falha (None), tal como uma exceção.
+async def safe_download_media(app, media, file_name="downloads/", in_memory=False):
+    try:
+        result = await app.safe_call(app.download_media, media, file_name=file_name, in_memory=in_memory)
+    except Exception as e:
+        log_event(logging.ERROR, "safe_download_media", "❌ Erro inesperado no download", error=str(e))
+        return None
+    if in_memory and result is not None and result.getbuffer().nbytes == 0:
+        log_event(logging.WARNING, "safe_download_media", "⚠️ Download devolveu um buffer vazio")
+        return None
+    return result
+
+# --- Download de fotos direto do histórico, com refetch em lote ---
+# A mensagem devolvida pelo get_chat_history já traz a foto; só quando o download falha
+# (tipicamente file reference expirada) é que a mensagem é pedida de novo. Os pedidos de
+# refetch de um canal são agrupados num único get_messages com a lista de ids.
+media_stats = { "downloads": 0, "download_retries": 0, "refetched_messages": 0, "refetch_calls": 0 }
+
+class MediaRefetcher:
+    def __init__(self, pyro, chat_id, max_wait: float = MEDIA_REFETCH_MAX_WAIT, max_batch: int = MEDIA_REFETCH_MAX_BATCH):
+        self.pyro = pyro
+        self.chat_id = chat_id
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.pending = {}
+        self.timer = None
+        self.tasks = set()
+
+    def refetch(self, message_id: int) -> asyncio.Future:
+        future = self.pending.get(message_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[message_id] = future
+        if len(self.pending) >= self.max_batch or self.max_wait <= 0:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+        return future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, {}
+        if batch:
+            task = asyncio.ensure_future(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch: dict):
+        media_stats["refetch_calls"] += 1
+        media_stats["refetched_messages"] += len(batch)
+        log_event(logging.INFO, "Media", "🔁 Refetch em lote num só get_messages", chat_id=self.chat_id, messages=len(batch))
+        try:
+            messages = await self.pyro.safe_call(self.pyro.get_messages, self.chat_id, list(batch))
+            by_id = { m.id: m for m in messages if m and not getattr(m, "empty", False) }
+        except Exception as e:
+            log_event(logging.ERROR, "Media", "❌ Refetch falhou", chat_id=self.chat_id, error=str(e))
+            by_id = {}
+        for message_id, future in batch.items():
+            future.done() or future.set_result(by_id.get(message_id))
+
+# --- Limites por estágio (partilhados entre todos os canais) ---
+download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# O slot de download só é ocupado durante cada download: a espera pelo lote de refetch é feita sem ele,
+# para não bloquear os outros downloads nem limitar o lote a DOWNLOAD_CONCURRENCY mensagens.
+async def download_photo(pyro, chat_id, msg, refetcher: MediaRefetcher = None):
+    media_stats["downloads"] += 1
+    async with download_semaphore:
+        buffer = await safe_download_media(pyro, msg, in_memory=True)
+    if buffer is not None:
+        return buffer
+    media_stats["download_retries"] += 1
+    refetcher = refetcher or MediaRefetcher(pyro, chat_id, max_wait=0)
+    fresh = await refetcher.refetch(msg.id)
+    if not fresh or not fresh.photo:
+        log_event(logging.WARNING, "Media", "⚠️ Mensagem sem foto após refetch", chat_id=chat_id, message_id=msg.id)
+        return None
+    async with download_semaphore:
+        return await safe_download_media(pyro, fresh, in_memory=True)
+
+# Falha transitória (download, upload ou OpenAI): a mensagem não conta como processada
+# e o cursor do canal não avança para além dela.
+class MessageProcessingError(Exception):
+    pass
+
+# --- Processar mensagem com validações robustas ---
+async def process_message(msg, chat_id, pyro, batcher: TextBatchExtractor = None, refetcher: MediaRefetcher = None):
+    log_event(logging.DEBUG, "Process", "📩 Mensagem recebida", chat_id=chat_id, message_id=msg.id, date=msg.date.isoformat(), has_text=bool(msg.text), has_photo=bool(msg.photo))
+    tip_data = None
+    image_url = None
+
+    if msg.text:
+        score = prefilter.score(msg.text) if prefilter.mode != "off" else None
+        if score is not None and prefilter.should_skip(score):
+            log_event(logging.DEBUG, "Process", "⏭️ Mensagem descartada pelo pré-filtro", chat_id=chat_id, message_id=msg.id, score=round(score, 2))
+            tip_data = { "is_tip": False, "prefiltered": True }
+        else:
+            if batcher:
+                tip_data = await batcher.analyze(msg.id, msg.text)
+            else:
+                async with llm_semaphore:
+                    tip_data = await analyze_message_with_openai_text(msg.text)
+            log_event(logging.DEBUG, "Process", "✅ Resultado texto", chat_id=chat_id, message_id=msg.id, result=tip_data)
+            if score is not None:
+                prefilter.record(msg.text, score, tip_data)
+
+    elif msg.photo:
+        try:
+            with PIPELINE_STAGE_SECONDS.labels("download").time():
+                buffer = await download_photo(pyro, chat_id, msg, refetcher)
+
+            if buffer is None:
+                log_event(logging.WARNING, "Process", "❌ Falha no download da imagem", chat_id=chat_id, message_id=msg.id, file_id=getattr(msg.photo, "file_id", None))
+                raise MessageProcessingError("Media download failed")
+
+            with PIPELINE_STAGE_SECONDS.labels("image_conversion").time():
+                image = await asyncio.to_thread(preprocess_image, buffer)
+            log_event(logging.DEBUG, "Process", "✅ Imagem preparada em memória", chat_id=chat_id, message_id=msg.id, width=image.width, height=image.height, bytes=len(image.data))
+
+            async with llm_semaphore:
+                tip_data = await analyze_image_with_openai(image)
+            log_event(logging.DEBUG, "Process", "✅ Resultado imagem", chat_id=chat_id, message_id=msg.id, result=tip_data)
+
+            # Só as tips precisam da imagem no storage. Um upload falhado não deita fora a análise:
+            # a tip segue com image_url None.
+            if tip_data and tip_data.get("is_tip") and not tip_data.get("error"):
+                async with upload_semaphore:
+                    image_url = await upload_image_bytes_to_supabase(image.data, f"{chat_id}_{msg.id}")
+                if image_url:
+                    log_event(logging.DEBUG, "Process", "✅ Imagem disponível no storage", chat_id=chat_id, message_id=msg.id, image_url=image_url)
+                else:
+                    log_event(logging.WARNING, "Process", "⚠️ Tip guardada sem imagem no storage", chat_id=chat_id, message_id=msg.id)
+        except MessageProcessingError:
+            raise
+        except Exception as e:
+            raise MessageProcessingError(str(e)) from e
+
+    else:
+        log_event(logging.DEBUG, "Process", "ℹ️ Mensagem sem texto nem imagem suportada", chat_id=chat_id, message_id=msg.id)
+
+    if tip_data and tip_data.get("error"):
+        raise MessageProcessingError(tip_data["error"])
+
+    if tip_data and tip_data.get("is_tip"):
+        tip_data["chat_id"] = chat_id
+        tip_data["message_id"] = msg.id
+        tip_data["date"] = msg.date.isoformat()
+
+        # Adiciona o texto da mensagem, se houver
+        if msg.text:
+            tip_data["text"] = msg.text
+
+        # Se foi imagem, adiciona o URL no storage (None se o upload falhou)
+        if msg.photo:
+            tip_data["image_url"] = image_url
+            if msg.caption:
+                tip_data["text"] = msg.caption
+        
+        log_event(logging.INFO, "Process", "✅ Tip válida detectada", chat_id=chat_id, message_id=msg.id)
+        return tip_data
+
+    log_event(logging.DEBUG, "Process", "⛔️ Mensagem não é uma tip", chat_id=chat_id, message_id=msg.id)
+    return None
+
+# --- Análise de estratégia do tipster (agregados locais + map-reduce) ---
+# Os agregados (mercados, ligas, odds, momento da aposta) são calculados localmente sobre todas as tips
+# e podem ser combinados (merge), o que permite calculá-los por lotes. Históricos pequenos vão numa
+# só chamada com as tips em formato compacto; nos grandes cada lote é resumido em paralelo (map) e só
+# os agregados e as observações parciais chegam à chamada final (reduce).
+ODDS_BUCKETS = ((1.5, "<1.5"), (2.0, "1.5-2"), (3.0, "2-3"), (5.0, "3-5"), (float("inf"), "5+"))
+TIMING_LABELS = ("Live", "Mesmo dia", "1 dia antes", "2+ dias antes", "Desconhecido")
+WEEKDAYS = ("seg", "ter", "qua", "qui", "sex", "sáb", "dom")
+
+def parse_tip_datetime(value) -> datetime | None:
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        parsed = parser.parse(value)
+    except (ValueError, OverflowError):
+        return None
+    return parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed.astimezone(timezone.utc)
+
+def parse_odd(value) -> float | None:
+    try:
+        odd = float(str(value).strip().lstrip("@").replace(",", "."))
+    except (TypeError, ValueError):
+        return None
+    return odd if odd > 1 else None
+
+def normalize_label(value) -> str | None:
+    if not value or not isinstance(value, str):
+        return None
+    return " ".join(value.split())[:60].casefold()
+
+def odds_bucket(odd: float) -> str:
+    return next(label for limit, label in ODDS_BUCKETS if odd < limit)
+
+# Momento da aposta: compara a data de publicação da tip com a data/hora do jogo
+def bet_timing(posted_at: datetime | None, match_at: datetime | None) -> str:
+    if not posted_at or not match_at:
+        return "Desconhecido"
+    if posted_at >= match_at:
+        return "Live"
+    days = (match_at.date() - posted_at.date()).days
+    if days <= 0:
+        return "Mesmo dia"
+    return "1 dia antes" if days == 1 else "2+ dias antes"
+
+def merge_extreme(pick, *values):
+    present = [value for value in values if value is not None]
+    return pick(present) if present else None
+
+class StrategyAggregate:
+    COUNTERS = ("types", "markets", "tournaments", "odds_buckets", "timing", "hours", "weekdays")
+
+    def __init__(self):
+        self.tips = 0
+        self.entries = 0
+        self.odds_sum = 0.0
+        self.odds_count = 0
+        self.odds_min = None
+        self.odds_max = None
+        self.first_date = None
+        self.last_date = None
+        for name in self.COUNTERS:
+            setattr(self, name, Counter())
+
+    @classmethod
+    def from_tips(cls, tips: list[dict]) -> "StrategyAggregate":
+        aggregate = cls()
+        for tip in tips:
+            aggregate.add(tip)
+        return aggregate
+
+    def add(self, tip: dict):
+        self.tips += 1
+        self.types[str(tip.get("type") or "desconhecido")] += 1
+        posted_at = parse_tip_datetime(tip.get("date"))
+        if posted_at:
+            self.hours[str(posted_at.hour)] += 1
+            self.weekdays[WEEKDAYS[posted_at.weekday()]] += 1
+            iso = posted_at.isoformat()
+            self.first_date = merge_extreme(min, self.first_date, iso)
+            self.last_date = merge_extreme(max, self.last_date, iso)
+        odd = parse_odd(tip.get("odd"))
+        if odd:
+            self.odds_sum += odd
+            self.odds_count += 1
+            self.odds_min = merge_extreme(min, self.odds_min, odd)
+            self.odds_max = merge_extreme(max, self.odds_max, odd)
+            self.odds_buckets[odds_bucket(odd)] += 1
+        for entry in tip.get("tip_entries") or []:
+            if not isinstance(entry, dict):
+                continue
+            self.entries += 1
+            market = normalize_label(entry.get("market"))
+            tournament = normalize_label(entry.get("tournament"))
+            if market:
+                self.markets[market] += 1
+            if tournament:
+                self.tournaments[tournament] += 1
+            self.timing[bet_timing(posted_at, parse_tip_datetime(entry.get("datetime")))] += 1
+
+    def merge(self, other: "StrategyAggregate") -> "StrategyAggregate":
+        self.tips += other.tips
+        self.entries += other.entries
+        self.odds_sum += other.odds_sum
+        self.odds_count += other.odds_count
+        self.odds_min = merge_extreme(min, self.odds_min, other.odds_min)
+        self.odds_max = merge_extreme(max, self.odds_max, other.odds_max)
+        self.first_date = merge_extreme(min, self.first_date, other.first_date)
+        self.last_date = merge_extreme(max, self.last_date, other.last_date)
+        for name in self.COUNTERS:
+            getattr(self, name).update(getattr(other, name))
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            "tips": self.tips,
+            "entries": self.entries,
+            "odds_sum": self.odds_sum,
+            "odds_count": self.odds_count,
+            "odds_min": self.odds_min,
+            "odds_max": self.odds_max,
+            "first_date": self.first_date,
+            "last_date": self.last_date,
+            **{ name: dict(getattr(self, name)) for name in self.COUNTERS }
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "StrategyAggregate":
+        aggregate = cls()
+        for key in ("tips", "entries", "odds_sum", "odds_count", "odds_min", "odds_max", "first_date", "last_date"):
+            setattr(aggregate, key, data.get(key, getattr(aggregate, key)))
+        for name in cls.COUNTERS:
+            setattr(aggregate, name, Counter(data.get(name) or {}))
+        return aggregate
+
+    # Resumo compacto (percentagens e tops) que é enviado ao LLM e devolvido pelo endpoint
+    def features(self, top: int = STRATEGY_TOP_N) -> dict:
+        def shares(counter: Counter, total: int, limit: int = None) -> dict:
+            return { key: round(count / total, 3) for key, count in counter.most_common(limit) } if total else {}
+
+        tips_per_week = None
+        if self.first_date and self.last_date:
+            span = datetime.fromisoformat(self.last_date) - datetime.fromisoformat(self.first_date)
+            tips_per_week = round(self.tips / max(1.0, span.total_seconds() / (7 * 86400)), 2)
+        return {
+            "tips": self.tips,
+            "entries": self.entries,
+            "entries_per_tip": round(self.entries / self.tips, 2) if self.tips else None,
+            "period": { "first": self.first_date, "last": self.last_date, "tips_per_week": tips_per_week },
+            "types": shares(self.types, self.tips),
+            "markets": shares(self.markets, self.entries, top),
+            "tournaments": shares(self.tournaments, self.entries, top),
+            "odds": {
+                "mean": round(self.odds_sum / self.odds_count, 2) if self.odds_count else None,
+                "min": self.odds_min,
+                "max": self.odds_max,
+                "distribution": shares(self.odds_buckets, self.odds_count)
+            },
+            "timing": shares(self.timing, self.entries),
+            "posting_hours_utc": shares(self.hours, self.tips, 6),
+            "weekdays": shares(self.weekdays, self.tips)
+        }
+
+def compact_tip_row(tip: dict) -> str:
+    posted_at = parse_tip_datetime(tip.get("date"))
+    entries = []
+    for entry in tip.get("tip_entries") or []:
+        if isinstance(entry, dict):
+            entries.append("; ".join(str(entry.get(key) or "-") for key in ("match", "market", "outcome", "individual_odd", "tournament"))
+                           + f"; {bet_timing(posted_at, parse_tip_datetime(entry.get('datetime')))}")
+    posted = posted_at.strftime("%Y-%m-%d %H:%M") if posted_at else "-"
+    return f"{posted} | {tip.get('type') or '-'} @{tip.get('odd') or '-'} | {' || '.join(entries) or '-'}"
+
+def parse_llm_json(content: str):
+    return json.loads(strip_json_fences(content))
+
+# Amostragem uniforme (determinística) quando há mais tips do que os lotes permitem
+def sample_evenly(items: list, limit: int) -> list:
+    if len(items) <= limit:
+        return items
+    step = len(items) / limit
+    return [items[int(index * step)] for index in range(limit)]
+
+async def summarize_strategy_chunk(rows: list[str]) -> list[str]:
+    async with llm_semaphore:
+        result = await create_chat_completion("strategy_chunk", [
+            { "role": "system", "content": get_strategy_chunk_prompt() },
+            { "role": "user", "content": "\n".join(rows) }
+        ], response_format=JSON_RESPONSE_FORMAT)
+    parsed = parse_llm_json(result.choices[0].message.content)
+    observations = parsed.get("observations", []) if isinstance(parsed, dict) else parsed
+    return [str(item) for item in observations][:5] if isinstance(observations, list) else []
+
+# Sem LLM (ou se falhar) a resposta é construída só a partir dos agregados
+def fallback_strategy(features: dict, error: str) -> dict:
+    timing = [label for label in features["timing"] if label != "Desconhecido"]
+    return {
+        "strategy_description": "Análise automática a partir dos agregados (LLM indisponível)",
+        "tags": {
+            "Mercados Preferidos": list(features["markets"])[:5],
+            "Ligas em Foco": list(features["tournaments"])[:5],
+            "Momento das Apostas": timing,
+            "Outras": [f"Odd média {features['odds']['mean']}"] if features["odds"]["mean"] else []
+        },
+        "error": error
+    }
+
+async def analyze_tipster_strategy_with_openai(tips: list[dict], aggregate: StrategyAggregate = None) -> dict:
+    aggregate = aggregate or StrategyAggregate.from_tips(tips)
+    features = aggregate.features()
+    ordered = sorted(tips, key=lambda tip: str(tip.get("date") or ""))
+    payload = { "aggregates": features, "partial_summaries": [], "sample_tips": [] }
+    try:
+        if len(ordered) <= STRATEGY_CHUNK_SIZE:
+            payload["sample_tips"] = [compact_tip_row(tip) for tip in ordered]
+        else:
+            rows = [compact_tip_row(tip) for tip in sample_evenly(ordered, STRATEGY_CHUNK_SIZE * STRATEGY_MAX_CHUNKS)]
+            chunks = [rows[i:i + STRATEGY_CHUNK_SIZE] for i in range(0, len(rows), STRATEGY_CHUNK_SIZE)]
+            log_event(logging.INFO, "Strategy", "🧩 Resumo por lotes", tips=len(ordered), chunks=len(chunks))
+            partials = await asyncio.gather(*(summarize_strategy_chunk(chunk) for chunk in chunks), return_exceptions=True)
+            for index, partial in enumerate(partials):
+                if isinstance(partial, Exception):
+                    log_event(logging.WARNING, "Strategy", "⚠️ Lote sem resumo", chunk=index, error=str(partial))
+                else:
+                    payload["partial_summaries"].append({ "chunk": index + 1, "observations": partial })
+        async with llm_semaphore:
+            result = await create_chat_completion("strategy", [
+                { "role": "system", "content": get_strategy_prompt() },
+                { "role": "user", "content": json.dumps(payload, ensure_ascii=False) }
+            ], temperature=0.3, response_format=JSON_RESPONSE_FORMAT)
+        return parse_llm_json(result.choices[0].message.content)
+
+    except Exception as e:
+        log_event(logging.ERROR, "OpenAI", "❌ Strategy Analysis Failed", error=str(e))
+        return fallback_strategy(features, str(e))
+
+# --- Perfis de estratégia incrementais por canal ---
+# Cada canal guarda no state_store os agregados, os ids das tips que cobrem e o último resumo do LLM.
+# Um pedido com as mesmas tips devolve o perfil tal como está; tips novas são somadas aos agregados
+# e o LLM só é chamado quando a distribuição (mercados, ligas, odds, tipos, momento) se afasta da
+# usada no último resumo mais do que STRATEGY_DRIFT_THRESHOLD (distância de variação total).
+# Se o pedido deixar de incluir tips já cobertas, os agregados são recalculados de raiz.
+strategy_profile_locks: dict[str, asyncio.Lock] = {}
+
+def get_strategy_version() -> str:
+    return hashlib.sha256(f"{OPENAI_MODEL}\n{get_strategy_prompt()}\n{get_strategy_chunk_prompt()}".encode("utf-8")).hexdigest()[:16]
+
+def tip_identity(tip: dict) -> str:
+    if tip.get("chat_id") is not None and tip.get("message_id") is not None:
+        return f"{tip['chat_id']}:{tip['message_id']}"
+    return hashlib.sha256(json.dumps(tip, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:24]
+
+def tips_digest(tip_ids) -> str:
+    return hashlib.sha256("\n".join(sorted(tip_ids)).encode("utf-8")).hexdigest()
+
+def distribution_drift(old: dict, new: dict) -> float:
+    return 0.5 * sum(abs(old.get(key, 0) - new.get(key, 0)) for key in set(old) | set(new))
+
+def strategy_drift(old: dict, new: dict) -> float:
+    drifts = [distribution_drift(old.get(key) or {}, new.get(key) or {}) for key in ("types", "markets", "tournaments", "timing")]
+    drifts.append(distribution_drift(old.get("odds", {}).get("distribution") or {}, new.get("odds", {}).get("distribution") or {}))
+    return round(max(drifts), 3)
+
+async def load_strategy_profile(chat_id) -> dict | None:
+    try:
+        return await asyncio.to_thread(state_store.get_strategy_profile, chat_id)
+    except Exception as e:
+        log_event(logging.WARNING, "Strategy", "⚠️ Não foi possível ler o perfil", chat_id=chat_id, error=str(e))
+        return None
+
+async def save_strategy_profile(chat_id, profile: dict):
+    try:
+        await asyncio.to_thread(state_store.set_strategy_profile, chat_id, profile)
+    except Exception as e:
+        log_event(logging.WARNING, "Strategy", "⚠️ Não foi possível gravar o perfil", chat_id=chat_id, error=str(e))
+
+async def update_strategy_profile(chat_id: str, tips: list[dict], force: bool = False) -> dict:
+    async with strategy_profile_locks.setdefault(str(chat_id), asyncio.Lock()):
+        unique = {}
+        for tip in tips:
+            unique.setdefault(tip_identity(tip), tip)
+        digest = tips_digest(unique)
+        profile = await load_strategy_profile(chat_id)
+        usable = bool(
+            profile and profile.get("version") == get_strategy_version()
+            and profile.get("summary") and not profile["summary"].get("error")
+        )
+        if usable and not force and profile["tips_digest"] == digest:
+            return { **profile, "mode": "cached", "drift": 0.0, "refreshed": False }
+
+        covered = set(profile["tip_ids"]) if usable else set()
+        if covered and covered <= unique.keys():
+            new_tips = [tip for tip_id, tip in unique.items() if tip_id not in covered]
+            aggregate = StrategyAggregate.from_dict(profile["aggregate"]).merge(StrategyAggregate.from_tips(new_tips))
+            mode = "incremental"
+        else:
+            aggregate = await asyncio.to_thread(StrategyAggregate.from_tips, list(unique.values()))
+            mode = "rebuild"
+        features = aggregate.features()
+        drift = strategy_drift(profile["summary_features"], features) if usable else None
+
+        refreshed = force or drift is None or drift > STRATEGY_DRIFT_THRESHOLD
+        if refreshed:
+            summary = await analyze_tipster_strategy_with_openai(list(unique.values()), aggregate)
+            summary_features, summary_tips = features, len(unique)
+        else:
+            summary, summary_features, summary_tips = profile["summary"], profile["summary_features"], profile["summary_tips"]
+        profile = {
+            "chat_id": str(chat_id),
+            "version": get_strategy_version(),
+            "tip_ids": sorted(unique),
+            "tips_digest": digest,
+            "aggregate": aggregate.to_dict(),
+            "summary": summary,
+            "summary_features": summary_features,
+            "summary_tips": summary_tips,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }
+        await save_strategy_profile(chat_id, profile)
+        log_event(logging.INFO, "Strategy", "✅ Perfil atualizado", chat_id=chat_id, tips=len(unique), mode=mode, drift=drift, refreshed=refreshed)
+        return { **profile, "mode": mode, "drift": drift, "refreshed": refreshed }
+
+# --- Atualizado: coleta em pipeline (produtor/consumidores) com limite e FloodWait safe ---
+# O produtor lê o histórico em streaming (iter_chat_history) para uma fila limitada; os consumidores
+# processam as mensagens em paralelo (cada estágio respeita o seu semáforo) e os resultados são reordenados no fim.
+# Com min_id, a leitura pára na primeira mensagem já processada por uma coleta anterior.
+# O report (opcional) recebe o id mais recente visto, os ids que falharam, o número de tips e se a
+# leitura foi cortada por max_messages (truncated).
+# Com llm_batch_size > 1 os textos curtos são extraídos em lote; há consumidores suficientes
+# para encher um lote, já que cada um espera pelo resultado da sua mensagem.
+# Com keep_tips=False as tips só passam por on_tip, e a memória fica constante qualquer que seja a profundidade.
+# Checkpoints: a cada SCAN_CHECKPOINT_EVERY mensagens, on_checkpoint recebe o id da mensagem mais antiga
+# até à qual tudo já foi processado (as mais recentes primeiro); passar esse estado em 'checkpoint'
+# retoma a leitura a partir daí, com o mesmo newest_message_id e os mesmos ids falhados.
+async def collect_tips_until_date(chat_id, until_date, page_size=HISTORY_PAGE_SIZE, max_messages=None, workers=PIPELINE_WORKERS, min_id=0, report=None, llm_batch_size=1, on_tip=None, keep_tips=True, checkpoint=None, on_checkpoint=None):
+    pyro = await telegram_pool.client_for(chat_id)
+    batcher = TextBatchExtractor(llm_batch_size) if llm_batch_size > 1 else None
+    refetcher = MediaRefetcher(pyro, chat_id)
+    workers = max(1, workers, llm_batch_size)
+    queue = asyncio.Queue(maxsize=workers * 2)
+    checkpoint = checkpoint or {}
+    results = {}
+    newest_message_id = checkpoint.get("newest_message_id")
+    failed_message_ids = list(checkpoint.get("failed_message_ids", []))
+    base_messages = checkpoint.get("messages", 0)
+    tips_found = checkpoint.get("tips", 0)
+    # Ids em processamento por seq e seqs terminados à frente da marca; ambos limitados pela fila
+    inflight_ids = {}
+    done_seqs = set()
+    watermark = { "seq": 0, "message_id": checkpoint.get("offset_id"), "saved": 0 }
+    checkpoint_lock = asyncio.Lock()
+    truncated = False
+    stop = {}
+
+    async def produce():
+        nonlocal newest_message_id, truncated
+        seq = 0
+        remaining = None if max_messages is None else max(0, max_messages - base_messages)
+        try:
+            history = iter_chat_history(
+                pyro, chat_id, page_size, offset_id=checkpoint.get("offset_id") or 0, min_id=min_id,
+                since=until_date, max_messages=remaining, stop=stop
+            )
+            async for msg in history:
+                if newest_message_id is None:
+                    newest_message_id = msg.id
+                inflight_ids[seq] = msg.id
+                await queue.put((seq, msg))
+                seq += 1
+            # Parou no limite e não em min_id/since: ficam mensagens por ler entre o cursor e a mais antiga lida
+            truncated = remaining is not None and seq >= remaining
+        finally:
+            for _ in range(workers):
+                await queue.put(None)
+
+    async def mark_done(seq: int):
+        done_seqs.add(seq)
+        while watermark["seq"] in done_seqs:
+            done_seqs.discard(watermark["seq"])
+            watermark["message_id"] = inflight_ids.pop(watermark["seq"])
+            watermark["seq"] += 1
+        if not on_checkpoint or watermark["seq"] - watermark["saved"] < SCAN_CHECKPOINT_EVERY or checkpoint_lock.locked():
+            return
+        async with checkpoint_lock:
+            watermark["saved"] = watermark["seq"]
+            await on_checkpoint({
+                "offset_id": watermark["message_id"],
+                "newest_message_id": newest_message_id,
+                "failed_message_ids": sorted(failed_message_ids),
+                "messages": base_messages + watermark["seq"],
+                "tips": tips_found
+            })
+
+    async def consume():
+        nonlocal tips_found
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            seq, msg = item
+            outcome = "not_tip"
+            try:
+                tip_data = await process_message(msg, chat_id, pyro, batcher, refetcher)
+            except MessageProcessingError as e:
+                log_event(logging.WARNING, "Process", "⚠️ Mensagem falhou e será reprocessada", chat_id=chat_id, message_id=msg.id, error=str(e))
+                failed_message_ids.append(msg.id)
+                tip_data = None
+                outcome = "failed"
+            except Exception as e:
+                log_event(logging.ERROR, "Process", "❌ Erro inesperado na mensagem", chat_id=chat_id, message_id=msg.id, error=str(e))
+                failed_message_ids.append(msg.id)
+                tip_data = None
+                outcome = "failed"
+            if tip_data:
+                outcome = "tip"
+                tips_found += 1
+                if on_tip:
+                    on_tip(tip_data)
+                if keep_tips:
+                    results[seq] = tip_data
+            MESSAGES_PROCESSED.labels("collect", outcome).inc()
+            await mark_done(seq)
+
+    consumers = [asyncio.create_task(consume()) for _ in range(workers)]
+    try:
+        await produce()
+        await asyncio.gather(*consumers)
+    finally:
+        for task in consumers:
+            task.cancel()
+    collected_tips = [results[seq] for seq in sorted(results)]
+    messages = base_messages + watermark["seq"]
+    log_event(logging.INFO, "Collect", "✅ Coleta do canal terminada", chat_id=chat_id, tips=tips_found, messages=messages, failed=len(failed_message_ids))
+    if report is not None:
+        report["messages"] = messages
+        report["tips"] = tips_found
+        report["newest_message_id"] = newest_message_id
+        report["oldest_message_id"] = watermark["message_id"]
+        report["failed_message_ids"] = sorted(failed_message_ids)
+        report["truncated"] = truncated
+        report["stopped_on"] = stop.get("reason")
+        if batcher:
+            report["llm_batches"] = dict(batcher.stats)
+    return collected_tips
+
+# --- Persistência das tips (upsert em lote por (chat_id, message_id)) ---
+# Com PERSIST_TIPS=1 (ou "persist": true no pedido) as tips são gravadas pelo próprio serviço nas
+# tabelas tips e tip_entries do state_store, à medida que são encontradas: em lotes de TIPS_FLUSH_SIZE
+# e no fim de cada canal. O upsert torna a repetição idempotente. Se a gravação falhar depois das
+# tentativas, o cursor do canal não avança e a próxima coleta volta a encontrar (e gravar) as tips.
+def build_tip_rows(tips: list[dict]) -> tuple[list[dict], list[dict]]:
+    now = datetime.now(timezone.utc).isoformat()
+    tip_rows, entry_rows = {}, {}
+    for tip in tips:
+        key = (str(tip["chat_id"]), int(tip["message_id"]))
+        tip_rows[key] = {
+            "chat_id": key[0],
+            "message_id": key[1],
+            "date": tip.get("date"),
+            "type": tip.get("type"),
+            "odd": parse_odd(tip.get("odd")),
+            "text": tip.get("text"),
+            "image_url": tip.get("image_url"),
+            "tip": tip,
+            "updated_at": now
+        }
+        entry_rows[key] = {}
+        for index, entry in enumerate(tip.get("tip_entries") or []):
+            if not isinstance(entry, dict):
+                continue
+            entry_rows[key][index] = {
+                "chat_id": key[0],
+                "message_id": key[1],
+                "entry_index": index,
+                "match": entry.get("match"),
+                "tournament": entry.get("tournament"),
+                "datetime": entry.get("datetime"),
+                "market": entry.get("market"),
+                "outcome": entry.get("outcome"),
+                "individual_odd": parse_odd(entry.get("individual_odd"))
+            }
+    # Linhas repetidas no mesmo upsert dão erro no Postgres; fica a última
+    return list(tip_rows.values()), [row for rows in entry_rows.values() for row in rows.values()]
+
+# Número de entradas de cada tip (maior entry_index + 1): as linhas de tip_entries a partir daí são de
+# uma versão anterior da tip com mais entradas e são apagadas pelo upsert_tips.
+def entry_counts(tip_rows: list[dict], entry_rows: list[dict]) -> dict[tuple[str, int], int]:
+    counts = { (row["chat_id"], row["message_id"]): 0 for row in tip_rows }
+    for row in entry_rows:
+        key = (row["chat_id"], row["message_id"])
+        counts[key] = max(counts.get(key, 0), row["entry_index"] + 1)
+    return counts
+
+async def write_tips(tips: list[dict], retries: int = TIPS_WRITE_RETRIES):
+    tip_rows, entry_rows = build_tip_rows(tips)
+    for attempt in range(retries + 1):
+        try:
+            with PIPELINE_STAGE_SECONDS.labels("persist").time():
+                await asyncio.to_thread(state_store.upsert_tips, tip_rows, entry_rows)
+            TIPS_PERSISTED.inc(len(tip_rows))
+            return
+        except Exception as e:
+            if attempt >= retries:
+                TIPS_PERSIST_FAILURES.inc(len(tip_rows))
+                raise
+            delay = TIPS_WRITE_BACKOFF * 2 ** attempt
+            log_event(logging.WARNING, "Persist", "⚠️ Falha ao gravar tips; nova tentativa", tips=len(tip_rows), attempt=attempt + 1, delay=delay, error=str(e))
+            await asyncio.sleep(delay)
+
+class TipWriter:
+    def __init__(self, chat_id, flush_size: int = TIPS_FLUSH_SIZE):
+        self.chat_id = chat_id
+        self.flush_size = max(1, flush_size)
+        self.pending = []
+        self.tasks = set()
+        self.lock = asyncio.Lock()
+        self.written = 0
+        self.error = None
+
+    def add(self, tip: dict):
+        self.pending.append(tip)
+        if len(self.pending) >= self.flush_size:
+            task = asyncio.ensure_future(self.write(self.take()))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def take(self) -> list[dict]:
+        batch, self.pending = self.pending, []
+        return batch
+
+    async def write(self, tips: list[dict]):
+        async with self.lock:
+            try:
+                await write_tips(tips)
+                self.written += len(tips)
+            except Exception as e:
+                self.error = str(e)
+                log_event(logging.ERROR, "Persist", "❌ Não foi possível gravar tips", chat_id=self.chat_id, tips=len(tips), error=str(e))
+
+    async def flush(self) -> bool:
+        if self.pending:
+            await self.write(self.take())
+        await asyncio.gather(*self.tasks)
+        return self.error is None
+
+    async def close(self) -> bool:
+        return await self.flush()
+
+# --- Coleta concorrente por canal ---
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def parse_since(since_str):
+    if since_str:
+        return parser.isoparse(since_str).astimezone(timezone.utc)
+    return datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc)
+
+async def load_cursor(chat_id) -> int | None:
+    try:
+        return await asyncio.to_thread(state_store.get_cursor, chat_id)
+    except Exception as e:
+        log_event(logging.WARNING, "Cursor", "⚠️ Não foi possível ler o cursor", chat_id=chat_id, error=str(e))
+        return None
+
+# Um checkpoint só serve para retomar a mesma leitura (mesmo 'since' e mesmo cursor de partida)
+async def load_scan_checkpoint(chat_id, since: datetime, min_id: int) -> dict | None:
+    try:
+        checkpoint = await asyncio.to_thread(state_store.get_scan_checkpoint, chat_id)
+    except Exception as e:
+        log_event(logging.WARNING, "Checkpoint", "⚠️ Não foi possível ler o checkpoint", chat_id=chat_id, error=str(e))
+        return None
+    if checkpoint and checkpoint.get("since") == since.isoformat() and checkpoint.get("min_id") == min_id:
+        return checkpoint
+    return None
+
+# --- Repetição seletiva de mensagens falhadas ---
+# Uma mensagem que falha (download, upload, resposta do LLM inválida) fica em failed_messages e, nas
+# coletas seguintes do canal, só ela é pedida de novo (get_messages por id) e reprocessada, até
+# FAILED_RETRY_MAX_ATTEMPTS vezes. Assim o cursor pode avançar sem reler tudo o que veio depois dela.
+# Se não for possível registar a falha, o cursor continua a não avançar para além da mensagem.
+async def load_failed_messages(chat_id) -> dict[int, int]:
+    try:
+        return await asyncio.to_thread(state_store.get_failed_messages, chat_id, FAILED_RETRY_MAX_ATTEMPTS)
+    except Exception as e:
+        log_event(logging.WARNING, "Retry", "⚠️ Não foi possível ler as mensagens falhadas", chat_id=chat_id, error=str(e))
+        return {}
+
+# Regista as falhas (message_id -> erro) somando uma tentativa às já gravadas, venham elas de uma coleta
+# ou do live. Devolve as tentativas de cada mensagem, ou None se não foi possível registar.
+async def queue_failed_messages(chat_id, failures: dict[int, str | None]) -> dict[int, int] | None:
+    if not failures:
+        return {}
+    try:
+        current = await asyncio.to_thread(state_store.get_failed_attempts, chat_id, sorted(failures))
+        attempts = { message_id: current.get(message_id, 0) + 1 for message_id in failures }
+        await asyncio.to_thread(state_store.record_failed_messages, chat_id, [
+            { "message_id": message_id, "attempts": attempts[message_id], "error": error } for message_id, error in failures.items()
+        ])
+        return attempts
+    except Exception as e:
+        log_event(logging.WARNING, "Retry", "⚠️ Não foi possível registar as mensagens falhadas", chat_id=chat_id, error=str(e))
+        return None
+
+async def retry_failed_messages(chat_id, attempts: dict[int, int], on_tip=None) -> tuple[list[dict], dict]:
+    pyro = await telegram_pool.client_for(chat_id)
+    refetcher = MediaRefetcher(pyro, chat_id)
+    ids = sorted(attempts, reverse=True)
+    found = {}
+    # get_messages aceita até 200 ids por pedido
+    for start in range(0, len(ids), 200):
+        messages = await pyro.safe_call(pyro.get_messages, chat_id, ids[start:start + 200])
+        found.update({ m.id: m for m in messages if m and not getattr(m, "empty", False) })
+
+    async def retry(message_id: int):
+        msg = found.get(message_id)
+        if msg is None:
+            return message_id, None, None
+        try:
+            return message_id, await process_message(msg, chat_id, pyro, refetcher=refetcher), None
+        except Exception as e:
+            return message_id, None, str(e)
+
+    tips = []
+    outcome = { "recovered": [], "missing": [], "failed": {} }
+    for message_id, tip_data, error in await asyncio.gather(*(retry(message_id) for message_id in ids)):
+        if error:
+            outcome["failed"][message_id] = error
+        elif message_id not in found:
+            outcome["missing"].append(message_id)
+        else:
+            outcome["recovered"].append(message_id)
+            if tip_data:
+                tips.append(tip_data)
+                if on_tip:
+                    on_tip(tip_data)
+    for name in ("recovered", "missing", "failed"):
+        FAILED_MESSAGE_RETRIES.labels(name).inc(len(outcome[name]))
+    log_event(logging.INFO, "Retry", "🔁 Mensagens falhadas repetidas", chat_id=chat_id, recovered=len(outcome["recovered"]), missing=len(outcome["missing"]), failed=len(outcome["failed"]), tips=len(tips))
+    return tips, outcome
+
+# Falhas desta coleta que não ficaram registadas para repetição
+def unqueued_failures(report: dict) -> set[int]:
+    return set(report.get("failed_message_ids") or []) - set(report.get("retry_queued") or [])
+
+async def advance_cursor(chat_id, cursor, report: dict):
+    # Uma leitura cortada por max_messages não chegou ao cursor: avançar para newest saltaria as
+    # mensagens entre o cursor e a mais antiga lida, por isso o cursor fica onde está.
+    if report.get("truncated"):
+        log_event(logging.WARNING, "Cursor", "⚠️ Leitura cortada pelo limite de mensagens, cursor mantido", chat_id=chat_id, cursor=cursor, oldest_message_id=report.get("oldest_message_id"))
+        return
+    # O backfill ignora o cursor, e uma leitura que parou em 'since' acima do cursor também não chegou
+    # a ele: em ambos os casos avançar saltaria as mensagens por ler entre o cursor e a mais antiga lida.
+    if report.get("mode") == "backfill":
+        return
+    if cursor and report.get("stopped_on") == "since":
+        log_event(logging.WARNING, "Cursor", "⚠️ Leitura parou em 'since' antes do cursor, cursor mantido", chat_id=chat_id, cursor=cursor, oldest_message_id=report.get("oldest_message_id"))
+        return
+    # Não avança para além da mensagem mais antiga que falhou sem ficar registada, para que seja reprocessada.
+    newest = report.get("newest_message_id")
+    failed = unqueued_failures(report)
+    target = min(failed) - 1 if failed else newest
+    if not target or target <= (cursor or 0):
+        return
+    try:
+        await asyncio.to_thread(state_store.set_cursor, chat_id, target)
+        report["cursor"] = target
+        log_event(logging.INFO, "Cursor", "✅ Cursor avançado", chat_id=chat_id, cursor=target)
+    except Exception as e:
+        log_event(logging.WARNING, "Cursor", "⚠️ Não foi possível gravar o cursor", chat_id=chat_id, error=str(e))
+
+# Repete as mensagens que falharam em coletas anteriores e regista as falhas (novas e repetidas).
+# As tips recuperadas vão para on_tip e, se 'tips' não for None, para a lista devolvida.
+async def retry_and_queue_failures(chat_id, retry_attempts: dict[int, int], report: dict, tips: list | None, on_tip):
+    failed = set(report.get("failed_message_ids") or [])
+    failures = { message_id: None for message_id in failed }
+    # As mensagens que a própria leitura já cobriu não são repetidas
+    newest, oldest = report.get("newest_message_id"), report.get("oldest_message_id")
+    scanned = { message_id for message_id in retry_attempts if newest and oldest and oldest <= message_id <= newest }
+    resolved = sorted(scanned - failed)
+    retry_attempts = { message_id: attempts for message_id, attempts in retry_attempts.items() if message_id not in scanned }
+    if retry_attempts:
+        try:
+            retried, outcome = await retry_failed_messages(chat_id, retry_attempts, on_tip)
+            if tips is not None:
+                tips.extend(retried)
+            report["tips"] = report.get("tips", 0) + len(retried)
+            report["retried"] = { "recovered": len(outcome["recovered"]), "missing": len(outcome["missing"]), "failed": len(outcome["failed"]) }
+            resolved += outcome["recovered"] + outcome["missing"]
+            failures.update(outcome["failed"])
+        except Exception as e:
+            log_event(logging.WARNING, "Retry", "⚠️ Repetição das mensagens falhadas falhou", chat_id=chat_id, error=str(e))
+    if resolved:
+        try:
+            await asyncio.to_thread(state_store.delete_failed_messages, chat_id, resolved)
+        except Exception as e:
+            log_event(logging.WARNING, "Retry", "⚠️ Não foi possível limpar as mensagens recuperadas", chat_id=chat_id, error=str(e))
+    attempts = await queue_failed_messages(chat_id, failures)
+    if attempts is not None:
+        report["retry_queued"] = sorted(message_id for message_id, count in attempts.items() if count < FAILED_RETRY_MAX_ATTEMPTS)
+        exhausted = sorted(message_id for message_id, count in attempts.items() if count >= FAILED_RETRY_MAX_ATTEMPTS)
+        if exhausted:
+            report["retry_exhausted"] = exhausted
+            log_event(logging.WARNING, "Retry", "⚠️ Mensagens sem mais tentativas", chat_id=chat_id, message_ids=exhausted)
+
+# Modo normal: lê só mensagens mais recentes que o cursor do canal (o 'since' explícito,
+# se existir, continua a ser respeitado). Modo backfill: ignora o cursor e lê desde 'since'.
+# Com persistência ativa a leitura grava checkpoints (depois de gravar as tips até esse ponto) e uma
+# coleta interrompida (restart, erro, lease perdida) é retomada do último checkpoint.
+async def collect_channel(channel: dict, semaphore: asyncio.Semaphore, backfill: bool = False, llm_batch_size: int = None, on_tip=None, on_channel=None, persist: bool = PERSIST_TIPS, max_messages: int = None, keep_tips: bool = True):
+    chat_id = channel.get("chat_id")
+    backfill = bool(channel.get("backfill", backfill))
+    report = { "chat_id": chat_id, "success": False, "tips": 0, "mode": "backfill" if backfill else "incremental" }
+    if llm_batch_size is None:
+        llm_batch_size = LLM_BACKFILL_BATCH_SIZE if backfill else LLM_BATCH_SIZE
+    queued_at = time.monotonic()
+    try:
+        since = parse_since(channel.get("since"))
+    except Exception as e:
+        log_event(logging.WARNING, "Collect", "⚠️ Erro ao interpretar 'since'", chat_id=chat_id, error=str(e))
+        report["error"] = f"Invalid since: {e}"
+        return [], report
+    # O limite só se aplica ao backfill: a coleta incremental tem de chegar ao cursor
+    try:
+        # 0 é um valor explícito (e inválido), não "sem valor"
+        value = channel.get("max_messages")
+        if value is None:
+            value = max_messages if max_messages is not None else BACKFILL_MAX_MESSAGES
+        max_messages = int(value)
+        if max_messages < 1:
+            raise ValueError("must be positive")
+    except (TypeError, ValueError) as e:
+        log_event(logging.WARNING, "Collect", "⚠️ Erro ao interpretar 'max_messages'", chat_id=chat_id, error=str(e))
+        report["error"] = f"Invalid max_messages: {e}"
+        return [], report
+    if not backfill:
+        max_messages = None
+    async with semaphore:
+        started_at = time.monotonic()
+        report["queued_seconds"] = round(started_at - queued_at, 3)
+        cursor = None if backfill else await load_cursor(chat_id)
+        if cursor and not channel.get("since"):
+            since = EPOCH
+        report["previous_cursor"] = cursor
+        retry_attempts = await load_failed_messages(chat_id)
+        checkpoint = await load_scan_checkpoint(chat_id, since, cursor or 0) if persist else None
+        if checkpoint:
+            report["resumed_from"] = checkpoint["offset_id"]
+        log_event(logging.INFO, "Collect", "▶️ Iniciando coleta", chat_id=chat_id, since=since.isoformat(), cursor=cursor, mode=report["mode"], resumed_from=report.get("resumed_from"))
+        writer = TipWriter(chat_id) if persist else None
+
+        def handle_tip(tip: dict):
+            if writer:
+                writer.add(tip)
+            if on_tip:
+                on_tip(tip)
+
+        async def save_checkpoint(state: dict):
+            if not await writer.flush():
+                return
+            try:
+                await asyncio.to_thread(state_store.set_scan_checkpoint, chat_id, { **state, "since": since.isoformat(), "min_id": cursor or 0 })
+            except Exception as e:
+                log_event(logging.WARNING, "Checkpoint", "⚠️ Não foi possível gravar o checkpoint", chat_id=chat_id, error=str(e))
+
+        try:
+            tips = await collect_tips_until_date(
+                chat_id, since, max_messages=max_messages, min_id=cursor or 0, report=report, llm_batch_size=llm_batch_size,
+                on_tip=handle_tip, keep_tips=keep_tips, checkpoint=checkpoint, on_checkpoint=save_checkpoint if writer else None
+            )
+            report["success"] = True
+        except Exception as e:
+            log_event(logging.ERROR, "Collect", "❌ Erro ao coletar tips", chat_id=chat_id, error=str(e))
+            report["error"] = str(e)
+            tips = []
+        await retry_and_queue_failures(chat_id, retry_attempts, report, tips if keep_tips else None, handle_tip)
+        persisted = True
+        if writer:
+            persisted = await writer.close()
+            report["persisted"] = writer.written
+            if not persisted:
+                report["persist_error"] = writer.error
+        if report["success"] and persisted:
+            await advance_cursor(chat_id, cursor, report)
+            if writer:
+                try:
+                    await asyncio.to_thread(state_store.delete_scan_checkpoint, chat_id)
+                except Exception as e:
+                    log_event(logging.WARNING, "Checkpoint", "⚠️ Não foi possível apagar o checkpoint", chat_id=chat_id, error=str(e))
+            if not backfill and not unqueued_failures(report):
+                live_stalled_channels.discard(str(chat_id))
+        report["elapsed_seconds"] = round(time.monotonic() - started_at, 3)
+    if on_channel:
+        on_channel(report)
+    return tips, report
+
+async def run_collection(channels: list[dict], concurrency: int = COLLECT_CONCURRENCY, backfill: bool = False, llm_batch_size: int = None, on_tip=None, on_channel=None, persist: bool = PERSIST_TIPS, max_messages: int = None):
+    concurrency = max(1, min(concurrency, COLLECT_MAX_CONCURRENCY))
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(
+        collect_channel(channel, semaphore, backfill, llm_batch_size, on_tip, on_channel, persist, max_messages) for channel in channels
+    ))
+    collected_tips = [tip for tips, _ in results for tip in tips]
+    reports = [report for _, report in results]
+    return collected_tips, reports
+
+def parse_collect_options(payload: dict) -> dict:
+    return {
+        "concurrency": int(payload.get("concurrency") or COLLECT_CONCURRENCY),
+        "backfill": payload.get("mode") == "backfill" or bool(payload.get("backfill")),
+        "llm_batch_size": int(payload["llm_batch_size"]) if payload.get("llm_batch_size") else None,
+        "persist": bool(payload["persist"]) if "persist" in payload else PERSIST_TIPS,
+        "max_messages": int(payload["max_messages"]) if payload.get("max_messages") is not None else None
+    }
+
+# --- Jobs de coleta em background ---
+# POST /collect-tips/jobs devolve um job_id; os jobs correm numa fila interna com COLLECT_JOB_WORKERS workers.
+# As tips ficam disponíveis à medida que são encontradas (polling com offset ou stream NDJSON/SSE)
+# e o job é mantido até ser lido por completo (mais COLLECT_JOB_FETCHED_TTL segundos).
+class CollectJob:
+    def __init__(self, channels: list[dict], options: dict):
+        self.id = uuid.uuid4().hex
+        self.channels = channels
+        self.options = options
+        self.status = "queued"
+        self.created_at = datetime.now(timezone.utc)
+        self.started_at = None
+        self.finished_at = None
+        self.fetched_at = None
+        self.error = None
+        self.tips = []
+        self.reports = []
+        self.events = []
+        self.task = None
+        self.changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "failed", "cancelled")
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def add_tip(self, tip: dict):
+        self.tips.append(tip)
+        self.events.append({ "type": "tip", "tip": tip })
+        self.notify()
+
+    def add_channel(self, report: dict):
+        self.reports.append(report)
+        self.events.append({ "type": "channel", "channel": report })
+        self.notify()
+
+    def finish(self, status: str, error: str = None):
+        self.status = status
+        self.error = error
+        self.finished_at = datetime.now(timezone.utc)
+        self.events.append({ "type": "status", **self.summary() })
+        self.notify()
+
+    def summary(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "channels_total": len(self.channels),
+            "channels_done": len(self.reports),
+            "tips_found": len(self.tips),
+            "error": self.error
+        }
+
+collect_jobs: dict[str, CollectJob] = {}
+collect_job_queue: asyncio.Queue = asyncio.Queue()
+collect_job_workers: list[asyncio.Task] = []
+
+async def run_collect_job(job: CollectJob):
+    job.status = "running"
+    job.started_at = datetime.now(timezone.utc)
+    job.notify()
+    log_event(logging.INFO, "Jobs", "▶️ Job iniciado", job_id=job.id, channels=len(job.channels))
+    job.task = asyncio.create_task(run_collection(
+        job.channels,
+        job.options["concurrency"],
+        job.options["backfill"],
+        job.options["llm_batch_size"],
+        on_tip=job.add_tip,
+        on_channel=job.add_channel,
+        persist=job.options["persist"],
+        max_messages=job.options["max_messages"]
+    ))
+    try:
+        await job.task
+        job.finish("completed")
+        log_event(logging.INFO, "Jobs", "✅ Job terminado", job_id=job.id, tips=len(job.tips))
+    except asyncio.CancelledError:
+        job.finish("cancelled")
+        log_event(logging.INFO, "Jobs", "🛑 Job cancelado", job_id=job.id, tips=len(job.tips))
+        # Se foi o próprio worker a ser cancelado (shutdown), propaga
+        if asyncio.current_task().cancelling():
+            raise
+    except Exception as e:
+        job.finish("failed", str(e))
+        log_event(logging.ERROR, "Jobs", "❌ Job falhou", job_id=job.id, error=str(e))
+
+# Sem jobs novos, os workers acordam a cada COLLECT_JOB_PRUNE_INTERVAL segundos para limpar os
+# jobs expirados, para que um serviço parado não os mantenha em memória
+async def collect_job_worker():
+    while True:
+        prune_collect_jobs()
+        try:
+            job = await asyncio.wait_for(collect_job_queue.get(), COLLECT_JOB_PRUNE_INTERVAL)
+        except asyncio.TimeoutError:
+            continue
+        if job.status == "queued":
+            await run_collect_job(job)
+
+def start_collect_job_workers():
+    for _ in range(COLLECT_JOB_WORKERS):
+        collect_job_workers.append(asyncio.create_task(collect_job_worker()))
+
+async def stop_collect_job_workers():
+    for task in collect_job_workers:
+        task.cancel()
+    await asyncio.gather(*collect_job_workers, return_exceptions=True)
+    collect_job_workers.clear()
+
+def prune_collect_jobs():
+    now = datetime.now(timezone.utc)
+    for job_id, job in list(collect_jobs.items()):
+        if not job.finished:
+            continue
+        if job.fetched_at and (now - job.fetched_at).total_seconds() > COLLECT_JOB_FETCHED_TTL:
+            del collect_jobs[job_id]
+        elif (now - job.finished_at).total_seconds() > COLLECT_JOB_UNFETCHED_TTL:
+            del collect_jobs[job_id]
+
+def cancel_collect_job(job: CollectJob):
+    if job.status == "queued":
+        job.finish("cancelled")
+    elif job.status == "running" and job.task:
+        job.task.cancel()
+
+async def stream_collect_job(job: CollectJob, sse: bool):
+    index = 0
+    while True:
+        changed = job.changed
+        while index < len(job.events):
+            event = job.events[index]
+            index += 1
+            data = json.dumps(event, default=str)
+            yield f"event: {event['type']}\ndata: {data}\n\n" if sse else f"{data}\n"
+        if job.finished:
+            job.fetched_at = job.fetched_at or datetime.now(timezone.utc)
+            return
+        await changed.wait()
+
+# --- Fila partilhada e workers (COLLECT_QUEUE=shared, WORKER_MODE=1) ---
+# Com COLLECT_QUEUE=shared, POST /collect-tips/jobs grava uma task por canal em collect_tasks (state store)
+# em vez de usar a fila em memória, e qualquer réplica responde ao estado do job. Os processos com
+# WORKER_MODE=1 correm WORKER_CONCURRENCY loops que pedem uma task de cada vez: a task fica com lease
+# (WORKER_LEASE_SECONDS) renovada por heartbeat, e nenhum canal tem duas leases ativas em simultâneo.
+# Se um worker morre, a lease expira e a task volta a ser entregue (até WORKER_MAX_ATTEMPTS leases).
+# Se o heartbeat deixa de conseguir renovar, a coleta é cancelada antes que outro worker pegue no canal.
+# As tips dos jobs partilhados são sempre gravadas (tabelas tips/tip_entries); o job só devolve os reports.
+# Por isso um pedido com "concurrency" ou "persist": false é recusado com 400 neste modo.
+queue_workers: list[asyncio.Task] = []
+
+def enqueue_shared_job(channels: list[dict], options: dict) -> str:
+    job_id = uuid.uuid4().hex
+    now = datetime.now(timezone.utc).isoformat()
+    task_options = { "backfill": options["backfill"], "llm_batch_size": options["llm_batch_size"], "max_messages": options["max_messages"] }
+    tasks = [
+        {
+            "task_id": uuid.uuid4().hex,
+            "job_id": job_id,
+            "chat_id": str(channel.get("chat_id")),
+            "channel": channel,
+            "options": task_options,
+            "status": "queued",
+            "created_at": now,
+            "updated_at": now
+        }
+        for channel in channels
+    ]
+    state_store.enqueue_tasks(tasks)
+    return job_id
+
+def shared_job_summary(job_id: str, tasks: list[dict]) -> dict:
+    counts = Counter(task["status"] for task in tasks)
+    finished = counts["done"] + counts["failed"] + counts["cancelled"]
+    if finished == len(tasks):
+        status = "cancelled" if counts["cancelled"] == len(tasks) else "completed"
+    elif counts["leased"] or finished:
+        status = "running"
+    else:
+        status = "queued"
+    reports = [task["report"] or { "chat_id": task["chat_id"], "success": False, "error": task["error"] } for task in tasks if task["status"] in ("done", "failed")]
+    return {
+        "job_id": job_id,
+        "status": status,
+        "queue": "shared",
+        "created_at": tasks[0]["created_at"],
+        "channels_total": len(tasks),
+        "channels_done": counts["done"] + counts["failed"],
+        "tips_found": sum(report.get("tips", 0) for report in reports),
+        "tasks": dict(counts),
+        "channels": reports
+    }
+
+async def heartbeat_task_lease(task: dict, collect: asyncio.Task):
+    renewed_at = time.monotonic()
+    while True:
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+        try:
+            renewed = await asyncio.to_thread(state_store.renew_task, task["task_id"], WORKER_ID, WORKER_LEASE_SECONDS)
+        except Exception as e:
+            log_event(logging.WARNING, "Worker", "⚠️ Falha ao renovar lease", task_id=task["task_id"], error=str(e))
+            # Sem renovação durante uma lease inteira outro worker pode já ter a task
+            renewed = time.monotonic() - renewed_at < WORKER_LEASE_SECONDS - WORKER_HEARTBEAT_INTERVAL
+            if renewed:
+                continue
+        if not renewed:
+            log_event(logging.WARNING, "Worker", "🛑 Lease perdida; coleta cancelada", task_id=task["task_id"], chat_id=task["chat_id"])
+            collect.cancel()
+            return
+        renewed_at = time.monotonic()
+
+async def run_queue_task(task: dict, semaphore: asyncio.Semaphore):
+    options = task["options"] or {}
+    log_event(logging.INFO, "Worker", "▶️ Task com lease", task_id=task["task_id"], job_id=task["job_id"], chat_id=task["chat_id"], attempt=task["attempts"])
+    collect = asyncio.create_task(collect_channel(
+        task["channel"], semaphore, bool(options.get("backfill")), options.get("llm_batch_size"),
+        persist=True, max_messages=options.get("max_messages"), keep_tips=False
+    ))
+    heartbeat = asyncio.create_task(heartbeat_task_lease(task, collect))
+    try:
+        _, report = await collect
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            # Shutdown: devolve a task à fila para outro worker, sem gastar a tentativa que o claim contou
+            collect.cancel()
+            await asyncio.to_thread(state_store.release_task, task["task_id"], WORKER_ID, max(0, task["attempts"] - 1))
+            QUEUE_TASKS.labels("released").inc()
+            raise
+        QUEUE_TASKS.labels("lease_lost").inc()
+        return
+    finally:
+        heartbeat.cancel()
+    status = "done" if report["success"] else "failed"
+    try:
+        finished = await asyncio.to_thread(state_store.finish_task, task["task_id"], WORKER_ID, status, report, report.get("error"))
+    except Exception as e:
+        # A lease expira e a task volta a ser entregue
+        log_event(logging.ERROR, "Worker", "❌ Não foi possível fechar a task", task_id=task["task_id"], error=str(e))
+        return
+    QUEUE_TASKS.labels(status if finished else "lease_lost").inc()
+    log_event(logging.INFO, "Worker", "✅ Task terminada", task_id=task["task_id"], chat_id=task["chat_id"], status=status, tips=report.get("tips"))
+
+async def queue_worker(semaphore: asyncio.Semaphore):
+    while True:
+        try:
+            task = await asyncio.to_thread(state_store.claim_task, WORKER_ID, WORKER_LEASE_SECONDS, WORKER_MAX_ATTEMPTS)
+        except Exception as e:
+            log_event(logging.WARNING, "Worker", "⚠️ Não foi possível pedir uma task", error=str(e))
+            task = None
+        if not task:
+            await asyncio.sleep(WORKER_POLL_INTERVAL)
+            continue
+        await run_queue_task(task, semaphore)
+
+def start_queue_workers():
+    semaphore = asyncio.Semaphore(max(1, WORKER_CONCURRENCY))
+    for _ in range(max(1, WORKER_CONCURRENCY)):
+        queue_workers.append(asyncio.create_task(queue_worker(semaphore)))
+    log_event(logging.INFO, "Worker", "👷 Worker ativo", worker_id=WORKER_ID, concurrency=WORKER_CONCURRENCY, lease_seconds=WORKER_LEASE_SECONDS)
+
+async def stop_queue_workers():
+    for task in queue_workers:
+        task.cancel()
+    await asyncio.gather(*queue_workers, return_exceptions=True)
+    queue_workers.clear()
+
+# --- Ingestão em tempo real (LIVE_MODE=1) ---
+# O cliente recebe updates e cada nova mensagem de um canal registado passa pelo mesmo process_message.
+# As mensagens de um canal são processadas por ordem (um lock por canal); canais diferentes em paralelo.
+# As tips detetadas vão para os sinks configurados em LIVE_SINK (memory, supabase, webhook).
+live_channels: dict[int, str] = {}
+live_channel_locks: dict[int, asyncio.Lock] = {}
+live_stalled_channels: set[str] = set()
+live_tasks: set[asyncio.Task] = set()
+live_tips_queue: asyncio.Queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+live_stats = { "received": 0, "processed": 0, "tips": 0, "failed": 0, "sink_errors": 0 }
+
+async def register_live_channel(chat_id: str) -> dict:
+    pyro = telegram_pool.primary
+    chat = await pyro.safe_call(pyro.get_chat, chat_id)
+    live_channels[chat.id] = str(chat_id)
+    live_channel_locks.setdefault(chat.id, asyncio.Lock())
+    log_event(logging.INFO, "Live", "✅ Canal registado", chat_id=chat_id, peer_id=chat.id)
+    return { "chat_id": str(chat_id), "peer_id": chat.id, "title": chat.title }
+
+def unregister_live_channel(chat_id: str) -> bool:
+    for peer_id, identifier in list(live_channels.items()):
+        if identifier == str(chat_id) or str(peer_id) == str(chat_id):
+            del live_channels[peer_id]
+            live_channel_locks.pop(peer_id, None)
+            return True
+    return False
+
+async def emit_live_tip(tip: dict):
+    for sink in LIVE_SINKS:
+        try:
+            if sink == "memory":
+                if live_tips_queue.full():
+                    live_tips_queue.get_nowait()
+                live_tips_queue.put_nowait(tip)
+            elif sink == "supabase":
+                await write_tips([tip])
+            elif sink == "webhook" and LIVE_WEBHOOK_URL:
+                headers = { "Authorization": f"Bearer {LIVE_WEBHOOK_SECRET}" } if LIVE_WEBHOOK_SECRET else {}
+                response = await http_client.post(LIVE_WEBHOOK_URL, json=tip, headers=headers)
+                response.raise_for_status()
+        except Exception as e:
+            live_stats["sink_errors"] += 1
+            log_event(logging.ERROR, "Live", "❌ Falha ao enviar tip para o sink", sink=sink, chat_id=tip.get("chat_id"), message_id=tip.get("message_id"), error=str(e))
+
+# O cursor só avança quando a mensagem é a seguinte ao cursor gravado. Mensagens publicadas entre a
+# última coleta e o arranque do live, ou perdidas durante uma desconexão, deixam um buraco: o cursor
+# fica onde está e a próxima coleta incremental lê-as. Assim o live também nunca recua um cursor
+# que uma coleta já tenha avançado.
+async def advance_live_cursor(chat_id: str, message_id: int):
+    try:
+        cursor = await asyncio.to_thread(state_store.get_cursor, chat_id)
+        if cursor is None or message_id != cursor + 1:
+            return
+        await asyncio.to_thread(state_store.set_cursor, chat_id, message_id)
+    except Exception as e:
+        log_event(logging.WARNING, "Cursor", "⚠️ Não foi possível gravar o cursor", chat_id=chat_id, error=str(e))
+
+async def process_live_message(msg, chat_id: str):
+    telegram_priority.set(PRIORITY_INTERACTIVE)
+    async with live_channel_locks.setdefault(msg.chat.id, asyncio.Lock()):
+        try:
+            tip_data = await process_message(msg, chat_id, telegram_pool.primary)
+        except Exception as e:
+            # A mensagem fica para a próxima coleta repetir; se nem isso for possível, o cursor
+            # deixa de avançar até uma coleta incremental a reprocessar
+            live_stats["failed"] += 1
+            MESSAGES_PROCESSED.labels("live", "failed").inc()
+            log_event(logging.WARNING, "Live", "⚠️ Mensagem falhou", chat_id=chat_id, message_id=msg.id, error=str(e))
+            if await queue_failed_messages(chat_id, { msg.id: str(e) }) is None:
+                live_stalled_channels.add(chat_id)
+                return
+            tip_data = None
+        else:
+            live_stats["processed"] += 1
+            MESSAGES_PROCESSED.labels("live", "tip" if tip_data else "not_tip").inc()
+        if tip_data:
+            live_stats["tips"] += 1
+            await emit_live_tip(tip_data)
+        # Num grupo básico os ids são da conta e não do chat (não são contíguos): o cursor nunca
+        # avançaria por aqui e fica a cargo da coleta incremental.
+        if chat_id not in live_stalled_channels and msg.chat.type != ChatType.GROUP:
+            await advance_live_cursor(chat_id, msg.id)
+
+async def on_live_message(client, msg):
+    chat_id = live_channels.get(msg.chat.id) if msg.chat else None
+    if chat_id is None:
+        return
+    live_stats["received"] += 1
+    # Não bloqueia o dispatcher do Pyrogram enquanto a mensagem é analisada
+    task = asyncio.create_task(process_live_message(msg, chat_id))
+    live_tasks.add(task)
+    task.add_done_callback(live_tasks.discard)
+
+async def start_live_mode():
+    telegram_pool.primary.add_handler(MessageHandler(on_live_message, filters.channel | filters.group))
+    for chat_id in LIVE_CHANNELS:
+        try:
+            await register_live_channel(chat_id)
+        except Exception as e:
+            log_event(logging.ERROR, "Live", "❌ Não foi possível registar o canal", chat_id=chat_id, error=str(e))
+    log_event(logging.INFO, "Live", "📡 Modo live ativo", channels=len(live_channels), sinks=",".join(LIVE_SINKS))
+
+# --- Metadados de canais (cache com TTL e avatares por big_file_id) ---
+# Os metadados de cada canal ficam em memória durante CHANNEL_INFO_TTL segundos. O avatar é guardado
+# no storage com um nome fixo derivado do id único da foto (big_photo_unique_id, ou big_file_id):
+# uma foto que não mudou nunca é descarregada nem enviada de novo, mesmo depois de um restart
+# (um HEAD ao URL público confirma que o objeto já existe).
+class TTLCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.stats = { "hits": 0, "misses": 0, "inflight_hits": 0 }
+
+    async def get_or_compute(self, key: str, compute, refresh: bool = False):
+        entry = self.entries.get(key)
+        if entry and not refresh and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+        task = self.inflight.get(key)
+        if task is not None:
+            self.stats["inflight_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.ensure_future(compute())
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        value = await asyncio.shield(task)
+        if value is not None:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return value
+
+    def snapshot(self) -> dict:
+        return { **self.stats, "size": len(self.entries), "inflight": len(self.inflight) }
+
+channel_info_cache = TTLCache(CHANNEL_INFO_CACHE_SIZE, CHANNEL_INFO_TTL)
+avatar_cache = TTLCache(CHANNEL_INFO_CACHE_SIZE, 30 * 24 * 3600)
+avatar_stats = { "uploads": 0, "reused_from_storage": 0 }
+
+async def storage_object_exists(url: str) -> bool:
+    try:
+        response = await http_client.head(url)
+        return response.status_code == 200
+    except Exception:
+        return False
+
+async def fetch_avatar_url(pyro, chat) -> str | None:
+    photo_key = getattr(chat.photo, "big_photo_unique_id", None) or chat.photo.big_file_id
+    file_name = f"avatars/{chat.id}_{hashlib.sha256(photo_key.encode('utf-8')).hexdigest()[:16]}.jpeg"
+
+    async def compute():
+        url = storage_public_url(file_name)
+        if await storage_object_exists(url):
+            avatar_stats["reused_from_storage"] += 1
+            return url
+        buffer = await safe_download_media(pyro, chat.photo.big_file_id, in_memory=True)
+        if buffer is None:
+            return None
+        # Um avatar que não se consegue converter ou enviar fica sem URL, mas os metadados do canal seguem
+        try:
+            image_bytes = await asyncio.to_thread(encode_image_jpeg, buffer)
+            avatar_stats["uploads"] += 1
+            return await upload_image_bytes_to_supabase(image_bytes, str(chat.id), file_name=file_name)
+        except Exception as e:
+            log_event(logging.WARNING, "Media", "⚠️ Avatar não disponível", chat_id=chat.id, error=str(e))
+            return None
+
+    return await avatar_cache.get_or_compute(photo_key, compute)
+
+async def fetch_channel_info(chat_id, refresh: bool = False) -> dict:
+    async def compute():
+        pyro = await telegram_pool.client_for(chat_id)
+        chat = await pyro.safe_call(pyro.get_chat, chat_id)
+        return {
+            "chat_id": chat_id,
+            "title": chat.title,
+            "username": chat.username,
+            "type": chat.type,
+            "members": getattr(chat, "members_count", None),
+            "description": getattr(chat, "bio", None) or getattr(chat, "description", None),
+            "photo_url": await fetch_avatar_url(pyro, chat) if chat.photo else None,
+            "invite_link": chat.invite_link
+        }
+
+    return dict(await channel_info_cache.get_or_compute(str(chat_id), compute, refresh))
+
+async def fetch_channels_info(chat_ids: list, concurrency: int = CHANNEL_INFO_CONCURRENCY, refresh: bool = False) -> list[dict]:
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def fetch(chat_id) -> dict:
+        async with semaphore:
+            try:
+                return { "chat_id": chat_id, "success": True, "info": await fetch_channel_info(chat_id, refresh) }
+            except Exception as e:
+                return { "chat_id": chat_id, "success": False, "error": str(e) }
+
+    return await asyncio.gather(*(fetch(chat_id) for chat_id in chat_ids))
+
+@app.post("/test-connection")
+async def test_connection(request: Request):
+    auth_check(request)
+    return { "success": True }
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    auth_check(request)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/cache-stats")
+async def cache_stats(request: Request):
+    auth_check(request)
+    return { "success": True, "classification_cache": classification_cache.snapshot() }
+
+@app.get("/telegram-stats")
+async def telegram_stats(request: Request):
+    auth_check(request)
+    return {
+        "success": True,
+        "scheduler": telegram_pool.primary.scheduler.snapshot(),
+        "pool": telegram_pool.snapshot(),
+        "media": media_stats,
+        "channel_info_cache": channel_info_cache.snapshot(),
+        "avatars": { **avatar_stats, **avatar_cache.snapshot() }
+    }
+
+@app.get("/prefilter-stats")
+async def prefilter_stats(request: Request):
+    auth_check(request)
+    return { "success": True, "prefilter": prefilter.snapshot() }
+
+@app.post("/test-channel-message", summary="Testar se o canal pode ser acedido e devolver a última mensagem", tags=["Telegram"])
+async def test_channel_message(request: Request, body: dict = Body(...), authorization: str = Header(None, description="Bearer token da API")):
+    log_request(request, body)
+    auth_check(request)
+    telegram_priority.set(PRIORITY_INTERACTIVE)
+    chat_id = body.get("chat_id")
+    if not chat_id:
+        return JSONResponse(status_code=400, content={"error": "Missing chat_id"})
+    try:
+        pyro = await telegram_pool.client_for(chat_id)
+        try:
+            messages = await safe_get_chat_history(pyro, chat_id, limit=1)
+        except Exception as fetch_error:
+            return {
                 "success": False,
                 "error": f"Não foi possível aceder ao canal: {str(fetch_error)}",
                 "reason": "Canal pode ser privado, não acessível ou com permissões limitadas"
@@ -486,8 +3338,11 @@ async def test_channel_message(request: Request, body: dict = Body(...), authori
                 last_message["content"] = msg.text
             elif msg.photo:
                 try:
-                    file_path = await app.safe_call(app.download_media, msg.photo)
-                    photo_url = upload_image_to_supabase(file_path, f"lastmsg_{msg.id}")
+                    buffer = await safe_download_media(pyro, msg, in_memory=True)
+                    if buffer is None:
+                        raise RuntimeError("Media download failed")
+                    image_bytes = await asyncio.to_thread(encode_image_jpeg, buffer)
+                    photo_url = await upload_image_bytes_to_supabase(image_bytes, f"lastmsg_{msg.id}")
                     last_message["type"] = "photo"
                     last_message["content"] = photo_url
                 except Exception as e:
@@ -517,32 +3372,40 @@ async def get_channel_info(request: Request, payload: dict = Body(...), authoriz
     log_request(request, payload)
     if not is_authorized(authorization):
         return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    telegram_priority.set(PRIORITY_INTERACTIVE)
     chat_id = payload.get("chat_id")
     if not chat_id:
         return JSONResponse(status_code=400, content={"error": "Missing chat_id"})
     try:
-        pyro = telegram_client
-        chat = await pyro.safe_call(pyro.get_chat, chat_id)
-        
-        photo_url = None
-        if chat.photo:
-            file_id = chat.photo.big_file_id
-            file_path = await pyro.safe_call(pyro.download_media, file_id, file_name=f"{chat.id}_profile.jpg")
-            photo_url = upload_image_to_supabase(file_path, chat.id)
-        info = {
-            "chat_id": chat_id,
-            "title": chat.title,
-            "username": chat.username,
-            "type": chat.type,
-            "members": getattr(chat, "members_count", None),
-            "description": getattr(chat, "bio", None) or getattr(chat, "description", None),
-            "photo_url": photo_url,
-            "invite_link": chat.invite_link
-        }
+        info = await fetch_channel_info(chat_id, bool(payload.get("refresh")))
         return {"success": True, "info": info}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+@app.post("/get-channels-info")
+async def get_channels_info(request: Request, payload: dict = Body(...), authorization: str = Header(None)):
+    log_request(request, payload)
+    if not is_authorized(authorization):
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    telegram_priority.set(PRIORITY_INTERACTIVE)
+    # Os ids mantêm o tipo recebido: para o Pyrogram um id numérico em string é um número de telefone
+    chat_ids = list(dict.fromkeys(payload.get("chat_ids") or []))
+    if not chat_ids:
+        return JSONResponse(status_code=400, content={"error": "Missing chat_ids"})
+    if len(chat_ids) > CHANNEL_INFO_MAX_IDS:
+        return JSONResponse(status_code=400, content={"error": f"Too many chat_ids (max {CHANNEL_INFO_MAX_IDS})"})
+    try:
+        concurrency = min(int(payload.get("concurrency") or CHANNEL_INFO_CONCURRENCY), CHANNEL_INFO_CONCURRENCY)
+    except (TypeError, ValueError) as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid options: {e}"})
+    started_at = time.monotonic()
+    channels = await fetch_channels_info(chat_ids, concurrency, bool(payload.get("refresh")))
+    return {
+        "success": all(channel["success"] for channel in channels),
+        "channels": channels,
+        "elapsed_seconds": round(time.monotonic() - started_at, 3)
+    }
+
 @app.post("/collect-tips")
 async def collect_tips(request: Request, payload: dict = Body(...), authorization: str = Header(None)):
     log_request(request, payload)
@@ -550,38 +3413,175 @@ async def collect_tips(request: Request, payload: dict = Body(...), authorizatio
         if not is_authorized(authorization):
             return JSONResponse(status_code=401, content={"error": "Unauthorized"})
         channels = payload.get("channels")
-        collected_tips = []
         if not channels:
-            print("[Collect] ❌ Nenhum canal recebido")
+            log_event(logging.WARNING, "Collect", "❌ Nenhum canal recebido")
             return JSONResponse(status_code=400, content={"error": "Missing channels"})
-        for channel in channels:
-            chat_id = channel.get("chat_id")
-            since_str = channel.get("since")
-            try:
-                since = parser.isoparse(since_str).astimezone(timezone.utc) if since_str else datetime.utcnow().replace(
-                    hour=0, minute=0, second=0, microsecond=0, tzinfo=timezone.utc
-                )
-                print(f"[Collect] ▶️ Iniciando coleta para {chat_id} desde {since.isoformat()}")
-            except Exception as e:
-                print(f"[Collect] ⚠️ Erro ao interpretar 'since' para {chat_id}: {e}")
-                continue
-            try:
-                tips = await collect_tips_until_date(chat_id, since)
-                collected_tips.extend(tips)
-            except Exception as e:
-                print(f"[Collect] ❌ Erro ao coletar tips para {chat_id}: {e}")
-            await asyncio.sleep(2)
-        print(f"[Collect] ✅ Finalizando com {len(collected_tips)} tips.")
-        print("[Collect] ✅ Enviando resposta...")
-        return JSONResponse(content={"success": True, "tips": collected_tips})
+        try:
+            options = parse_collect_options(payload)
+        except (TypeError, ValueError) as e:
+            return JSONResponse(status_code=400, content={"error": f"Invalid options: {e}"})
+        started_at = time.monotonic()
+        collected_tips, reports = await run_collection(channels, options["concurrency"], options["backfill"], options["llm_batch_size"], persist=options["persist"], max_messages=options["max_messages"])
+        log_event(logging.INFO, "Collect", "✅ Coleta terminada", channels=len(reports), tips=len(collected_tips), elapsed=round(time.monotonic() - started_at, 3))
+        return JSONResponse(content={
+            "success": True,
+            "tips": collected_tips,
+            "channels": reports,
+            "elapsed_seconds": round(time.monotonic() - started_at, 3)
+        })
     except Exception as e:
-        print(f"[Collect] ❌ EXCEPTION inesperada em /collect-tips: {e}")
+        log_event(logging.ERROR, "Collect", "❌ EXCEPTION inesperada em /collect-tips", error=str(e))
         return JSONResponse(status_code=500, content={"error": "Internal error", "details": str(e)})
         
+@app.post("/collect-tips/jobs", status_code=202)
+async def create_collect_job(request: Request, payload: dict = Body(...), authorization: str = Header(None)):
+    log_request(request, payload)
+    if not is_authorized(authorization):
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    channels = payload.get("channels")
+    if not channels:
+        return JSONResponse(status_code=400, content={"error": "Missing channels"})
+    try:
+        options = parse_collect_options(payload)
+    except (TypeError, ValueError) as e:
+        return JSONResponse(status_code=400, content={"error": f"Invalid options: {e}"})
+    if COLLECT_QUEUE == "shared":
+        # Na fila partilhada o paralelismo é o dos workers (WORKER_CONCURRENCY) e as tips são sempre gravadas
+        if "concurrency" in payload:
+            return JSONResponse(status_code=400, content={"error": "'concurrency' is not supported with the shared queue (set WORKER_CONCURRENCY on the workers)"})
+        if not options["persist"] and "persist" in payload:
+            return JSONResponse(status_code=400, content={"error": "'persist': false is not supported with the shared queue (tips are always persisted)"})
+        job_id = await asyncio.to_thread(enqueue_shared_job, channels, options)
+        log_event(logging.INFO, "Jobs", "📥 Job na fila partilhada", job_id=job_id, channels=len(channels))
+        return { "success": True, "job_id": job_id, "status": "queued", "queue": "shared", "channels_total": len(channels) }
+    prune_collect_jobs()
+    job = CollectJob(channels, options)
+    collect_jobs[job.id] = job
+    await collect_job_queue.put(job)
+    log_event(logging.INFO, "Jobs", "📥 Job em fila", job_id=job.id, channels=len(channels))
+    return { "success": True, **job.summary() }
+
+@app.get("/collect-tips/jobs/{job_id}")
+async def get_collect_job(request: Request, job_id: str, offset: int = 0):
+    auth_check(request)
+    job = collect_jobs.get(job_id)
+    if not job and COLLECT_QUEUE == "shared":
+        tasks = await asyncio.to_thread(state_store.get_job_tasks, job_id)
+        if tasks:
+            return { "success": True, **shared_job_summary(job_id, tasks) }
+    if not job:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    tips = job.tips[offset:]
+    if job.finished and offset + len(tips) >= len(job.tips):
+        job.fetched_at = job.fetched_at or datetime.now(timezone.utc)
+    return {
+        "success": True,
+        **job.summary(),
+        "tips": tips,
+        "next_offset": offset + len(tips),
+        "channels": job.reports
+    }
+
+@app.get("/collect-tips/jobs/{job_id}/stream")
+async def stream_collect_job_events(request: Request, job_id: str, format: str = "ndjson"):
+    auth_check(request)
+    job = collect_jobs.get(job_id)
+    if not job:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    sse = format == "sse"
+    return StreamingResponse(
+        stream_collect_job(job, sse),
+        media_type="text/event-stream" if sse else "application/x-ndjson"
+    )
+
+@app.delete("/collect-tips/jobs/{job_id}")
+async def delete_collect_job(request: Request, job_id: str):
+    auth_check(request)
+    job = collect_jobs.get(job_id)
+    if not job and COLLECT_QUEUE == "shared":
+        # Só as tasks ainda em fila são canceladas; as que têm lease terminam normalmente
+        tasks = await asyncio.to_thread(state_store.get_job_tasks, job_id)
+        if tasks:
+            cancelled = await asyncio.to_thread(state_store.cancel_job_tasks, job_id)
+            return { "success": True, "job_id": job_id, "status": "cancelling", "tasks_cancelled": cancelled }
+    if not job:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    if job.finished:
+        del collect_jobs[job_id]
+        return { "success": True, "job_id": job_id, "status": "deleted" }
+    cancel_collect_job(job)
+    return { "success": True, "job_id": job_id, "status": "cancelling" if job.status == "running" else job.status }
+
+@app.get("/live/channels")
+async def list_live_channels(request: Request):
+    auth_check(request)
+    return {
+        "success": True,
+        "live_mode": LIVE_MODE,
+        "channels": [{ "chat_id": identifier, "peer_id": peer_id } for peer_id, identifier in live_channels.items()],
+        "stalled": sorted(live_stalled_channels),
+        "stats": live_stats
+    }
+
+@app.post("/live/channels")
+async def add_live_channels(request: Request, payload: dict = Body(...), authorization: str = Header(None)):
+    log_request(request, payload)
+    if not is_authorized(authorization):
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    if not LIVE_MODE:
+        return JSONResponse(status_code=409, content={"error": "Live mode is disabled (LIVE_MODE=1)"})
+    telegram_priority.set(PRIORITY_INTERACTIVE)
+    chat_ids = payload.get("chat_ids")
+    if not chat_ids:
+        return JSONResponse(status_code=400, content={"error": "Missing chat_ids"})
+    registered, errors = [], []
+    for chat_id in chat_ids:
+        try:
+            registered.append(await register_live_channel(chat_id))
+        except Exception as e:
+            errors.append({ "chat_id": chat_id, "error": str(e) })
+    return { "success": not errors, "registered": registered, "errors": errors }
+
+@app.delete("/live/channels")
+async def remove_live_channels(request: Request, payload: dict = Body(...), authorization: str = Header(None)):
+    if not is_authorized(authorization):
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+    chat_ids = payload.get("chat_ids") or []
+    removed = [chat_id for chat_id in chat_ids if unregister_live_channel(chat_id)]
+    return { "success": True, "removed": removed }
+
+@app.get("/live/tips")
+async def drain_live_tips(request: Request, limit: int = 100):
+    auth_check(request)
+    tips = []
+    while len(tips) < limit and not live_tips_queue.empty():
+        tips.append(live_tips_queue.get_nowait())
+    return { "success": True, "tips": tips, "remaining": live_tips_queue.qsize() }
+
 @app.post("/get-tipster-strategy")
 async def get_tipster_strategy(request: Request, body: AnalyzeStrategyRequest, authorization: str = Header(None)):
     log_request(request, body.dict())
     if not is_authorized(authorization):
         return JSONResponse(status_code=401, content={"error": "Unauthorized"})
-    result = analyze_tipster_strategy_with_openai(body.tips)
-    return { "success": True, "result": result }
+    # Sem chat_id explícito, usa o canal das tips quando são todas do mesmo
+    chat_ids = { str(tip["chat_id"]) for tip in body.tips if tip.get("chat_id") is not None }
+    chat_id = body.chat_id or (chat_ids.pop() if len(chat_ids) == 1 else None)
+    if chat_id is None:
+        aggregate = await asyncio.to_thread(StrategyAggregate.from_tips, body.tips)
+        result = await analyze_tipster_strategy_with_openai(body.tips, aggregate)
+        return { "success": True, "result": result, "aggregates": aggregate.features() }
+    profile = await update_strategy_profile(chat_id, body.tips, body.force)
+    return {
+        "success": True,
+        "result": profile["summary"],
+        "aggregates": StrategyAggregate.from_dict(profile["aggregate"]).features(),
+        "profile": {
+            "chat_id": chat_id,
+            "tips": len(profile["tip_ids"]),
+            "summary_tips": profile["summary_tips"],
+            "mode": profile["mode"],
+            "drift": profile["drift"],
+            "refreshed": profile["refreshed"],
+            "updated_at": profile["updated_at"]
+        }
+    }
@@ -0,0 +1,68 @@
+-- Fila partilhada de coleta (COLLECT_QUEUE=shared / WORKER_MODE=1) no Supabase.
+-- Correr uma vez no SQL editor (ou como migração) antes de ativar os workers.
+-- Os nomes assumem COLLECT_TASKS_TABLE=collect_tasks.
+
+create table if not exists collect_tasks (
+    task_id text primary key,
+    job_id text not null,
+    chat_id text not null,
+    channel jsonb not null,
+    options jsonb,
+    status text not null default 'queued',
+    worker_id text,
+    lease_until timestamptz,
+    attempts int not null default 0,
+    report jsonb,
+    error text,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+create index if not exists collect_tasks_job_idx on collect_tasks (job_id, created_at);
+create index if not exists collect_tasks_status_idx on collect_tasks (status, created_at);
+create index if not exists collect_tasks_chat_idx on collect_tasks (chat_id, status);
+
+-- Entrega no máximo uma task ao worker, com lease de p_lease_seconds.
+-- O advisory lock serializa os claims: dois workers nunca recebem a mesma task nem tasks do mesmo canal.
+-- Leases expiradas sem tentativas restantes ficam failed; as restantes voltam a ser entregues.
+create or replace function claim_collect_task(p_worker_id text, p_lease_seconds int, p_max_attempts int)
+returns setof collect_tasks
+language plpgsql
+as $$
+declare
+    v_task_id text;
+begin
+    perform pg_advisory_xact_lock(hashtext('claim_collect_task'));
+
+    update collect_tasks
+       set status = 'failed',
+           error = 'Lease expired after ' || attempts || ' attempts',
+           updated_at = now()
+     where status = 'leased' and lease_until < now() and attempts >= p_max_attempts;
+
+    select t.task_id into v_task_id
+      from collect_tasks t
+     where (t.status = 'queued' or (t.status = 'leased' and t.lease_until < now()))
+       and not exists (
+           select 1 from collect_tasks o
+            where o.chat_id = t.chat_id and o.status = 'leased'
+              and o.lease_until >= now() and o.task_id <> t.task_id
+       )
+     order by t.created_at
+     limit 1;
+
+    if v_task_id is null then
+        return;
+    end if;
+
+    return query
+    update collect_tasks
+       set status = 'leased',
+           worker_id = p_worker_id,
+           lease_until = now() + make_interval(secs => p_lease_seconds),
+           attempts = attempts + 1,
+           updated_at = now()
+     where task_id = v_task_id
+    returning *;
+end;
+$$;
@@ -0,0 +1,43 @@
+# Treina o modelo opcional do pré-filtro a partir das amostras gravadas em modo shadow
+# (PREFILTER_SAMPLES_PATH). Requer scikit-learn e joblib, que não fazem parte do requirements.txt.
+#
+#   python train_prefilter.py prefilter_samples.jsonl prefilter_model.joblib
+import json
+import sys
+
+import joblib
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import cross_val_score
+from sklearn.pipeline import make_pipeline
+
+def load_samples(path: str):
+    texts, labels = [], []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            sample = json.loads(line)
+            texts.append(sample["text"])
+            labels.append(int(sample["is_tip"]))
+    return texts, labels
+
+def main(samples_path: str, model_path: str):
+    texts, labels = load_samples(samples_path)
+    print(f"[Prefilter] {len(texts)} amostras, {sum(labels)} tips")
+    model = make_pipeline(
+        TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4), min_df=2, sublinear_tf=True),
+        LogisticRegression(max_iter=1000, class_weight="balanced")
+    )
+    if len(set(labels)) > 1 and min(labels.count(0), labels.count(1)) >= 5:
+        scores = cross_val_score(model, texts, labels, cv=5, scoring="recall")
+        print(f"[Prefilter] Recall (cv=5): {scores.mean():.3f}")
+    model.fit(texts, labels)
+    joblib.dump(model, model_path)
+    print(f"[Prefilter] ✅ Modelo gravado em {model_path}")
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Uso: python train_prefilter.py <amostras.jsonl> <modelo.joblib>")
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2])